@@ -0,0 +1,307 @@
+"""
+ASGI 入口: 视频信息提取和进度推送在事件循环中等待, 慢速提取不再占用工作线程
+
+    pip install asgiref uvicorn    (或 uv sync --extra asgi)
+    uvicorn asgi:application --host 0.0.0.0 --port 5001
+
+阻塞的 yt-dlp 调用在有界线程池中执行, 每个请求有超时时间, 客户端断开后放弃提取;
+其余路由仍由 Flask 应用处理, 在另一个有界线程池中执行
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from web_server import (
+    app,
+    ERRORS,
+    ProgressEventStream,
+    progress_registry,
+    warmup,
+)
+
+# 执行视频信息提取的线程数, 超出的请求排队等待
+ASYNC_EXTRACT_THREADS = int(os.environ.get('ASYNC_EXTRACT_THREADS', 32))
+# 单个视频信息请求的最长时间(秒, 包括排队), 超时返回 504 并放弃提取
+ASYNC_EXTRACT_TIMEOUT = float(os.environ.get('ASYNC_EXTRACT_TIMEOUT', 60))
+# 执行其余 Flask 路由(下载、文件发送等)的线程数
+ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 16))
+
+extract_executor = ThreadPoolExecutor(ASYNC_EXTRACT_THREADS, thread_name_prefix='extract')
+wsgi_executor = ThreadPoolExecutor(ASYNC_WSGI_THREADS, thread_name_prefix='wsgi')
+
+class ClientDisconnected(Exception):
+    """
+    客户端在响应发送完之前断开了连接
+    """
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+async def send_json(send, body, status):
+    content = (app.json.dumps(body) + '\n').encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode('latin-1')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+async def call_state(func, *args):
+    """
+    读取进度存储; 使用共享状态后端时在线程池中执行, 避免阻塞事件循环
+    """
+    if progress_registry.backend is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+class AsyncWakeup:
+    """
+    把 progress_notifier 在下载线程中发出的通知转交给事件循环
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+async def progress_stream(scope, receive, send, download_ids):
+    """
+    Server-Sent Events 推送, 与 Flask 路由的行为相同, 但等待进度时不占用线程
+    """
+    wakeup = AsyncWakeup(asyncio.get_running_loop())
+    stream = ProgressEventStream(download_ids, wakeup)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            # 禁用 nginx 的响应缓冲, 否则事件会被攒起来
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    try:
+        chunk = stream.open()
+        while not disconnect.done():
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            events, timeout = await call_state(stream.poll)
+            chunk = ''.join(events)
+            if stream.finished:
+                break
+            if chunk:
+                continue
+            waiter = asyncio.ensure_future(wakeup.event.wait())
+            done, _ = await asyncio.wait({waiter, disconnect}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if not done:
+                chunk = stream.keepalive() or ''
+        if not disconnect.done():
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8')})
+    finally:
+        stream.close()
+        disconnect.cancel()
+
+def build_environ(scope, body, cancel_event, deadline=None):
+    """
+    按 PEP 3333 把 ASGI 的 scope 和请求体转换成 WSGI environ
+    """
+    script_name = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    path_info = scope['path'].encode('utf-8').decode('latin-1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # Flask 路由通过它得知客户端已经断开或请求已经超时
+        'ytdlp_webui.cancel_event': cancel_event,
+        # 请求的截止时间 (time.monotonic()), 没有超时设置时为 None
+        'ytdlp_webui.deadline': deadline,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        # 重复的请求头按 RFC 9110 合并成一个
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+class WsgiBridgeInstance:
+    """
+    在指定的有界线程池中执行一个 Flask 请求 (asgiref 的 WSGI 适配器把所有请求放到同一个线程中执行,
+    并且不会关闭响应迭代器). 客户端断开或超过 timeout 后不再发送, 并通过 environ 中的 cancel_event
+    通知 Flask 路由放弃工作; 响应迭代器总会被关闭(释放正在发送的文件、结束流式下载的循环)
+    """
+    def __init__(self, wsgi_application, executor, timeout=None):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+        self.timeout = timeout
+        self.cancel_event = threading.Event()
+        self.response_started = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            # 在工作线程中调用, 把消息交给事件循环发送
+            self.sync_send = async_to_sync(send)
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            await self.run_wsgi_app(build_environ(scope, body, self.cancel_event, deadline), receive)
+
+    async def run_wsgi_app(self, environ, receive):
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        worker = asyncio.ensure_future(
+            sync_to_async(self.run_wsgi_app_in_thread, thread_sensitive=False, executor=self.executor)(environ)
+        )
+        try:
+            done, _ = await asyncio.wait({worker, disconnect}, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            if worker in done:
+                worker.result()
+                return
+            # 线程中的请求不会再发送任何内容, 阻塞的调用返回后自行结束
+            self.cancel_event.set()
+            worker.add_done_callback(lambda task: task.cancelled() or task.exception())
+            if disconnect not in done:
+                await self.timed_out()
+        finally:
+            disconnect.cancel()
+
+    async def timed_out(self):
+        if not self.response_started:
+            self.response_started = True
+            await send_json(self.send, {'error': 'Request timed out.'}, 504)
+
+    def checked_send(self, message):
+        if self.cancel_event.is_set():
+            raise ClientDisconnected()
+        self.sync_send(message)
+
+    def run_wsgi_app_in_thread(self, environ):
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and self.response_started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start.update(
+                type='http.response.start',
+                status=int(status.split(' ', 1)[0]),
+                headers=[(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            )
+
+        def start():
+            if not self.response_started:
+                self.response_started = True
+                self.checked_send(response_start)
+
+        iterable = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in iterable:
+                start()
+                if chunk:
+                    self.checked_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start()
+            self.checked_send({'type': 'http.response.body'})
+        except ClientDisconnected:
+            pass
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+class VideoInfoRequest(WsgiBridgeInstance):
+    """
+    /get_video_info: 在提取线程池中执行, 超过 ASYNC_EXTRACT_TIMEOUT 返回 504;
+    放弃后排队中的提取不再执行, 正在运行的 yt-dlp 子进程被结束,
+    进程内提取无法中断, 完成后结果进入缓存
+    """
+    def __init__(self, wsgi_application):
+        super().__init__(wsgi_application, extract_executor, ASYNC_EXTRACT_TIMEOUT)
+
+    async def timed_out(self):
+        ERRORS.inc(stage='info', error_class='timeout')
+        app.logger.warning("Timed out after %ss fetching video info", ASYNC_EXTRACT_TIMEOUT)
+        if not self.response_started:
+            self.response_started = True
+            await send_json(self.send, {'error': 'Timed out while fetching video information. Please try again.'}, 504)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # 在后台预热 yt-dlp, 不推迟开始监听
+            warmup.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            extract_executor.shutdown(wait=False, cancel_futures=True)
+            wsgi_executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+    if path == '/get_video_info':
+        await VideoInfoRequest(app)(scope, receive, send)
+    elif method == 'GET' and path == '/progress_stream':
+        query = urllib.parse.parse_qs(scope['query_string'].decode('latin-1'))
+        download_ids = list(dict.fromkeys(i for i in query.get('ids', [''])[0].split(',') if i))
+        if not download_ids:
+            await send_json(send, {'error': 'At least one download ID is required'}, 400)
+            return
+        await progress_stream(scope, receive, send, download_ids)
+    elif method == 'GET' and path.startswith('/progress_stream/') and '/' not in path[len('/progress_stream/'):]:
+        download_id = path[len('/progress_stream/'):]
+        if not await call_state(progress_registry.__contains__, download_id):
+            await send_json(send, {'error': 'Download ID not found'}, 404)
+            return
+        await progress_stream(scope, receive, send, [download_id])
+    else:
+        await WsgiBridgeInstance(app, wsgi_executor)(scope, receive, send)
@@ -0,0 +1,209 @@
+"""
+Throughput benchmark for /download_video.
+
+Compares the range-capable file path used by /download_video with the
+previous send_from_directory implementation, under the Werkzeug
+development server or under Gunicorn (which sends files with sendfile).
+
+    python benchmarks/file_serving.py --server werkzeug
+    python benchmarks/file_serving.py --server gunicorn --size-mb 512 --clients 8
+
+Everything runs locally against a temporary DOWNLOADS_DIR.
+"""
+import argparse
+import http.client
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOWNLOAD_ID = 'benchmark'
+
+
+def create_app():
+    """
+    Application factory used by both servers: the normal app plus a route
+    that serves the same file the way /download_video used to.
+    """
+    sys.path.insert(0, ROOT)
+    import web_server
+    from flask import jsonify, send_from_directory
+
+    @web_server.app.route('/_benchmark/legacy/<download_id>')
+    def legacy_download(download_id):
+        progress_data = web_server.progress_registry.snapshot(download_id)
+        if progress_data is None:
+            return jsonify({'error': 'Download ID not found'}), 404
+        filename = progress_data['filename_on_server']
+        return send_from_directory(
+            directory=os.path.dirname(filename),
+            path=os.path.basename(filename),
+            as_attachment=True,
+            download_name=progress_data['suggested_filename'],
+            mimetype=progress_data['mimetype']
+        )
+
+    return web_server.app
+
+
+def prepare_artifact(size_mb):
+    import web_server
+    path = os.path.join(web_server.ARTIFACTS_DIR, 'be', 'benchmark.mp4')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chunk = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(chunk)
+    web_server.progress_registry.create(
+        DOWNLOAD_ID,
+        'completed',
+        progress=100,
+        filename_on_server=path,
+        suggested_filename='benchmark.mp4',
+        mimetype='video/mp4'
+    )
+    return path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start on port {port}')
+
+
+def start_server(kind, port):
+    """
+    Start the server and return a function that stops it.
+    """
+    if kind == 'werkzeug':
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', port, create_app(), threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server.shutdown
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--bind', f'127.0.0.1:{port}', '--access-logfile', '/dev/null', '--log-level', 'warning',
+         'benchmarks.file_serving:create_app()'],
+        cwd=ROOT,
+        env=env
+    )
+    wait_for_port(port)
+
+    def stop():
+        process.terminate()
+        process.wait()
+    return stop
+
+
+def fetch(port, path, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        received = 0
+        while True:
+            data = response.read(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+        if response.status not in (200, 206):
+            raise RuntimeError(f'{path} returned HTTP {response.status}')
+        return received
+    finally:
+        conn.close()
+
+
+def run_scenario(port, path, clients, requests_per_client, file_size, range_mb):
+    """
+    Each client downloads the file requests_per_client times, either whole
+    or as random ranges of range_mb MiB, and the aggregate rate is reported.
+    """
+    latencies = []
+    totals = []
+    lock = threading.Lock()
+
+    def client():
+        received = 0
+        for _ in range(requests_per_client):
+            headers = {}
+            if range_mb:
+                length = range_mb * 1024 * 1024
+                start = random.randrange(0, max(1, file_size - length))
+                headers['Range'] = f'bytes={start}-{start + length - 1}'
+            started = time.perf_counter()
+            received += fetch(port, path, headers)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        with lock:
+            totals.append(received)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    total = sum(totals)
+    return {
+        'seconds': elapsed,
+        'mib_per_second': total / elapsed / (1024 * 1024),
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--size-mb', type=int, default=256, help='size of the served file')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=4, help='requests per client')
+    parser.add_argument('--range-mb', type=int, default=8, help='size of each ranged request in the range scenario')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ytdlp-webui-bench-')
+    os.environ['DOWNLOADS_DIR'] = workdir
+    os.environ['STATE_BACKEND'] = f'sqlite:///{os.path.join(workdir, "state.sqlite3")}'
+    os.environ.setdefault('WEB_WORKERS', '1')
+    sys.path.insert(0, ROOT)
+    file_size = os.path.getsize(prepare_artifact(args.size_mb))
+
+    port = free_port()
+    stop = start_server(args.server, port)
+    try:
+        print(f'{args.server}: {args.size_mb} MiB file, {args.clients} clients x {args.requests} requests')
+        print(f'{"path":<10} {"mode":<10} {"MiB/s":>10} {"req/s":>8} {"p50 ms":>10} {"p99 ms":>10}')
+        for name, path in (('legacy', f'/_benchmark/legacy/{DOWNLOAD_ID}'), ('current', f'/download_video/{DOWNLOAD_ID}')):
+            for mode, range_mb in (('full', 0), (f'range {args.range_mb}M', args.range_mb)):
+                result = run_scenario(port, path, args.clients, args.requests, file_size, range_mb)
+                print(f'{name:<10} {mode:<10} {result["mib_per_second"]:>10.1f} {result["requests_per_second"]:>8.1f} '
+                      f'{result["p50_ms"]:>10.1f} {result["p99_ms"]:>10.1f}')
+    finally:
+        stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,636 @@
+"""
+Offline load test for the web server.
+
+Starts a fake video host on localhost (HTML pages with a <video> tag, read
+by yt-dlp's generic extractor, and range-capable media files), starts the
+server under test in a subprocess, and runs these scenarios against it:
+
+    info          concurrent /get_video_info lookups of distinct videos (cache misses)
+    info-cached   the same lookups again, answered from the metadata cache
+    downloads     a burst of /start_download requests, each polled until completed
+    pollers       many clients polling /download_progress
+    serving       concurrent /download_video transfers of the finished files
+
+Each scenario reports p50/p99 latency, throughput, and the peak resident
+memory and open file descriptors of the server processes. Results are
+saved as JSON so two runs can be compared:
+
+    python benchmarks/load_test.py --label before
+    python benchmarks/load_test.py --label after --compare benchmarks/results/before-*.json
+    python benchmarks/load_test.py --server gunicorn --scenarios info,pollers --clients 32
+
+Nothing leaves the machine; the server gets a temporary DOWNLOADS_DIR.
+"""
+import argparse
+import glob
+import http.client
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SCENARIOS = ('info', 'info-cached', 'downloads', 'pollers', 'serving')
+FINAL_STATUSES = ('completed', 'error', 'cancelled')
+
+
+class FakeCDNHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /watch/<id> returns a page with a <video> tag pointing at /media/<id>.mp4;
+    media files are generated on the fly and support Range requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Set by FakeCDN
+    media_size = 0
+    page_latency = 0.0
+    rate = 0
+    block = b''
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = urllib.parse.urlsplit(self.path).path
+        match = re.fullmatch(r'/watch/([\w-]+)', path)
+        if match:
+            time.sleep(self.page_latency)
+            body = (
+                f'<html><head><title>Benchmark video {match.group(1)}</title></head>'
+                f'<body><video src="/media/{match.group(1)}.mp4"></video></body></html>'
+            ).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+        if not re.fullmatch(r'/media/[\w-]+\.mp4', path):
+            self.send_error(404)
+            return
+
+        start, end = 0, self.media_size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and match.group(1):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+        if start > end:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{self.media_size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{self.media_size}')
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        remaining = end - start + 1
+        started = time.perf_counter()
+        sent = 0
+        try:
+            while remaining > 0:
+                chunk = self.block[:min(remaining, len(self.block))]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                sent += len(chunk)
+                if self.rate:
+                    # Throttle to the configured rate per connection
+                    delay = sent / self.rate - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class FakeCDN:
+    """
+    Threaded fake video host running in the benchmark process.
+    """
+    def __init__(self, media_size, page_latency, rate):
+        handler = type('Handler', (FakeCDNHandler,), {
+            'media_size': media_size,
+            'page_latency': page_latency,
+            'rate': rate,
+            'block': os.urandom(256 * 1024),
+        })
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, video_id):
+        return f'http://127.0.0.1:{self.port}/watch/{video_id}'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Server did not start on port {port}')
+
+
+def start_server(kind, port, env, log):
+    """
+    Start the server under test in its own process group and return the process.
+    """
+    if kind == 'werkzeug':
+        command = [
+            sys.executable, '-c',
+            'import sys, web_server; from werkzeug.serving import run_simple; '
+            'web_server.warmup.start(); run_simple("127.0.0.1", int(sys.argv[1]), web_server.app, threaded=True)',
+            str(port),
+        ]
+    elif kind == 'gunicorn':
+        command = [
+            sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+            '--bind', f'127.0.0.1:{port}', '--access-logfile', '/dev/null', '--log-level', 'warning',
+            'web_server:app',
+        ]
+    else:
+        command = [
+            sys.executable, '-m', 'uvicorn', 'asgi:application',
+            '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log',
+        ]
+    return subprocess.Popen(
+        command, cwd=ROOT, env=env, start_new_session=True,
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def process_tree(pid):
+    """
+    The server process and its descendants (gunicorn workers), from /proc.
+    """
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split('/')[2]))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def resource_usage(pid):
+    """
+    Resident memory (MiB) and open file descriptors summed over the server's
+    processes, or None where /proc is not available.
+    """
+    if not os.path.isdir(f'/proc/{pid}'):
+        return None
+    rss = fds = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                        break
+            fds += len(os.listdir(f'/proc/{member}/fd'))
+        except OSError:
+            continue
+    return {'rss_mb': round(rss / (1024 * 1024), 1), 'fds': fds}
+
+
+class ResourceSampler:
+    """
+    Samples the server's memory and descriptors while a scenario runs.
+    """
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            usage = resource_usage(self.pid)
+            if usage is not None:
+                self.samples.append(usage)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        return {
+            'rss_peak_mb': max(s['rss_mb'] for s in self.samples),
+            'rss_end_mb': self.samples[-1]['rss_mb'],
+            'fds_peak': max(s['fds'] for s in self.samples),
+            'fds_end': self.samples[-1]['fds'],
+        }
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def latency_summary(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+def request(port, method, path, body=None, read=True):
+    """
+    One request on a new connection; returns (status, body, seconds, bytes received).
+    """
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    started = time.perf_counter()
+    try:
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        data = b''
+        received = 0
+        if read and response.status == 200 and response.getheader('Content-Type', '').startswith('application/json'):
+            data = response.read()
+            received = len(data)
+        else:
+            while True:
+                chunk = response.read(1024 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+        return response.status, data, time.perf_counter() - started, received
+    finally:
+        conn.close()
+
+
+def run_clients(clients, work):
+    """
+    Run work(client_index) in parallel threads; returns the wall time and errors.
+    """
+    errors = []
+
+    def client(index):
+        try:
+            work(index)
+        except Exception as e:
+            errors.append(f'{type(e).__name__}: {e}')
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, errors
+
+
+def scenario_info(ctx, args, video_ids):
+    latencies = []
+    failures = []
+    pending = list(video_ids)
+    lock = threading.Lock()
+
+    def work(index):
+        while True:
+            with lock:
+                if not pending:
+                    return
+                video_id = pending.pop()
+            url = urllib.parse.quote(ctx['cdn'].url(video_id), safe='')
+            status, _, seconds, _ = request(ctx['port'], 'GET', f'/get_video_info?url={url}')
+            with lock:
+                latencies.append(seconds)
+                if status != 200:
+                    failures.append(status)
+
+    elapsed, errors = run_clients(args.clients, work)
+    return dict(
+        latency_summary(latencies),
+        seconds=round(elapsed, 3),
+        requests_per_second=round(len(latencies) / elapsed, 1),
+        failures=len(failures) + len(errors),
+    )
+
+
+def scenario_downloads(ctx, args):
+    """
+    Starts args.downloads jobs at once and polls each until it finishes.
+    """
+    start_latencies = []
+    job_seconds = []
+    completed = []
+    failures = []
+    lock = threading.Lock()
+    video_ids = [f'{ctx["run"]}-dl-{i}' for i in range(args.downloads)]
+
+    def work(index):
+        for video_id in video_ids[index::args.clients]:
+            url = urllib.parse.quote(ctx['cdn'].url(video_id), safe='')
+            status, data, seconds, _ = request(ctx['port'], 'GET', f'/start_download?url={url}&format_id=0')
+            started = time.perf_counter() - seconds
+            with lock:
+                start_latencies.append(seconds)
+            if status not in (200, 202):
+                with lock:
+                    failures.append(status)
+                continue
+            download_id = json.loads(data)['download_id']
+            while True:
+                status, data, _, _ = request(ctx['port'], 'GET', f'/download_progress/{download_id}')
+                progress = json.loads(data) if status == 200 else {'status': 'error', 'error': f'HTTP {status}'}
+                if progress.get('status') in FINAL_STATUSES:
+                    break
+                time.sleep(args.poll_interval)
+            with lock:
+                job_seconds.append(time.perf_counter() - started)
+                if progress['status'] == 'completed':
+                    completed.append(download_id)
+                else:
+                    failures.append(progress.get('error') or progress['status'])
+
+    elapsed, errors = run_clients(min(args.clients, args.downloads), work)
+    ctx['download_ids'] = completed
+    start = latency_summary(start_latencies)
+    jobs = latency_summary(job_seconds)
+    return {
+        'count': len(video_ids),
+        'start_p50_ms': start['p50_ms'],
+        'start_p99_ms': start['p99_ms'],
+        'p50_ms': jobs['p50_ms'],
+        'p99_ms': jobs['p99_ms'],
+        'max_ms': jobs['max_ms'],
+        'seconds': round(elapsed, 3),
+        'jobs_per_second': round(len(completed) / elapsed, 2),
+        'mib_per_second': round(len(completed) * args.media_mb / elapsed, 1),
+        'failures': len(failures) + len(errors),
+    }
+
+
+def scenario_pollers(ctx, args):
+    """
+    args.pollers clients poll progress of the finished downloads for args.duration seconds.
+    """
+    download_ids = ctx.get('download_ids') or ['missing']
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def work(index):
+        local = []
+        while time.perf_counter() < deadline:
+            status, _, seconds, _ = request(ctx['port'], 'GET', f'/download_progress/{random.choice(download_ids)}')
+            local.append(seconds)
+            if status not in (200, 404):
+                failures.append(status)
+        with lock:
+            latencies.extend(local)
+
+    elapsed, errors = run_clients(args.pollers, work)
+    return dict(
+        latency_summary(latencies),
+        seconds=round(elapsed, 3),
+        requests_per_second=round(len(latencies) / elapsed, 1),
+        failures=len(failures) + len(errors),
+    )
+
+
+def scenario_serving(ctx, args):
+    """
+    Each client downloads finished files args.requests times.
+    """
+    download_ids = ctx.get('download_ids')
+    if not download_ids:
+        return {'skipped': 'no completed downloads'}
+    latencies = []
+    received = []
+    failures = []
+    lock = threading.Lock()
+
+    def work(index):
+        for i in range(args.requests):
+            download_id = download_ids[(index + i) % len(download_ids)]
+            status, _, seconds, size = request(ctx['port'], 'GET', f'/download_video/{download_id}', read=False)
+            with lock:
+                latencies.append(seconds)
+                received.append(size)
+                if status != 200:
+                    failures.append(status)
+
+    elapsed, errors = run_clients(args.clients, work)
+    return dict(
+        latency_summary(latencies),
+        seconds=round(elapsed, 3),
+        requests_per_second=round(len(latencies) / elapsed, 1),
+        mib_per_second=round(sum(received) / elapsed / (1024 * 1024), 1),
+        failures=len(failures) + len(errors),
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_results(results):
+    print(f'{"scenario":<12} {"p50 ms":>10} {"p99 ms":>10} {"req/s":>9} {"MiB/s":>8} {"RSS MiB":>9} {"fds":>6} {"fail":>5}')
+    for name, result in results['scenarios'].items():
+        if 'skipped' in result:
+            print(f'{name:<12} skipped: {result["skipped"]}')
+            continue
+        rate = result.get('requests_per_second', result.get('jobs_per_second'))
+
+        def cell(value, width, digits=1):
+            return f'{value:>{width}.{digits}f}' if isinstance(value, (int, float)) else f'{"-":>{width}}'
+        print(f'{name:<12} {cell(result.get("p50_ms"), 10)} {cell(result.get("p99_ms"), 10)} {cell(rate, 9)} '
+              f'{cell(result.get("mib_per_second"), 8)} {cell(result.get("rss_peak_mb"), 9)} '
+              f'{cell(result.get("fds_peak"), 6, 0)} {result.get("failures", 0):>5}')
+
+
+def compare_results(previous, current):
+    """
+    Print the relative change of the main numbers against an earlier run.
+    """
+    print(f'\nCompared with {previous.get("label")} ({previous.get("revision")}, {previous.get("timestamp")}):')
+    print(f'{"scenario":<12} {"metric":<18} {"before":>10} {"after":>10} {"change":>8}')
+    for name, result in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p99_ms', 'requests_per_second', 'jobs_per_second', 'mib_per_second', 'rss_peak_mb', 'fds_peak'):
+            old, new = before.get(metric), result.get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+                continue
+            change = f'{(new - old) / old * 100:+.1f}%' if old else '-'
+            print(f'{name:<12} {metric:<18} {old:>10} {new:>10} {change:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'asgi'), default='werkzeug')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients for info, downloads and serving')
+    parser.add_argument('--videos', type=int, default=64, help='distinct videos looked up in the info scenarios')
+    parser.add_argument('--downloads', type=int, default=16, help='downloads started in the burst')
+    parser.add_argument('--pollers', type=int, default=32, help='concurrent progress pollers')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the pollers run')
+    parser.add_argument('--requests', type=int, default=4, help='file downloads per client in the serving scenario')
+    parser.add_argument('--media-mb', type=int, default=16, help='size of each fake video')
+    parser.add_argument('--page-latency-ms', type=float, default=50, help='delay of the fake video pages, like a slow upstream site')
+    parser.add_argument('--cdn-rate', default='0', help='per-connection rate of the fake CDN (e.g. 20M), 0 = unlimited')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='seconds between progress polls of a download')
+    parser.add_argument('--server-log', help='file for the server output (default: discarded)')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for the server')
+    parser.add_argument('--label', default='run', help='name of this run in the results file')
+    parser.add_argument('--output', help=f'results file (default: {os.path.relpath(RESULTS_DIR, ROOT)}/<label>-<time>.json)')
+    parser.add_argument('--compare', help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    # yt-dlp's byte-size parser, also used by the server for its settings
+    sys.path.insert(0, ROOT)
+    from yt_dlp.utils import parse_bytes
+    cdn = FakeCDN(args.media_mb * 1024 * 1024, args.page_latency_ms / 1000, parse_bytes(args.cdn_rate) or 0)
+    cdn.start()
+
+    workdir = tempfile.mkdtemp(prefix='ytdlp-webui-load-')
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        DOWNLOADS_DIR=workdir,
+        STATE_BACKEND=f'sqlite:///{os.path.join(workdir, "state.sqlite3")}',
+        COOKIES_FILE=os.path.join(workdir, 'cookies.txt'),
+        DEBUG='false',
+    )
+    env.setdefault('WEB_WORKERS', '2')
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+
+    port = free_port()
+    launched = time.perf_counter()
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = start_server(args.server, port, env, log)
+    ctx = {'port': port, 'cdn': cdn, 'run': uuid.uuid4().hex[:8]}
+    results = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'server': args.server,
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'scenarios': {},
+    }
+    try:
+        wait_for_port(port, process)
+        results['startup'] = dict(seconds=round(time.perf_counter() - launched, 3), **(resource_usage(process.pid) or {}))
+        print(f'{args.server} on port {port}, started in {results["startup"]["seconds"]}s; fake CDN on port {cdn.port}')
+
+        video_ids = [f'{ctx["run"]}-info-{i}' for i in range(args.videos)]
+        for name in scenarios:
+            with ResourceSampler(process.pid) as sampler:
+                if name in ('info', 'info-cached'):
+                    # The second pass over the same videos is answered from the cache
+                    result = scenario_info(ctx, args, video_ids)
+                elif name == 'downloads':
+                    result = scenario_downloads(ctx, args)
+                elif name == 'pollers':
+                    result = scenario_pollers(ctx, args)
+                else:
+                    result = scenario_serving(ctx, args)
+            result.update(sampler.summary())
+            results['scenarios'][name] = result
+    finally:
+        stop_server(process)
+        if args.server_log:
+            log.close()
+        cdn.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    output = args.output or os.path.join(RESULTS_DIR, f'{args.label}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {os.path.relpath(output)}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Startup benchmark for the web server.
+
+Starts the server under each worker model several times and measures:
+
+    listen_ms       launch until /healthz answers (imports done, accepting requests)
+    ready_ms        launch until /readyz answers 200 (yt-dlp imported, sessions and
+                    extractor matching warmed up in the background)
+    rss_ready_mb    resident memory of all server processes once ready
+    first_info_ms   the first /get_video_info of a page on the local fake video host
+    rss_info_mb     resident memory after that lookup
+
+Every run gets a fresh temporary DOWNLOADS_DIR and nothing leaves the machine:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --servers gunicorn --runs 5 --env WEB_WORKERS=4
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from load_test import (
+    RESULTS_DIR,
+    ROOT,
+    FakeCDN,
+    free_port,
+    git_revision,
+    request,
+    resource_usage,
+    start_server,
+    stop_server,
+)
+
+SERVERS = ('werkzeug', 'gunicorn', 'asgi')
+
+
+def wait_for(port, process, path, timeout):
+    """
+    Poll path until it answers 200; return the seconds since the call.
+    """
+    started = time.perf_counter()
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        try:
+            status, _, _, _ = request(port, 'GET', path)
+            if status == 200:
+                return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f'{path} did not answer 200 within {timeout}s')
+
+
+def measure(kind, env, cdn, timeout):
+    workdir = tempfile.mkdtemp(prefix='ytdlp-webui-startup-')
+    run_env = dict(
+        env,
+        DOWNLOADS_DIR=workdir,
+        STATE_BACKEND=f'sqlite:///{os.path.join(workdir, "state.sqlite3")}',
+        COOKIES_FILE=os.path.join(workdir, 'cookies.txt'),
+    )
+    port = free_port()
+    launched = time.perf_counter()
+    process = start_server(kind, port, run_env, subprocess.DEVNULL)
+    try:
+        wait_for(port, process, '/healthz', timeout)
+        listen = time.perf_counter() - launched
+        wait_for(port, process, '/readyz', timeout)
+        ready = time.perf_counter() - launched
+        rss_ready = (resource_usage(process.pid) or {}).get('rss_mb')
+        url = urllib.parse.quote(cdn.url(f'startup-{port}'), safe='')
+        status, _, seconds, _ = request(port, 'GET', f'/get_video_info?url={url}')
+        if status != 200:
+            raise RuntimeError(f'/get_video_info returned {status}')
+        rss_info = (resource_usage(process.pid) or {}).get('rss_mb')
+    finally:
+        stop_server(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'listen_ms': round(listen * 1000, 1),
+        'ready_ms': round(ready * 1000, 1),
+        'rss_ready_mb': rss_ready,
+        'first_info_ms': round(seconds * 1000, 1),
+        'rss_info_mb': rss_info,
+    }
+
+
+def summarize(runs):
+    return {
+        metric: round(statistics.median(run[metric] for run in runs), 1)
+        for metric in runs[0]
+        if all(isinstance(run[metric], (int, float)) for run in runs)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', default=','.join(SERVERS), help='comma-separated subset of: ' + ', '.join(SERVERS))
+    parser.add_argument('--runs', type=int, default=3, help='server starts per worker model; the median is reported')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the server to become ready')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for the server')
+    parser.add_argument('--label', default='startup', help='name of this run in the results file')
+    parser.add_argument('--output', help=f'results file (default: {os.path.relpath(RESULTS_DIR, ROOT)}/<label>-<time>.json)')
+    args = parser.parse_args()
+
+    servers = [name.strip() for name in args.servers.split(',') if name.strip()]
+    unknown = set(servers) - set(SERVERS)
+    if unknown:
+        parser.error(f'unknown servers: {", ".join(sorted(unknown))}')
+
+    env = dict(os.environ, PYTHONPATH=ROOT, DEBUG='false')
+    env.setdefault('WEB_WORKERS', '2')
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+
+    cdn = FakeCDN(1024 * 1024, 0, 0)
+    cdn.start()
+    results = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'servers': {},
+    }
+    try:
+        for kind in servers:
+            runs = [measure(kind, env, cdn, args.timeout) for _ in range(args.runs)]
+            results['servers'][kind] = {'median': summarize(runs), 'runs': runs}
+    finally:
+        cdn.stop()
+
+    print(f'{"server":<10} {"listen ms":>10} {"ready ms":>10} {"RSS MiB":>9} {"1st info ms":>12} {"RSS MiB":>9}')
+    for kind, result in results['servers'].items():
+        median = result['median']
+
+        def cell(metric, width):
+            value = median.get(metric)
+            return f'{value:>{width}.1f}' if value is not None else f'{"-":>{width}}'
+        print(f'{kind:<10} {cell("listen_ms", 10)} {cell("ready_ms", 10)} {cell("rss_ready_mb", 9)} '
+              f'{cell("first_info_ms", 12)} {cell("rss_info_mb", 9)}')
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{args.label}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {os.path.relpath(output)}')
+
+
+if __name__ == '__main__':
+    main()
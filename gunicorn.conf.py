@@ -0,0 +1,28 @@
+# Gunicorn configuration for production deployments:
+#   gunicorn -c gunicorn.conf.py web_server:app
+# Workers share progress, caches and download deduplication through STATE_BACKEND.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+
+# 每个工作进程有自己的下载队列和提取池, 线程用于处理进度推送等长连接
+workers = int(os.environ.get('WEB_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 16))
+
+# 进度推送连接会长时间保持, 不能按请求时长杀掉工作进程
+timeout = int(os.environ.get('WEB_TIMEOUT', 0))
+graceful_timeout = 30
+keepalive = 5
+
+# 后台线程在首次使用时启动, 不能在 fork 之前创建
+preload_app = False
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
+
+def post_worker_init(worker):
+    # 工作进程加载应用后在后台预热 yt-dlp, 不推迟开始处理请求; /readyz 报告预热是否完成
+    from web_server import warmup
+    warmup.start()
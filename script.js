@@ -1,6 +1,8 @@
 // 全局变量
-let activeDownloadId = null;
-let downloadProgressInterval = null;
+// 正在跟踪进度的下载任务: downloadId -> { button, progressContainer, interval }
+const activeDownloads = new Map();
+// 所有任务共用的进度推送连接 (Server-Sent Events)
+let progressEventSource = null;
 let currentLang = localStorage.getItem('language') || 'zh';
 
 // 开始下载函数
@@ -24,9 +26,6 @@ async function startDownload(event) {
             throw new Error(data.error);
         }
         
-        // 保存下载ID
-        activeDownloadId = data.download_id;
-        
         // 创建一个包含下载链接的容器元素
         const downloadContainer = document.createElement('div');
         downloadContainer.className = 'download-container';
@@ -57,12 +56,8 @@ async function startDownload(event) {
         // 将新容器添加到格式项中
         formatItem.appendChild(downloadContainer);
         
-        // 开始轮询下载进度
-        if (downloadProgressInterval) {
-            clearInterval(downloadProgressInterval);
-        }
-        
-        downloadProgressInterval = setInterval(() => checkDownloadProgress(activeDownloadId, button, progressContainer), 1000);
+        // 开始跟踪下载进度
+        watchDownload(data.download_id, button, progressContainer);
         
     } catch (error) {
         console.error('Error starting download:', error);
@@ -72,8 +67,84 @@ async function startDownload(event) {
     }
 }
 
+// 开始跟踪下载进度: 优先使用推送, 浏览器不支持时使用轮询
+function watchDownload(downloadId, button, progressContainer) {
+    activeDownloads.set(downloadId, { button, progressContainer, interval: null });
+    
+    if (window.EventSource) {
+        openProgressStream();
+    } else {
+        startProgressPolling(downloadId);
+    }
+}
+
+// 停止跟踪下载进度
+function stopWatchingDownload(downloadId) {
+    const download = activeDownloads.get(downloadId);
+    if (!download) return;
+    
+    if (download.interval) {
+        clearInterval(download.interval);
+    }
+    activeDownloads.delete(downloadId);
+    
+    // 用剩下的任务重新建立推送连接
+    if (progressEventSource) {
+        openProgressStream();
+    }
+}
+
+// 为所有使用推送的任务建立一个共用的推送连接
+function openProgressStream() {
+    if (progressEventSource) {
+        progressEventSource.close();
+        progressEventSource = null;
+    }
+    
+    const ids = Array.from(activeDownloads.keys()).filter(id => !activeDownloads.get(id).interval);
+    if (ids.length === 0) return;
+    
+    const eventSource = new EventSource(`/progress_stream?ids=${encodeURIComponent(ids.join(','))}`);
+    progressEventSource = eventSource;
+    
+    eventSource.addEventListener('progress', (event) => {
+        const data = JSON.parse(event.data);
+        const download = activeDownloads.get(data.download_id);
+        if (!download) return;
+        
+        if (updateDownloadProgress(data.download_id, data, download.button, download.progressContainer)) {
+            stopWatchingDownload(data.download_id);
+        }
+    });
+    
+    eventSource.onerror = () => {
+        // 所有任务都结束后服务器会关闭连接, 这是正常情况
+        if (progressEventSource !== eventSource) return;
+        eventSource.close();
+        progressEventSource = null;
+        
+        // 推送不可用, 回退到轮询
+        activeDownloads.forEach((download, downloadId) => {
+            if (!download.interval) {
+                startProgressPolling(downloadId);
+            }
+        });
+    };
+}
+
+// 每秒轮询一次下载进度
+function startProgressPolling(downloadId) {
+    const download = activeDownloads.get(downloadId);
+    if (!download || download.interval) return;
+    
+    download.interval = setInterval(() => checkDownloadProgress(downloadId), 1000);
+}
+
 // 检查下载进度
-async function checkDownloadProgress(downloadId, button, progressContainer) {
+async function checkDownloadProgress(downloadId) {
+    const download = activeDownloads.get(downloadId);
+    if (!download) return;
+    
     try {
         const response = await fetch(`/download_progress/${downloadId}`);
         const data = await response.json();
@@ -82,78 +153,97 @@ async function checkDownloadProgress(downloadId, button, progressContainer) {
             throw new Error(data.error || 'Failed to fetch progress');
         }
         
-        // 更新进度条
-        const progressBar = progressContainer.querySelector('.download-progress');
-        const progressPercent = progressContainer.querySelector('.download-progress-percent');
-        const progressStatus = progressContainer.querySelector('.download-progress-status');
-        
-        // 设置进度条宽度
-        progressBar.style.width = `${data.progress}%`;
-        progressPercent.textContent = `${data.progress}%`;
-        
-        // 更新状态文本
-        let statusText = '';
-        switch (data.status) {
-            case 'waiting':
-                statusText = translations[currentLang].waiting;
-                break;
-            case 'downloading':
-                // 显示下载速度和文件大小
-                // 处理速度显示
-                let speed = data.speed;
-                if (typeof speed === 'string' && speed) {
-                    // 已经是格式化的字符串，直接使用
-                    speed = speed;
-                } else {
-                    // 尝试格式化数字
-                    speed = formatSpeed(data.downloaded_bytes / 10); // 简单估算
-                }
-                
-                // 处理文件大小显示
-                const size = formatSize(data.total_bytes);
-                statusText = `${translations[currentLang].downloading}: ${speed} - ${size}`;
-                break;
-            case 'processing':
-                statusText = translations[currentLang].processing;
-                break;
-            case 'completed':
-                statusText = translations[currentLang].completed;
-                clearInterval(downloadProgressInterval);
-                
-                // 下载完成后，启动实际的文件下载
-                setTimeout(() => {
-                    window.location.href = `/download_video/${downloadId}`;
-                    
-                    // 重置按钮状态
-                    button.disabled = false;
-                    button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
-                    
-                    // 可选：在下载开始后移除进度条
-                    setTimeout(() => {
-                        progressContainer.remove();
-                    }, 3000);
-                }, 1000);
-                break;
-            case 'error':
-                statusText = `${translations[currentLang].error}: ${data.error}`;
-                clearInterval(downloadProgressInterval);
-                
-                // 重置按钮状态
-                button.disabled = false;
-                button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
-                break;
+        if (updateDownloadProgress(downloadId, data, download.button, download.progressContainer)) {
+            stopWatchingDownload(downloadId);
         }
         
-        progressStatus.textContent = statusText;
-        
     } catch (error) {
         console.error('Error checking download progress:', error);
-        clearInterval(downloadProgressInterval);
+        stopWatchingDownload(downloadId);
         
         // 重置按钮状态
-        button.disabled = false;
-        button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
+        download.button.disabled = false;
+        download.button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
+    }
+}
+
+// 更新进度条和状态文本, 任务结束时返回 true
+function updateDownloadProgress(downloadId, data, button, progressContainer) {
+    // 更新进度条
+    const progressBar = progressContainer.querySelector('.download-progress');
+    const progressPercent = progressContainer.querySelector('.download-progress-percent');
+    const progressStatus = progressContainer.querySelector('.download-progress-status');
+    let finished = false;
+    
+    // 设置进度条宽度
+    progressBar.style.width = `${data.progress}%`;
+    progressPercent.textContent = `${data.progress}%`;
+    
+    // 更新状态文本
+    let statusText = '';
+    switch (data.status) {
+        case 'queued':
+            statusText = translations[currentLang].queued;
+            if (data.queue_position) {
+                statusText += ` (${translations[currentLang].queuePosition.replace('{position}', data.queue_position)})`;
+            }
+            break;
+        case 'waiting':
+            statusText = translations[currentLang].waiting;
+            break;
+        case 'downloading':
+            // 显示下载速度和文件大小
+            // 处理速度显示
+            let speed = data.speed;
+            if (typeof speed === 'string' && speed) {
+                // 已经是格式化的字符串，直接使用
+                speed = speed;
+            } else {
+                // 尝试格式化数字
+                speed = formatSpeed(data.downloaded_bytes / 10); // 简单估算
+            }
+            
+            // 处理文件大小显示
+            const size = formatSize(data.total_bytes);
+            statusText = `${translations[currentLang].downloading}: ${speed} - ${size}`;
+            break;
+        case 'processing':
+            statusText = translations[currentLang].processing;
+            break;
+        case 'completed':
+            statusText = translations[currentLang].completed;
+            finished = true;
+            
+            // 下载完成后，启动实际的文件下载
+            setTimeout(() => {
+                window.location.href = `/download_video/${downloadId}`;
+                
+                // 重置按钮状态
+                button.disabled = false;
+                button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
+                
+                // 可选：在下载开始后移除进度条
+                setTimeout(() => {
+                    progressContainer.remove();
+                }, 3000);
+            }, 1000);
+            break;
+        case 'cancelled':
+        case 'expired':
+        case 'error':
+            statusText = data.status === 'cancelled'
+                ? translations[currentLang].cancelled
+                : `${translations[currentLang].error}: ${data.error}`;
+            finished = true;
+            
+            // 重置按钮状态
+            button.disabled = false;
+            button.innerHTML = `<i class="fas fa-download"></i> ${translations[currentLang].downloadButton}`;
+            break;
     }
+    
+    progressStatus.textContent = statusText;
+    return finished;
 }
 
 // 格式化文件大小
@@ -624,7 +714,12 @@ document.addEventListener('DOMContentLoaded', () => {
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ url: url })
+            // 只请求界面用到的字段, 并合并等价格式, 减小响应体积
+            body: JSON.stringify({
+                url: url,
+                fields: 'title,thumbnail,duration,formats.format_id,formats.ext,formats.vcodec,formats.acodec,formats.resolution,formats.filesize,formats.filesize_approx,formats.abr',
+                dedupe: true
+            })
         };
 
         // 重置 UI 为新请求
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# web_server 在导入时读取配置, 测试使用临时下载目录、进程内状态后端, 不恢复任务日志
+os.environ.setdefault('DOWNLOADS_DIR', tempfile.mkdtemp(prefix='ytdlp-webui-tests-'))
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('JOB_JOURNAL', '')
+os.environ.setdefault('LOG_LEVEL', 'warning')
@@ -0,0 +1,93 @@
+"""
+下载带宽分配
+"""
+import math
+import types
+
+import pytest
+
+import web_server
+from web_server import BandwidthShaper, max_min_shares, prepare_streaming_download
+
+
+def test_equal_demands_split_capacity_evenly():
+    shares = max_min_shares(300, {'a': math.inf, 'b': math.inf, 'c': math.inf})
+    assert shares == {'a': 100, 'b': 100, 'c': 100}
+
+
+def test_demand_below_fair_share_is_met_and_rest_is_shared():
+    # a 只需要 40, 省下的 60 由 b 和 c 平分
+    shares = max_min_shares(300, {'a': 40, 'b': math.inf, 'c': math.inf})
+    assert shares == {'a': 40, 'b': 130, 'c': 130}
+
+
+def test_small_demands_cascade():
+    # 先满足 a, 剩余的平均份额仍然高于 b 的需求, 再满足 b, 最后 c 得到全部剩余
+    shares = max_min_shares(300, {'a': 10, 'b': 120, 'c': math.inf})
+    assert shares == {'a': 10, 'b': 120, 'c': 170}
+
+
+def test_demand_just_above_fair_share_is_capped():
+    shares = max_min_shares(300, {'a': 40, 'b': 140, 'c': 200})
+    assert shares['a'] == 40
+    assert shares['b'] == shares['c'] == 130
+    assert sum(shares.values()) == 300
+
+
+def test_all_demands_below_capacity_are_met():
+    shares = max_min_shares(1000, {'a': 100, 'b': 200})
+    assert shares == {'a': 100, 'b': 200}
+
+
+def test_unlimited_capacity_returns_demands():
+    assert max_min_shares(math.inf, {'a': 5, 'b': math.inf}) == {'a': 5, 'b': math.inf}
+    assert max_min_shares(100, {}) == {}
+
+
+def test_shaper_gives_unused_share_of_slow_flow_to_others():
+    shaper = BandwidthShaper('download', 300_000, 0, 1)
+    slow, fast_1, fast_2 = shaper.open(), shaper.open(), shaper.open()
+    assert slow.rate == pytest.approx(100_000)
+    # 上一个统计周期里 slow 只用到了 40000 字节/秒
+    slow.demand = 40_000
+    with shaper._lock:
+        shaper._rebalance(slow._window_start)
+    assert slow.rate == pytest.approx(40_000)
+    assert fast_1.rate == fast_2.rate == pytest.approx(130_000)
+
+    slow.close()
+    assert fast_1.rate == fast_2.rate == pytest.approx(150_000)
+
+
+def test_client_limit_caps_one_clients_flows():
+    shaper = BandwidthShaper('download', 300_000, 100_000, 1)
+    a_1, a_2, b, c = shaper.open('a'), shaper.open('a'), shaper.open('b'), shaper.open('c')
+    # 平均份额是 75000, 但客户端 a 合计不能超过 100000, 省下的带宽分给 b 和 c
+    assert a_1.rate == a_2.rate == pytest.approx(50_000)
+    assert b.rate == c.rate == pytest.approx(100_000)
+
+
+def merged_info():
+    return {
+        'ext': 'mp4',
+        'protocol': 'https+https',
+        'requested_formats': [
+            {'url': 'https://example.com/video.mp4', 'protocol': 'https', 'ext': 'mp4'},
+            {'url': 'https://example.com/audio.m4a', 'protocol': 'https', 'ext': 'm4a'},
+        ],
+    }
+
+
+def test_limited_streaming_keeps_merged_formats_on_native_downloader(monkeypatch):
+    # ffmpeg 下载时没有进度回调, 带宽分配无法限制它
+    monkeypatch.setattr(web_server, 'download_bandwidth', BandwidthShaper('download', 1_000_000, 0, 1))
+    ydl = types.SimpleNamespace(params={})
+    assert prepare_streaming_download(ydl, merged_info(), rewrites_output=False) is False
+    assert 'external_downloader' not in ydl.params
+
+
+def test_client_limit_also_keeps_native_downloader(monkeypatch):
+    monkeypatch.setattr(web_server, 'download_bandwidth', BandwidthShaper('download', 0, 500_000, 1))
+    ydl = types.SimpleNamespace(params={})
+    assert prepare_streaming_download(ydl, merged_info(), rewrites_output=False) is False
+    assert 'external_downloader' not in ydl.params
@@ -0,0 +1,150 @@
+"""
+/download_video 的 Range/If-Range、ETag 条件请求, 以及 FileRange
+"""
+import io
+import os
+import uuid
+
+import pytest
+
+import web_server
+from web_server import BandwidthShaper, FileRange
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def served(tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(CONTENT)
+    download_id = str(uuid.uuid4())
+    web_server.progress_registry.create(
+        download_id, status='completed', filename_on_server=str(path),
+        suggested_filename='video.mp4', mimetype='video/mp4'
+    )
+    client = web_server.app.test_client()
+
+    def get(**headers):
+        response = client.get(f'/download_video/{download_id}', headers=headers)
+        body = response.get_data()
+        response.close()
+        return response, body
+
+    yield get, str(path)
+    web_server.progress_registry.remove(download_id)
+
+
+def test_full_download_has_validators(served):
+    get, path = served
+    response, body = get()
+    assert response.status_code == 200
+    assert body == CONTENT
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Length'] == str(len(CONTENT))
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+    # 发送结束后释放文件引用
+    assert not web_server.artifact_store.in_use(path)
+
+
+def test_single_range(served):
+    get, _ = served
+    response, body = get(Range='bytes=100-199')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+    assert body == CONTENT[100:200]
+
+
+def test_open_ended_range(served):
+    get, _ = served
+    response, body = get(Range='bytes=10000-')
+    assert response.status_code == 206
+    assert body == CONTENT[10000:]
+
+
+def test_suffix_range(served):
+    get, _ = served
+    response, body = get(Range='bytes=-10')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {len(CONTENT) - 10}-{len(CONTENT) - 1}/{len(CONTENT)}'
+    assert body == CONTENT[-10:]
+
+
+@pytest.mark.parametrize('header', ['bytes=0-9,20-29', 'bytes=0-9,5-19', 'bytes=abc'])
+def test_multi_range_and_malformed_range_send_whole_file(served, header):
+    get, _ = served
+    response, body = get(Range=header)
+    assert response.status_code == 200
+    assert 'Content-Range' not in response.headers
+    assert body == CONTENT
+
+
+def test_unsatisfiable_range(served):
+    get, path = served
+    response, body = get(Range=f'bytes={len(CONTENT)}-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+    assert not web_server.artifact_store.in_use(path)
+
+
+def test_if_range_with_current_etag(served):
+    get, _ = served
+    etag = get()[0].headers['ETag']
+    response, body = get(Range='bytes=0-99', **{'If-Range': etag})
+    assert response.status_code == 206
+    assert body == CONTENT[:100]
+
+
+def test_stale_if_range_sends_whole_file(served):
+    get, path = served
+    old_etag = get()[0].headers['ETag']
+    # 文件被替换(同名重新下载), 旧的 ETag 失效
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    response, body = get(Range='bytes=0-99', **{'If-Range': old_etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != old_etag
+    assert body == CONTENT
+
+
+def test_stale_if_range_date_sends_whole_file(served):
+    get, _ = served
+    response, body = get(Range='bytes=0-99', **{'If-Range': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    assert response.status_code == 200
+    assert body == CONTENT
+
+
+def test_if_none_match_returns_304(served):
+    get, path = served
+    etag = get()[0].headers['ETag']
+    response, body = get(**{'If-None-Match': etag})
+    assert response.status_code == 304
+    assert body == b''
+    assert not web_server.artifact_store.in_use(path)
+
+
+def test_file_range_reads_only_its_span(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(CONTENT)
+    closed = []
+    file = FileRange(str(path), 1000, 300, on_close=lambda: closed.append(True))
+    assert file.read(200) == CONTENT[1000:1200]
+    assert file.read() == CONTENT[1200:1300]
+    assert file.read(10) == b''
+    file.close()
+    file.close()
+    assert closed == [True]
+
+
+def test_file_range_hides_fileno_when_bandwidth_is_limited(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(CONTENT)
+    unlimited = FileRange(str(path), 0, 10, bandwidth=BandwidthShaper('serve', 0, 0, 1).open())
+    limited = FileRange(str(path), 0, 10, bandwidth=BandwidthShaper('serve', 10**9, 0, 1).open())
+    try:
+        assert unlimited.fileno() >= 0
+        # 限速时让服务器逐块调用 read(), 不能用 sendfile 绕过限速
+        with pytest.raises(io.UnsupportedOperation):
+            limited.fileno()
+    finally:
+        unlimited.close()
+        limited.close()
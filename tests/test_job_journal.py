@@ -0,0 +1,163 @@
+"""
+JobJournal: 接管已退出进程的任务, 包括恢复过程中心跳过期的情况
+"""
+import threading
+import time
+
+import pytest
+
+import web_server
+from web_server import DownloadQueueFull, JobJournal
+
+
+def params(url):
+    return {
+        'url': url, 'format_id': '18', 'audio_only': False, 'audio_format_pref': 'best',
+        'video_quality_pref': 'best', 'embed_subs': False, 'stream': False, 'priority': 'normal', 'client': None,
+    }
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite3')
+
+
+def expire_heartbeat(journal):
+    # 模拟进程停止写入心跳超过三个周期
+    with journal._lock:
+        journal._db.execute('UPDATE owners SET heartbeat_at = 0 WHERE owner = ?', (journal.owner,))
+        journal._db.commit()
+
+
+def test_claims_unfinished_jobs_of_dead_process(journal_path):
+    old = JobJournal(journal_path, 3600, 10)
+    old._beat()
+    old.add('queued', params('https://example.com/1'))
+    old.add('started', params('https://example.com/2'))
+    old.record('started', 'started')
+    old.add('done', params('https://example.com/3'))
+    old.record('done', 'completed', {'filename_on_server': '/tmp/x.mp4'})
+    expire_heartbeat(old)
+
+    new = JobJournal(journal_path, 3600, 10)
+    claimed = new.claim_interrupted()
+    assert [(download_id, status) for download_id, _, status in claimed] == [('queued', 'queued'), ('started', 'started')]
+    assert claimed[0][1] == params('https://example.com/1')
+
+    event = new.history('started')[-1]
+    assert event['status'] == 'recovered'
+    assert event['owner'] == new.owner
+    assert event['data'] == {'previous_owner': old.owner}
+    # 已经接管的任务不会被再次接管
+    assert new.claim_interrupted() == []
+
+
+def test_live_process_keeps_its_jobs(journal_path):
+    owner = JobJournal(journal_path, 3600, 10)
+    owner._beat()
+    owner.add('running', params('https://example.com/1'))
+    assert JobJournal(journal_path, 3600, 10).claim_interrupted() == []
+
+
+def test_only_one_process_claims_each_job(journal_path):
+    dead = JobJournal(journal_path, 3600, 10)
+    for i in range(5):
+        dead.add(f'job-{i}', params(f'https://example.com/{i}'))
+    first, second = JobJournal(journal_path, 3600, 10), JobJournal(journal_path, 3600, 10)
+    claimed = {}
+    barrier = threading.Barrier(2)
+
+    def claim(journal):
+        barrier.wait()
+        claimed[journal.owner] = [download_id for download_id, _, _ in journal.claim_interrupted()]
+
+    threads = [threading.Thread(target=claim, args=(journal,)) for journal in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    ids = claimed[first.owner] + claimed[second.owner]
+    assert sorted(ids) == [f'job-{i}' for i in range(5)]
+
+
+def test_claim_refreshes_own_heartbeat(journal_path):
+    # 接管的任务立即归属于一个有心跳的进程, 其他进程不会在下一次心跳之前再次接管
+    JobJournal(journal_path, 3600, 10).add('job', params('https://example.com/1'))
+    recovering = JobJournal(journal_path, 3600, 10)
+    assert [download_id for download_id, _, _ in recovering.claim_interrupted()] == ['job']
+    assert JobJournal(journal_path, 3600, 10).claim_interrupted() == []
+
+
+def test_jobs_move_on_when_recovering_process_dies_mid_recovery(journal_path):
+    JobJournal(journal_path, 3600, 10).add('job', params('https://example.com/1'))
+    recovering = JobJournal(journal_path, 3600, 10)
+    assert [download_id for download_id, _, _ in recovering.claim_interrupted()] == ['job']
+    # 接管后、重新排队前进程退出, 心跳过期
+    expire_heartbeat(recovering)
+
+    third = JobJournal(journal_path, 3600, 10)
+    assert [download_id for download_id, _, _ in third.claim_interrupted()] == ['job']
+    recovered = [event['data']['previous_owner'] for event in third.history('job') if event['status'] == 'recovered']
+    assert recovered[-1] == recovering.owner
+
+
+def test_slow_recovery_does_not_let_heartbeat_expire(journal_path, monkeypatch):
+    dead = JobJournal(journal_path, 3600, 0.1)
+    for i in range(3):
+        dead.add(f'job-{i}', params(f'https://example.com/{i}'))
+
+    enqueued = []
+
+    def slow_enqueue(download_id=None, **kwargs):
+        # 每个任务重新排队都比三个心跳周期还慢
+        enqueued.append(download_id)
+        time.sleep(0.5)
+        return {'download_id': download_id, 'status': 'queued'}
+
+    monkeypatch.setattr(web_server, 'enqueue_download', slow_enqueue)
+    recovering = JobJournal(journal_path, 3600, 0.1)
+    recovering.start()
+    deadline = time.monotonic() + 5
+    while not enqueued and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert enqueued
+
+    # 恢复还在进行, 另一个进程不能把已经接管的任务再接管一次
+    other = JobJournal(journal_path, 3600, 0.1)
+    for _ in range(4):
+        time.sleep(0.2)
+        assert other.claim_interrupted() == []
+    deadline = time.monotonic() + 5
+    while len(enqueued) < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert enqueued == ['job-0', 'job-1', 'job-2']
+
+
+def test_recover_requeues_under_same_id_and_records_failures(journal_path, monkeypatch):
+    JobJournal(journal_path, 3600, 10).add('resumed', params('https://example.com/1'))
+    JobJournal(journal_path, 3600, 10).add('rejected', params('https://example.com/2'))
+
+    def enqueue(download_id=None, **kwargs):
+        if download_id == 'rejected':
+            raise DownloadQueueFull(30)
+        return {'download_id': download_id, 'status': 'queued'}
+
+    monkeypatch.setattr(web_server, 'enqueue_download', enqueue)
+    journal = JobJournal(journal_path, 3600, 10)
+    journal.recover()
+
+    assert journal.get('resumed')['status'] == 'queued'
+    assert journal.get('rejected')['status'] == 'error'
+    assert web_server.progress_registry.get_status('rejected') == 'error'
+    web_server.progress_registry.remove('rejected')
+
+
+def test_compact_drops_only_old_finished_jobs(journal_path):
+    journal = JobJournal(journal_path, 0, 10)
+    journal.add('finished', params('https://example.com/1'))
+    journal.record('finished', 'completed', {'filename_on_server': '/tmp/x.mp4'})
+    journal.add('active', params('https://example.com/2'))
+    time.sleep(0.01)
+    journal.compact()
+    assert journal.get('finished') is None and journal.history('finished') == []
+    assert journal.get('active')['status'] == 'queued'
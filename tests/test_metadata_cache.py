@@ -0,0 +1,103 @@
+"""
+MetadataCache.get_or_load: 合并并发请求时等待者的取消、超时和异常
+"""
+import threading
+import time
+
+import pytest
+
+import web_server
+from web_server import ExtractionCancelled, MetadataCache
+
+
+def start_leader(cache, key, release, result=None, error=None):
+    # 在后台线程中发起提取, 直到 release 被设置才返回结果或抛出异常
+    started = threading.Event()
+    outcome = {}
+
+    def loader():
+        started.set()
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result, {'extract': 1.0}
+
+    def run():
+        try:
+            outcome['result'] = cache.get_or_load(key, loader)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(5)
+    return thread, outcome
+
+
+def test_follower_gets_leader_result():
+    cache = MetadataCache(600, 10, 1 << 20)
+    release = threading.Event()
+    thread, _ = start_leader(cache, 'k', release, result={'title': 't'})
+    threading.Timer(0.1, release.set).start()
+    payload, timings, status = cache.get_or_load('k', lambda: pytest.fail('loaded twice'))
+    thread.join(5)
+    assert payload == {'title': 't'} and status == 'coalesced' and timings['mode'] == 'coalesced'
+
+
+def test_follower_gives_up_when_cancelled():
+    cache = MetadataCache(600, 10, 1 << 20)
+    release = threading.Event()
+    thread, outcome = start_leader(cache, 'k', release, result={'title': 't'})
+    cancel_event = threading.Event()
+    threading.Timer(0.1, cancel_event.set).start()
+    started = time.monotonic()
+    with pytest.raises(ExtractionCancelled):
+        cache.get_or_load('k', lambda: pytest.fail('loaded twice'), cancel_event=cancel_event)
+    assert time.monotonic() - started < 2
+    release.set()
+    thread.join(5)
+    assert outcome['result'][2] == 'miss'
+
+
+def test_follower_gives_up_at_deadline():
+    cache = MetadataCache(600, 10, 1 << 20)
+    release = threading.Event()
+    thread, _ = start_leader(cache, 'k', release, result={'title': 't'})
+    started = time.monotonic()
+    with pytest.raises(ExtractionCancelled):
+        cache.get_or_load('k', lambda: pytest.fail('loaded twice'), deadline=started + 0.3)
+    assert 0.3 <= time.monotonic() - started < 2
+    release.set()
+    thread.join(5)
+
+
+def test_each_follower_raises_its_own_exception():
+    cache = MetadataCache(600, 10, 1 << 20)
+    release = threading.Event()
+    original = web_server.yt_dlp.utils.DownloadError('ERROR: Private video')
+    thread, outcome = start_leader(cache, 'k', release, error=original)
+
+    errors = []
+
+    def follow():
+        try:
+            cache.get_or_load('k', lambda: pytest.fail('loaded twice'))
+        except Exception as e:
+            errors.append(e)
+
+    followers = [threading.Thread(target=follow) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.2)
+    release.set()
+    for follower in followers:
+        follower.join(5)
+    thread.join(5)
+
+    assert outcome['error'] is original
+    assert len(errors) == 3
+    assert len({id(error) for error in errors}) == 3
+    for error in errors:
+        assert error is not original
+        assert type(error) is type(original) and str(error) == str(original)
+        assert error.__cause__ is original
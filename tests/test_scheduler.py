@@ -0,0 +1,140 @@
+"""
+DownloadScheduler: 出队顺序、站点并发限制、预取名额、后处理交接和队列满时的 Retry-After
+"""
+import threading
+
+import pytest
+
+import web_server
+from web_server import DownloadJob, DownloadQueueFull, DownloadScheduler
+
+
+def make_job(download_id, host='example.com', priority=1, prefetch=False, target=None):
+    job = DownloadJob(download_id, host, priority, target or (lambda cancel_event=None: None), ())
+    job.prefetch = prefetch
+    return job
+
+
+def enqueue(scheduler, *jobs):
+    # 只放入队列, 不启动工作线程, 用来单独检查 _take_next
+    for job in jobs:
+        scheduler._seq += 1
+        job.seq = scheduler._seq
+        scheduler._queue.append(job)
+
+
+def run(scheduler, job):
+    # 模拟工作线程开始运行任务
+    scheduler._running[job.download_id] = job
+    scheduler._host_running[job.host] = scheduler._host_running.get(job.host, 0) + 1
+
+
+def blocking_target(started, release):
+    def target(cancel_event=None):
+        started.set()
+        release.wait(5)
+    return target
+
+
+def test_take_next_orders_by_priority_then_submission():
+    scheduler = DownloadScheduler(2, 10, 0)
+    enqueue(scheduler, make_job('low', priority=2), make_job('normal-1'), make_job('high', priority=0), make_job('normal-2'))
+    taken = [scheduler._take_next().download_id for _ in range(4)]
+    assert taken == ['high', 'normal-1', 'normal-2', 'low']
+    assert scheduler._take_next() is None
+
+
+def test_take_next_skips_hosts_at_their_limit():
+    scheduler = DownloadScheduler(3, 10, 1)
+    run(scheduler, make_job('running', host='a'))
+    enqueue(scheduler, make_job('same-host', host='a', priority=0), make_job('other-host', host='b', priority=2))
+
+    assert scheduler._take_next().download_id == 'other-host'
+    assert scheduler._take_next() is None
+    assert [job.download_id for job in scheduler._queue] == ['same-host']
+
+    scheduler._running.pop('running')
+    scheduler._release_host('a')
+    assert scheduler._take_next().download_id == 'same-host'
+
+
+def test_prefetch_waits_behind_blocked_user_download():
+    scheduler = DownloadScheduler(3, 10, 1)
+    run(scheduler, make_job('running', host='a'))
+    enqueue(scheduler, make_job('user', host='a'), make_job('prefetch', host='b', priority=2, prefetch=True))
+    # 用户的任务只是在等站点名额, 预取也不能先占用工作线程
+    assert scheduler._take_next() is None
+
+
+def test_prefetch_never_takes_the_last_worker():
+    scheduler = DownloadScheduler(2, 10, 0)
+    assert scheduler.prefetch_slots == 1
+    run(scheduler, make_job('prefetch-1', prefetch=True))
+    enqueue(scheduler, make_job('prefetch-2', prefetch=True))
+    assert scheduler._take_next() is None
+    assert not scheduler.prefetch_available()
+
+    enqueue(scheduler, make_job('user'))
+    assert scheduler._take_next().download_id == 'user'
+
+
+def test_handoff_frees_worker_and_host_for_queued_download():
+    scheduler = DownloadScheduler(1, 10, 1)
+    downloaded, finish_postprocess = threading.Event(), threading.Event()
+    second_started, release_second = threading.Event(), threading.Event()
+
+    def first(cancel_event=None):
+        # 下载完成, 转入后处理
+        downloaded.set()
+        assert scheduler.handoff('first')
+        finish_postprocess.wait(5)
+
+    try:
+        scheduler.submit(make_job('first', target=first))
+        assert downloaded.wait(5)
+        scheduler.submit(make_job('second', target=blocking_target(second_started, release_second)))
+        # 第一个任务还在后处理, 同一站点的第二个任务已经开始下载
+        assert second_started.wait(5)
+        stats = scheduler.stats()
+        assert stats['running'] == 2 and stats['postprocessing'] == 1
+        assert stats['running_per_host'] == {'example.com': 1}
+        # 后处理的任务不能超过工作线程数
+        assert not scheduler.handoff('second')
+    finally:
+        finish_postprocess.set()
+        release_second.set()
+
+
+def test_host_limit_fills_queue_and_reports_retry_after():
+    scheduler = DownloadScheduler(1, 1, 1)
+    started, release = threading.Event(), threading.Event()
+    try:
+        scheduler.submit(make_job('running', target=blocking_target(started, release)))
+        assert started.wait(5)
+        scheduler.submit(make_job('queued'))
+        with pytest.raises(DownloadQueueFull) as excinfo:
+            scheduler.submit(make_job('rejected'))
+        # 一个工作线程、一个排队任务: 大约两个任务的平均耗时
+        assert excinfo.value.retry_after == 2 * 30
+        assert scheduler.queue_position('queued') == 1
+    finally:
+        release.set()
+
+
+def test_start_download_returns_429_with_retry_after(monkeypatch):
+    scheduler = DownloadScheduler(1, 1, 1)
+    monkeypatch.setattr(web_server, 'download_scheduler', scheduler)
+    started, release = threading.Event(), threading.Event()
+    try:
+        scheduler.submit(make_job('running', target=blocking_target(started, release)))
+        assert started.wait(5)
+        scheduler.submit(make_job('queued'))
+
+        response = web_server.app.test_client().get(
+            '/start_download', query_string={'url': 'https://example.com/video.mp4', 'format_id': '18'}
+        )
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '60'
+        assert response.get_json()['retry_after'] == 60
+    finally:
+        release.set()
@@ -0,0 +1,110 @@
+"""
+两个应用实例(相当于两个工作进程)连接同一个 Redis 时能看到彼此写入的状态
+"""
+import importlib.util
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip('fakeredis')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(name):
+    # 每次加载得到一份独立的模块, 有自己的缓存、进度登记表和调度器
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, 'web_server.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def apps(tmp_path_factory):
+    patch = pytest.MonkeyPatch()
+    patch.setenv('STATE_BACKEND', 'fakeredis')
+    patch.setenv('STATE_KEY_PREFIX', f"test-{uuid.uuid4().hex[:8]}")
+    patch.setenv('DOWNLOADS_DIR', str(tmp_path_factory.mktemp('downloads')))
+    patch.setenv('METADATA_CACHE_TTL', '600')
+    try:
+        yield load_app('web_server_a'), load_app('web_server_b')
+    finally:
+        patch.undo()
+
+
+def test_backends_share_one_server(apps):
+    a, b = apps
+    assert a.state_backend.shared and b.state_backend.shared
+    a.state_backend.set('test', 'key', {'value': 1})
+    assert b.state_backend.get('test', 'key') == {'value': 1}
+    b.state_backend.delete('test', 'key')
+    assert a.state_backend.get('test', 'key') is None
+
+
+def test_metadata_cache_is_shared(apps):
+    a, b = apps
+    payload = {'title': 'Shared', 'formats': [{'format_id': '18'}]}
+    loaded = a.metadata_cache.get_or_load('youtube:shared', lambda: (payload, {'extract': 1.0}))
+    assert loaded[2] == 'miss'
+
+    before = b.metadata_cache.stats()['shared_hits']
+    assert b.metadata_cache.get('youtube:shared') == payload
+    assert b.metadata_cache.stats()['shared_hits'] == before + 1
+
+    result = b.metadata_cache.get_or_load('youtube:shared', lambda: pytest.fail('loaded twice'))
+    assert result[0] == payload and result[2] == 'hit'
+
+
+def test_progress_is_visible_to_other_app(apps):
+    a, b = apps
+    a.progress_registry.create('remote-progress', status='downloading', progress=42.0, filename='video.mp4')
+
+    response = b.app.test_client().get('/download_progress/remote-progress')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'downloading'
+    assert response.get_json()['progress'] == 42.0
+
+    a.progress_registry.update('remote-progress', status='completed', progress=100)
+    assert b.app.test_client().get('/download_progress/remote-progress').get_json()['status'] == 'completed'
+
+
+def test_cancel_flag_reaches_owning_app(apps):
+    a, b = apps
+    a.progress_registry.create('remote-cancel', status='downloading')
+    assert not a.shared_cancel_requested('remote-cancel')
+
+    # b 没有这个任务, 只能通过共享取消标记通知 a
+    response = b.app.test_client().post('/cancel_download/remote-cancel')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'cancelling'
+    assert a.shared_cancel_requested('remote-cancel')
+
+    a.release_inflight_claim('unused-job-key', 'remote-cancel')
+    assert not b.shared_cancel_requested('remote-cancel')
+
+
+def test_artifact_index_and_leases_are_shared(apps, tmp_path):
+    a, b = apps
+    key = 'ab' * 32
+    src = tmp_path / 'video.mp4'
+    src.write_bytes(b'x' * 100)
+    path = a.artifact_store.add(key, str(src), 'video.mp4', 'video/mp4')
+
+    entry = b.artifact_store.lookup(key)
+    assert entry['path'] == path and entry['size'] == 100
+    assert key in dict(b.artifact_store.entries())
+
+    # a 正在发送文件时 b 不能删除它
+    a.artifact_store.acquire(path)
+    try:
+        assert b.artifact_store.in_use(path)
+        assert b.artifact_store.remove(key) is False
+        assert os.path.exists(path)
+    finally:
+        a.artifact_store.release(path)
+
+    assert not b.artifact_store.in_use(path)
+    assert b.artifact_store.remove(key) is True
+    assert not os.path.exists(path)
+    assert not a.artifact_store.contains(key)
@@ -43,6 +43,9 @@ const translations = {
     'starting': '开始下载...',
     'preparing': '准备中...',
     'waiting': '等待中...',
+    'queued': '排队中',
+    'queuePosition': '第 {position} 位',
+    'cancelled': '已取消',
     'downloading': '下载中:',
     'processing': '处理中...',
     'completed': '下载完成',
@@ -95,6 +98,9 @@ const translations = {
     'starting': 'Starting download...',
     'preparing': 'Preparing...',
     'waiting': 'Waiting...',
+    'queued': 'Queued',
+    'queuePosition': 'position {position}',
+    'cancelled': 'Cancelled',
     'downloading': 'Downloading:',
     'processing': 'Processing...',
     'completed': 'Download completed',
@@ -1,13 +1,38 @@
 import os
 import json # Used by app.logger.debug for pretty printing opts
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import sys
 from pathlib import Path
 import time
 import uuid
+import re
+import shutil
+import hashlib
+import importlib.util
+import queue
+import sqlite3
+import socket
+import subprocess
+import functools
+import contextlib
+import gzip
+import bisect
+import urllib.parse
+import unicodedata
+import mimetypes
+import math
+import io
+import copy
+import atexit
+import contextvars
+from collections import OrderedDict
+import threading
 from threading import Thread
 
+# 模块开始加载的时间, 用于报告工作进程的启动耗时
+IMPORT_STARTED = time.perf_counter()
+
 # Try to import dotenv for environment variable support
 try:
     from dotenv import load_dotenv
@@ -17,18 +42,845 @@ except ImportError:
     pass  # dotenv is optional
 
 try:
-    from flask import Flask, request, jsonify, send_from_directory
-    import yt_dlp
-    from yt_dlp import YoutubeDL
+    from flask import Flask, Response, request, jsonify, send_from_directory, has_request_context
+    from flask.logging import default_handler
+    from werkzeug.exceptions import RequestedRangeNotSatisfiable
+    from werkzeug.http import parse_range_header
+    from werkzeug.wsgi import wrap_file
+    if importlib.util.find_spec('yt_dlp') is None:
+        raise ImportError('yt_dlp')
 except ImportError:
     print("Flask and yt-dlp are required. Install them with: pip install Flask yt-dlp")
     sys.exit(1)
 
+# 与 yt-dlp 相同的 brotli 可选依赖, 没有安装时为 None
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+class LazyModule:
+    """
+    第一次访问属性时才导入的模块
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            # import_module 持有模块的导入锁, 多个线程同时触发时只导入一次
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+# 导入 yt-dlp 需要约 0.2 秒, 推迟到第一次使用或者服务器开始监听后的后台预热
+yt_dlp = LazyModule('yt_dlp')
+
+def parse_bytes(value):
+    """
+    解析 50M、2G 这样的字节数(1024 进制), 规则与 yt_dlp.utils.parse_bytes 相同, 无效时返回 None
+    """
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([kmgtpezy]?)', value.strip().lower())
+    if match is None:
+        return None
+    return round(float(match.group(1)) * 1024 ** 'bkmgtpezy'.index(match.group(2) or 'b'))
+
 # Create Flask app instance
 app = Flask(__name__) # Simplified as static files are served from root.
 
-# 存储下载进度的全局字典
-download_progress = {}
+# Get downloads directory from environment variable or use default
+DOWNLOADS_DIR = os.environ.get('DOWNLOADS_DIR', os.path.join(os.getcwd(), 'downloads'))
+# Convert relative path to absolute if needed
+if not os.path.isabs(DOWNLOADS_DIR):
+    DOWNLOADS_DIR = os.path.join(os.getcwd(), DOWNLOADS_DIR)
+# Ensure the downloads directory exists
+if not os.path.exists(DOWNLOADS_DIR):
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+
+# 共享状态后端: memory (仅当前进程)、sqlite:///路径 (同一台机器的多个进程) 或 redis://主机:端口/库 (多台机器)
+# 默认使用下载目录中的 sqlite 文件
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite')
+# Redis 键的前缀, 多个部署共用一个 Redis 时用来区分
+STATE_KEY_PREFIX = os.environ.get('STATE_KEY_PREFIX', 'ytdlp-webui')
+
+class MemoryStateBackend:
+    """
+    进程内的状态后端, 只适合单进程运行
+    """
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, namespace, key, now):
+        entry = self._data.get((namespace, key))
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[(namespace, key)]
+            return None
+        return entry
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._live(namespace, key, time.time())
+        return entry[0] if entry is not None else None
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[(namespace, key)] = (value, expires_at)
+
+    def add(self, namespace, key, value, ttl=None):
+        """
+        键不存在时写入并返回 True, 已存在时返回 False
+        """
+        now = time.time()
+        with self._lock:
+            if self._live(namespace, key, now) is not None:
+                return False
+            self._data[(namespace, key)] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.pop((namespace, key), None)
+
+    def scan(self, namespace):
+        now = time.time()
+        with self._lock:
+            return [
+                (key, value) for (ns, key), (value, expires_at) in list(self._data.items())
+                if ns == namespace and (expires_at is None or expires_at > now)
+            ]
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for item_key, (_, expires_at) in list(self._data.items()):
+                if expires_at is not None and expires_at <= now:
+                    del self._data[item_key]
+
+class SqliteStateBackend:
+    """
+    基于 sqlite (WAL 模式) 的状态后端, 同一台机器上的多个进程共享
+    """
+    shared = True
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?', (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, separators=(',', ':')), expires_at)
+            )
+            self._db.commit()
+
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM state WHERE namespace = ? AND key = ? AND expires_at IS NOT NULL AND expires_at <= ?',
+                (namespace, key, now)
+            )
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, separators=(',', ':')), now + ttl if ttl else None)
+            )
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._db.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+            self._db.commit()
+
+    def scan(self, namespace):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, value FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (namespace, time.time())
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def purge_expired(self):
+        with self._lock:
+            self._db.execute('DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+            self._db.commit()
+
+class RedisStateBackend:
+    """
+    基于 Redis 的状态后端, 多台机器共享; 任何兼容 redis-py 接口的客户端都可以使用
+    """
+    shared = True
+
+    def __init__(self, client, prefix):
+        self._client = client
+        self._prefix = prefix
+
+    def _key(self, namespace, key):
+        return f"{self._prefix}:{namespace}:{key}"
+
+    def get(self, namespace, key):
+        value = self._client.get(self._key(namespace, key))
+        return json.loads(value) if value is not None else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self._client.set(self._key(namespace, key), json.dumps(value, separators=(',', ':')), ex=int(ttl) if ttl else None)
+
+    def add(self, namespace, key, value, ttl=None):
+        return bool(self._client.set(
+            self._key(namespace, key), json.dumps(value, separators=(',', ':')), ex=int(ttl) if ttl else None, nx=True
+        ))
+
+    def delete(self, namespace, key):
+        self._client.delete(self._key(namespace, key))
+
+    def scan(self, namespace):
+        prefix = self._key(namespace, '')
+        keys = list(self._client.scan_iter(match=prefix + '*', count=500))
+        if not keys:
+            return []
+        items = []
+        for raw_key, value in zip(keys, self._client.mget(keys)):
+            if value is None:
+                continue
+            if isinstance(raw_key, bytes):
+                raw_key = raw_key.decode('utf-8')
+            items.append((raw_key[len(prefix):], json.loads(value)))
+        return items
+
+    def purge_expired(self):
+        # Redis 自己处理过期
+        pass
+
+def create_state_backend(spec):
+    """
+    根据 STATE_BACKEND 创建状态后端
+    """
+    if spec == 'memory':
+        return MemoryStateBackend()
+    if spec == 'sqlite':
+        return SqliteStateBackend(os.path.join(DOWNLOADS_DIR, '.state.sqlite3'))
+    if spec.startswith('sqlite:///'):
+        return SqliteStateBackend(spec[len('sqlite:///'):])
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            print("STATE_BACKEND=redis requires the redis package. Install it with: pip install redis")
+            sys.exit(1)
+        return RedisStateBackend(redis.Redis.from_url(spec), STATE_KEY_PREFIX)
+    if spec == 'fakeredis':
+        # 进程内的 Redis 替身, 用于在没有 Redis 服务器时测试 Redis 后端;
+        # 同一进程中创建的所有后端连接到同一个替身服务器, 和连接同一台 Redis 一样共享数据
+        import fakeredis
+        return RedisStateBackend(fakeredis.FakeRedis(host='ytdlp-webui-fakeredis'), STATE_KEY_PREFIX)
+    print(f"Unsupported STATE_BACKEND: {spec}")
+    sys.exit(1)
+
+state_backend = create_state_backend(STATE_BACKEND)
+
+# 指标快照发布到共享状态后端的间隔(秒), /metrics 汇总所有工作进程的快照
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', 15))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 65536 for n in range(0, 14, 2))
+
+class Metric:
+    """
+    一个带标签的指标, 值按标签值元组保存
+    """
+    def __init__(self, registry, kind, name, help_text, labels, buckets=None, collect=None, merge='sum'):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) if buckets else None
+        self.collect = collect
+        self.merge = merge
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry._touch()
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # 每个桶的计数 (不累计), 最后两项是总和与次数
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+        self.registry._touch()
+
+class MetricsRegistry:
+    """
+    进程内的 Prometheus 指标: 计数器、直方图和抓取时才计算的仪表值, 以文本格式输出
+
+    共享状态后端可用时, 每个进程定期把快照写入后端, /metrics 汇总所有工作进程
+    """
+    def __init__(self, backend=None, publish_interval=15):
+        self.backend = backend
+        self.publish_interval = publish_interval
+        self.instance = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._publisher = None
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Metric(self, 'counter', name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Metric(self, 'histogram', name, help_text, labels, buckets=buckets))
+
+    def gauge(self, name, help_text, labels, collect, merge='sum'):
+        """
+        collect() 返回 {标签值元组: 数值}; merge 决定多个进程的值如何合并 ('sum' 或 'max')
+        """
+        return self._add(Metric(self, 'gauge', name, help_text, labels, collect=collect, merge=merge))
+
+    def _touch(self):
+        # 第一次记录指标时才启动发布线程
+        if self._publisher is None and self.backend is not None:
+            with self._lock:
+                if self._publisher is not None:
+                    return
+                self._publisher = Thread(target=self._publish_loop, name='metrics-publisher')
+                self._publisher.daemon = True
+                self._publisher.start()
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(self.publish_interval)
+            try:
+                self.publish()
+            except Exception as e:
+                app.logger.warning("Failed to publish metrics: %s", e)
+
+    def snapshot(self):
+        result = {}
+        for metric in self._metrics:
+            if metric.kind == 'gauge':
+                try:
+                    values = metric.collect()
+                except Exception as e:
+                    app.logger.warning("Failed to collect metric %s: %s", metric.name, e)
+                    values = {}
+            else:
+                with self._lock:
+                    values = {key: list(value) if isinstance(value, list) else value for key, value in metric.values.items()}
+            result[metric.name] = {json.dumps(list(key)): value for key, value in values.items()}
+        return result
+
+    def publish(self):
+        self.backend.set('metrics', self.instance, self.snapshot(), max(60, self.publish_interval * 3))
+
+    def _merged(self):
+        if self.backend is None:
+            return [self.snapshot()]
+        self.publish()
+        return [snapshot for _, snapshot in self.backend.scan('metrics')]
+
+    def render(self):
+        """
+        返回 Prometheus 文本格式
+        """
+        snapshots = self._merged()
+        lines = []
+        for metric in self._metrics:
+            merged = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(metric.name, {}).items():
+                    if key not in merged:
+                        merged[key] = list(value) if isinstance(value, list) else value
+                    elif metric.kind == 'histogram':
+                        merged[key] = [a + b for a, b in zip(merged[key], value)]
+                    elif metric.merge == 'max':
+                        merged[key] = max(merged[key], value)
+                    else:
+                        merged[key] += value
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, value in sorted(merged.items()):
+                labels = list(zip(metric.labels, json.loads(key)))
+                if metric.kind != 'histogram':
+                    lines.append(f"{metric.name}{format_metric_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-2]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{metric.name}_bucket{format_metric_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{format_metric_labels(labels)} {value[-2]}")
+                lines.append(f"{metric.name}_count{format_metric_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+metrics = MetricsRegistry(state_backend if state_backend.shared else None, METRICS_PUBLISH_INTERVAL)
+
+EXTRACTION_SECONDS = metrics.histogram(
+    'ytdlp_extraction_seconds',
+    'Video info extraction time by stage (inprocess: queue, init, extract; subprocess: spawn, process, parse)',
+    ('mode', 'stage')
+)
+DOWNLOAD_SECONDS = metrics.histogram(
+    'ytdlp_download_job_seconds', 'Download job duration from start to finish, including postprocessing', ('status',), DURATION_BUCKETS
+)
+DOWNLOAD_THROUGHPUT = metrics.histogram(
+    'ytdlp_download_throughput_bytes_per_second', 'Transfer rate of each downloaded file', (), THROUGHPUT_BUCKETS
+)
+POSTPROCESS_SECONDS = metrics.histogram(
+    'ytdlp_postprocess_seconds', 'Postprocessor (ffmpeg merge, conversion, embedding) run time', ('postprocessor',), LATENCY_BUCKETS + DURATION_BUCKETS[5:]
+)
+DOWNLOAD_SETUP_SECONDS = metrics.histogram(
+    'ytdlp_download_setup_seconds', 'Time to set up the YoutubeDL instance of a download job'
+)
+POSTPROCESS_WAIT_SECONDS = metrics.histogram(
+    'ytdlp_postprocess_wait_seconds', 'Time postprocessors wait for a free ffmpeg slot', ('cost',), LATENCY_BUCKETS + DURATION_BUCKETS[5:]
+)
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'ytdlp_queue_wait_seconds', 'Time download jobs spend queued before a worker starts them', ('priority',), LATENCY_BUCKETS + DURATION_BUCKETS[5:]
+)
+CACHE_REQUESTS = metrics.counter(
+    'ytdlp_cache_requests_total', 'Lookups in the video info cache and the download artifact store', ('cache', 'result')
+)
+ERRORS = metrics.counter(
+    'ytdlp_errors_total', 'Failed video info lookups and downloads by error class', ('stage', 'error_class')
+)
+
+# 日志级别(debug, info, warning, error)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info').upper()
+# 日志格式: text 为一行文本; json 为每行一个 JSON 对象, 附带下载任务ID、请求路径、耗时等字段
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# 日志文件的位置, 为空时只输出到标准错误; 直接运行 web_server.py 时默认为 web_server.log
+LOG_FILE = os.environ.get('LOG_FILE', 'web_server.log' if __name__ == '__main__' else '')
+# 单个日志文件的大小上限(可以使用 10M 这样的后缀)和保留的旧文件数
+LOG_MAX_BYTES = parse_bytes(os.environ.get('LOG_MAX_BYTES', '10M')) or 0
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# 在后台线程中格式化和写入日志, 请求和下载线程只把记录放进队列; false 时在调用线程中同步写入
+LOG_ASYNC = os.environ.get('LOG_ASYNC', 'true').lower() == 'true'
+# 日志队列的长度, 写入跟不上时丢弃新的记录而不是阻塞调用线程
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+LOG_RECORDS_DROPPED = metrics.counter(
+    'ytdlp_log_records_dropped_total', 'Log records dropped because the asynchronous log queue was full'
+)
+
+# 当前线程正在执行的下载任务ID, 由调度器设置, 附加到任务期间写出的每条日志
+log_download_id = contextvars.ContextVar('log_download_id', default=None)
+
+# LogRecord 自带的属性; 其余属性是通过 extra 传入的结构化字段
+LOG_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class LogContextFilter(logging.Filter):
+    """
+    在写日志的线程中为记录补充下载任务ID和请求的方法、路径
+    """
+    def filter(self, record):
+        if getattr(record, 'download_id', None) is None:
+            download_id = log_download_id.get()
+            if download_id is not None:
+                record.download_id = download_id
+        if has_request_context() and not hasattr(record, 'path'):
+            record.method = request.method
+            record.path = request.path
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    每条记录输出为一行 JSON: 时间、级别、消息, 以及 download_id、ms、timings 等 extra 字段
+    """
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in LOG_RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """
+    把记录放进队列, 由 QueueListener 的线程写出. 消息的 % 格式化和异常文本在调用线程中完成,
+    参数对象不会被其他线程访问; 队列满时丢弃记录并计数, 不阻塞请求和下载
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+def configure_logging():
+    """
+    按 LOG_* 环境变量设置 app.logger 的输出, 替换 Flask 默认的同步处理器;
+    异步模式下返回写日志的 QueueListener
+    """
+    if LOG_FORMAT == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        # 多个 gunicorn 工作进程写同一个文件时各自轮转会互相覆盖, 这种部署应输出到标准错误
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(LOG_LEVEL)
+    context_filter = LogContextFilter()
+    if not LOG_ASYNC:
+        for handler in handlers:
+            handler.addFilter(context_filter)
+            app.logger.addHandler(handler)
+        return None
+
+    queue_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(context_filter)
+    app.logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出前写完队列中剩余的记录
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+
+class ProgressNotifier:
+    """
+    进度变化的发布/订阅: 推送连接为关心的下载任务注册一个 Event, 进度更新时只唤醒相关的连接
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, download_ids, event):
+        with self._lock:
+            for download_id in download_ids:
+                self._subscribers.setdefault(download_id, set()).add(event)
+
+    def unsubscribe(self, download_ids, event):
+        with self._lock:
+            for download_id in download_ids:
+                events = self._subscribers.get(download_id)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self._subscribers[download_id]
+
+    def notify(self, download_id):
+        with self._lock:
+            events = self._subscribers.get(download_id)
+            if not events:
+                return
+            events = list(events)
+        for event in events:
+            event.set()
+
+progress_notifier = ProgressNotifier()
+
+# 已结束(完成、出错、取消)的下载记录保留多少秒, 之后自动清理
+PROGRESS_TTL = int(os.environ.get('PROGRESS_TTL', 3600))
+# 进度写入共享状态后端的最小间隔(秒), 状态变化总是立即写入
+PROGRESS_STORE_INTERVAL = float(os.environ.get('PROGRESS_STORE_INTERVAL', 1.0))
+
+# 结束状态, 不会再有进度更新; expired 表示任务完成过, 但文件已经被清理
+FINAL_STATUSES = ('completed', 'error', 'cancelled', 'expired')
+# 文件被清理后进度记录中的错误信息
+EXPIRED_ERROR = 'The file has been removed from the server. Please start the download again.'
+
+class ProgressRecord:
+    """
+    一个下载任务的进度, 使用固定字段以减少内存占用
+    """
+    # 总是出现在进度响应中的字段
+    FIELDS = ('status', 'progress', 'filename', 'speed', 'eta', 'total_bytes', 'downloaded_bytes', 'error')
+    # 只有设置了才出现在响应中的字段
+    OPTIONAL_FIELDS = ('details', 'filename_on_server', 'suggested_filename', 'mimetype', 'streamable', 'postprocess', 'bandwidth')
+    __slots__ = FIELDS + OPTIONAL_FIELDS + ('updated_at', 'finished_at', 'stored_at', 'raw_filename')
+
+    def __init__(self, status='waiting'):
+        self.status = status
+        self.progress = 0
+        self.filename = ''
+        self.speed = ''
+        self.eta = ''
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.error = None
+        for name in self.OPTIONAL_FIELDS:
+            setattr(self, name, None)
+        self.updated_at = time.time()
+        self.finished_at = self.updated_at if status in FINAL_STATUSES else None
+        self.stored_at = 0
+        self.raw_filename = None
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        for name in self.OPTIONAL_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+class ProgressRegistry:
+    """
+    线程安全的下载进度登记表: 结束的记录在 PROGRESS_TTL 秒后清理, 可选地写入共享状态后端
+    """
+    # 两次过期清理之间的最小间隔(秒)
+    SWEEP_INTERVAL = 60
+    # 未结束的记录在共享后端中的有效期, 防止崩溃的进程留下永久的记录
+    ACTIVE_TTL = 86400
+
+    def __init__(self, ttl, notifier, backend=None, store_interval=1.0):
+        self.ttl = ttl
+        self.notifier = notifier
+        self.backend = backend
+        self.store_interval = store_interval
+        self._records = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.evicted = 0
+
+    def __contains__(self, download_id):
+        with self._lock:
+            if download_id in self._records:
+                return True
+        return self.backend is not None and self.backend.get('progress', download_id) is not None
+
+    def _store_ttl(self, status):
+        return self.ttl if status in FINAL_STATUSES else self.ACTIVE_TTL
+
+    def _changed(self, download_id, record, status_changed):
+        # 在锁外调用: 通知推送连接, 并按需写入共享存储
+        self.notifier.notify(download_id)
+        if self.backend is not None:
+            now = time.time()
+            if status_changed or now - record.stored_at >= self.store_interval:
+                record.stored_at = now
+                self.backend.set('progress', download_id, record.to_dict(), self._store_ttl(record.status))
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                download_id for download_id, record in self._records.items()
+                if record.finished_at is not None and record.finished_at <= cutoff
+            ]
+            for download_id in expired:
+                del self._records[download_id]
+            self.evicted += len(expired)
+        if self.backend is not None:
+            self.backend.purge_expired()
+
+    def create(self, download_id, status='waiting', **fields):
+        record = ProgressRecord(status)
+        for name, value in fields.items():
+            setattr(record, name, value)
+        with self._lock:
+            self._records[download_id] = record
+        self._changed(download_id, record, True)
+
+    def update(self, download_id, **fields):
+        """
+        更新记录的字段, 记录不存在时返回 False
+        """
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is None:
+                return self._update_stored(download_id, fields)
+            old_status = record.status
+            for name, value in fields.items():
+                setattr(record, name, value)
+            record.updated_at = time.time()
+            status_changed = record.status != old_status
+            if status_changed and record.status in FINAL_STATUSES:
+                record.finished_at = record.updated_at
+        self._changed(download_id, record, status_changed)
+        return True
+
+    def _update_stored(self, download_id, fields):
+        # 记录属于其他进程, 直接修改共享存储中的副本
+        if self.backend is None:
+            return False
+        data = self.backend.get('progress', download_id)
+        if data is None:
+            return False
+        data.update(fields)
+        self.backend.set('progress', download_id, data, self._store_ttl(data.get('status')))
+        self.notifier.notify(download_id)
+        return True
+
+    def update_download(self, download_id, d):
+        """
+        progress_hook 的快速路径: 用 yt-dlp 的进度信息更新下载中的记录
+        """
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is None:
+                record = self._records[download_id] = ProgressRecord()
+            status_changed = record.status != 'downloading'
+            record.status = 'downloading'
+            raw_filename = d.get('filename')
+            if raw_filename != record.raw_filename:
+                record.raw_filename = raw_filename
+                record.filename = os.path.basename(raw_filename) if raw_filename else ''
+            record.speed = d.get('_speed_str', '')
+            record.eta = d.get('_eta_str', '')
+            
+            # Calculate progress percentage
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total and total > 0:
+                downloaded = d.get('downloaded_bytes') or 0
+                record.total_bytes = total
+                record.downloaded_bytes = downloaded
+                record.progress = round(downloaded * 100 / total, 1)
+            record.updated_at = time.time()
+        self._changed(download_id, record, status_changed)
+
+    def expire_file(self, path):
+        """
+        产物文件被清理后, 把指向它的已完成记录(包括其他进程的)改为 expired, 返回修改的记录数
+        """
+        fields = {'status': 'expired', 'error': EXPIRED_ERROR}
+        with self._lock:
+            local = [
+                download_id for download_id, record in self._records.items()
+                if record.status == 'completed' and record.filename_on_server == path
+            ]
+        for download_id in local:
+            self.update(download_id, **fields)
+        count = len(local)
+        if self.backend is not None:
+            for download_id, data in self.backend.scan('progress'):
+                if download_id not in local and data.get('status') == 'completed' and data.get('filename_on_server') == path:
+                    self._update_stored(download_id, fields)
+                    count += 1
+        return count
+
+    def get_status(self, download_id):
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is not None:
+                return record.status
+        if self.backend is not None:
+            data = self.backend.get('progress', download_id)
+            if data is not None:
+                return data.get('status')
+        return None
+
+    def snapshot(self, download_id):
+        """
+        返回记录的字典副本, 不存在时返回 None
+        """
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is not None:
+                return record.to_dict()
+        if self.backend is not None:
+            return self.backend.get('progress', download_id)
+        return None
+
+    def remove(self, download_id):
+        with self._lock:
+            self._records.pop(download_id, None)
+
+    def stats(self):
+        with self._lock:
+            by_status = {}
+            for record in self._records.values():
+                by_status[record.status] = by_status.get(record.status, 0) + 1
+            return {
+                'records': len(self._records),
+                'by_status': by_status,
+                'evicted': self.evicted,
+                'ttl': self.ttl,
+                'shared': self.backend is not None,
+            }
+
+progress_registry = ProgressRegistry(
+    PROGRESS_TTL,
+    progress_notifier,
+    state_backend if state_backend.shared else None,
+    PROGRESS_STORE_INTERVAL
+)
 
 # 自定义进度钩子函数
 def progress_hook(d, download_id):
@@ -36,240 +888,2549 @@ def progress_hook(d, download_id):
     处理下载进度的函数
     """
     try:
-        if download_id not in download_progress:
-            download_progress[download_id] = {
-                'status': 'waiting',
-                'progress': 0,
-                'filename': '',
-                'speed': '',
-                'eta': '',
-                'total_bytes': 0,
-                'downloaded_bytes': 0,
-                'error': None
-            }
-        
-        if d['status'] == 'downloading':
-            download_progress[download_id]['status'] = 'downloading'
-            download_progress[download_id]['filename'] = d.get('filename', '').split('/')[-1]
-            download_progress[download_id]['speed'] = d.get('_speed_str', '')
-            download_progress[download_id]['eta'] = d.get('_eta_str', '')
-            
-            # Calculate progress percentage
-            if 'total_bytes' in d and d['total_bytes'] > 0:
-                download_progress[download_id]['total_bytes'] = d['total_bytes']
-                download_progress[download_id]['downloaded_bytes'] = d['downloaded_bytes']
-                progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                download_progress[download_id]['progress'] = round(progress, 1)
-            elif 'total_bytes_estimate' in d and d['total_bytes_estimate'] > 0:
-                download_progress[download_id]['total_bytes'] = d['total_bytes_estimate']
-                download_progress[download_id]['downloaded_bytes'] = d['downloaded_bytes']
-                progress = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
-                download_progress[download_id]['progress'] = round(progress, 1)
+        status = d['status']
+        if status == 'downloading':
+            progress_registry.update_download(download_id, d)
         
-        elif d['status'] == 'finished':
+        elif status == 'finished':
             # Download finished, now post-processing
-            download_progress[download_id]['status'] = 'processing'
-            download_progress[download_id]['progress'] = 100
-            download_progress[download_id]['filename'] = d.get('filename', '').split('/')[-1]
+            filename = d.get('filename')
+            progress_registry.update(
+                download_id,
+                status='processing',
+                progress=100,
+                filename=os.path.basename(filename) if filename else ''
+            )
         
-        elif d['status'] == 'error':
-            download_progress[download_id]['status'] = 'error'
-            download_progress[download_id]['error'] = d.get('error', 'Unknown error')
+        elif status == 'error':
+            progress_registry.update(download_id, status='error', error=d.get('error', 'Unknown error'))
     except Exception as e:
-        app.logger.error(f"Error in progress_hook: {str(e)}")
+        app.logger.error("Error in progress_hook: %s", e)
         # 确保即使出错也能更新进度状态
-        if download_id in download_progress:
-            download_progress[download_id]['status'] = 'error'
-            download_progress[download_id]['error'] = f"Error tracking progress: {str(e)}"
+        progress_registry.update(download_id, status='error', error=f"Error tracking progress: {str(e)}")
 
-# Get downloads directory from environment variable or use default
-DOWNLOADS_DIR = os.environ.get('DOWNLOADS_DIR', os.path.join(os.getcwd(), 'downloads'))
-# Convert relative path to absolute if needed
-if not os.path.isabs(DOWNLOADS_DIR):
-    DOWNLOADS_DIR = os.path.join(os.getcwd(), DOWNLOADS_DIR)
-# Ensure the downloads directory exists
-if not os.path.exists(DOWNLOADS_DIR):
-    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+# 获取cookies文件路径
+def get_cookies_file():
+    return os.environ.get('COOKIES_FILE', os.path.join(os.getcwd(), 'config', 'cookies.txt'))
 
-@app.route('/')
-def index():
-    # Serves index.html from the root directory where web_server.py is located
-    return send_from_directory(os.getcwd(), 'index.html')
+# 两次检查cookies文件修改时间的最小间隔(秒)
+COOKIES_CHECK_INTERVAL = float(os.environ.get('COOKIES_CHECK_INTERVAL', 5))
+
+@functools.cache
+def tracked_cookie_jar_class():
+    # 基类在 yt-dlp 中, 第一次创建 cookie jar 时才定义这个类
+    class TrackedCookieJar(yt_dlp.cookies.YoutubeDLCookieJar):
+        """
+        记录 cookies 是否被服务器返回的 Set-Cookie 修改过, 没有修改就不必写回文件
+        """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.modified = False
+
+        def set_cookie(self, cookie):
+            super().set_cookie(cookie)
+            self.modified = True
+    return TrackedCookieJar
+
+class SharedCookieJar:
+    """
+    所有 YoutubeDL 实例共用的内存 cookies, 只在文件的修改时间变化时重新解析
+
+    重新加载时替换同一个 jar 对象的内容, 已经建立的 HTTP 会话继续使用它; jar 在第一次 get() 时创建
+    """
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self.jar = None
+        self.reloads = 0
+        self._mtime = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self):
+        """
+        返回共享的 cookie jar; 距上次检查超过 check_interval 秒时检查文件是否被修改
+        """
+        now = time.monotonic()
+        checked = self._checked
+        if checked is None or now - checked >= self.check_interval:
+            with self._lock:
+                # 其他线程已经检查过时不再重复
+                if self._checked is checked:
+                    self._checked = now
+                    mtime = self._stat()
+                    if checked is None or mtime != self._mtime:
+                        self._load(mtime)
+        return self.jar
+
+    def _load(self, mtime):
+        if self.jar is None:
+            self.jar = tracked_cookie_jar_class()(self.path)
+        fresh = tracked_cookie_jar_class()(self.path)
+        self._mtime = mtime
+        if mtime is None:
+            app.logger.warning("Cookies file not found: %s", self.path)
+        else:
+            try:
+                fresh.load()
+            except Exception as e:
+                # 保留之前加载的 cookies, 文件再次修改时重试
+                app.logger.error("Failed to load cookies file %s: %s", self.path, e)
+                return
+            app.logger.info("Loaded cookies file: %s (%s cookies)", self.path, len(fresh))
+        with self.jar._cookies_lock:
+            self.jar._cookies = fresh._cookies
+            self.jar.modified = False
+        self.reloads += 1
+
+    def save(self):
+        """
+        把服务器更新过的 cookies 写回文件; 文件在此期间被外部修改时放弃写入, 下次检查时加载新文件
+        """
+        if self.jar is None or not self.jar.modified:
+            return
+        with self._lock:
+            if not self.jar.modified or self._stat() != self._mtime:
+                return
+            try:
+                # 写入期间其他线程不能修改 cookies
+                with self.jar._cookies_lock:
+                    self.jar.save()
+                    self.jar.modified = False
+            except OSError as e:
+                app.logger.warning("Failed to save cookies file %s: %s", self.path, e)
+                return
+            self._mtime = self._stat()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'cookies': len(self.jar) if self.jar is not None else 0,
+            'reloads': self.reloads,
+        }
+
+shared_cookies = SharedCookieJar(get_cookies_file(), COOKIES_CHECK_INTERVAL)
+
+# 影响 HTTP 连接和提取器列表的 yt-dlp 选项; 这些选项相同的 YoutubeDL 实例共用一个会话
+SESSION_PROFILE_OPTIONS = (
+    'http_headers', 'proxy', 'nocheckcertificate', 'source_address', 'socket_timeout',
+    'legacyserverconnect', 'impersonate', 'compat_opts', 'allowed_extractors',
+)
+# 下载任务使用的请求头
+DOWNLOAD_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+}
+
+class YoutubeDLSessions:
+    """
+    按选项配置保存预先初始化的会话; 新建的 YoutubeDL 实例直接使用会话中的提取器列表、
+    共享的 cookies 和请求处理器, 不再各自生成提取器列表和解析cookies文件,
+    同一主机的 keep-alive 连接在任务之间复用 (需要安装 requests, 否则 yt-dlp 使用不保持连接的 urllib)
+    """
+    def __init__(self, cookies):
+        self.cookies = cookies
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def profile(ydl_opts):
+        return {name: ydl_opts[name] for name in SESSION_PROFILE_OPTIONS if name in ydl_opts}
+
+    def _owner(self, ydl_opts):
+        # 会话由一个只用来持有请求处理器的实例创建, 请求处理器的日志也输出到这个实例
+        profile = self.profile(ydl_opts)
+        key = json.dumps(profile, sort_keys=True, default=str)
+        with self._lock:
+            owner = self._owners.get(key)
+            if owner is None:
+                owner = yt_dlp.YoutubeDL({**profile, 'quiet': True, 'no_warnings': True})
+                owner.__dict__['cookiejar'] = self.cookies.get()
+                owner._request_director
+                self._owners[key] = owner
+        return owner
+
+    def create(self, ydl_opts):
+        """
+        创建使用共享会话的 YoutubeDL 实例, 用完后调用 release 而不是 close
+        """
+        owner = self._owner(ydl_opts)
+        # auto_init=False 跳过生成提取器列表(上千个提取器, 每次约 60ms), 直接复制会话中的列表
+        ydl = yt_dlp.YoutubeDL(ydl_opts, auto_init=False)
+        ydl._ies = dict(owner._ies)
+        ydl.__dict__['cookiejar'] = self.cookies.get()
+        ydl.__dict__['_request_director'] = owner._request_director
+        return ydl
+
+    def release(self, ydl):
+        # 共享的请求处理器不随实例关闭; cookies 由 shared_cookies 统一写回
+        ydl.__dict__.pop('_request_director', None)
+        ydl.params['cookiefile'] = None
+        ydl.close()
+        self.cookies.save()
+
+    @contextlib.contextmanager
+    def session(self, ydl_opts):
+        ydl = self.create(ydl_opts)
+        try:
+            yield ydl
+        finally:
+            self.release(ydl)
+
+    def prewarm(self, profiles):
+        """
+        启动时加载cookies并创建常用配置的会话, 第一个任务不必等待
+        """
+        try:
+            for ydl_opts in profiles:
+                self._owner(ydl_opts)
+        except Exception as e:
+            app.logger.warning("Failed to prewarm yt-dlp sessions: %s", e)
+
+    def warm_extractors(self, ydl_opts, load_all=False):
+        """
+        编译所有提取器的 URL 匹配规则并加载 YouTube 和通用提取器, 否则第一个视频信息请求要多花约 0.5 秒;
+        load_all 时加载全部提取器的代码, 通用提取器检查网页中的嵌入视频时会用到它们(每个进程多占约 20MB)
+        """
+        owner = self._owner(ydl_opts)
+        for ie in list(owner._ies.values()):
+            ie.suitable('https://warmup.invalid/')
+            if load_all:
+                # 延迟加载的提取器在访问 real_class 时导入实际的模块
+                getattr(ie, 'real_class', None)
+        owner.get_info_extractor('Youtube')
+        owner.get_info_extractor('Generic')
+
+    def stats(self):
+        with self._lock:
+            handlers = sorted({
+                handler.RH_NAME
+                for owner in self._owners.values()
+                for handler in owner._request_director.handlers.values()
+            })
+        return {
+            'profiles': len(self._owners),
+            'request_handlers': handlers,
+            'cookies': self.cookies.stats(),
+        }
+
+youtube_dl_sessions = YoutubeDLSessions(shared_cookies)
+
+# 视频信息提取引擎: 'inprocess' 复用常驻的 YoutubeDL 实例, 'subprocess' 每次调用 yt-dlp 命令行
+EXTRACTOR_MODE = os.environ.get('EXTRACTOR_MODE', 'inprocess').lower()
+# 进程内提取时同时工作的 YoutubeDL 实例数量
+EXTRACTOR_POOL_SIZE = int(os.environ.get('EXTRACTOR_POOL_SIZE', 4))
+# 每个实例最多使用多少次后重建, 防止长时间运行时内部缓存无限增长
+EXTRACTOR_MAX_USES = int(os.environ.get('EXTRACTOR_MAX_USES', 200))
+
+# 进程内提取使用的 yt-dlp 选项
+EXTRACTOR_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'skip_download': True,
+    'nocheckcertificate': True,
+    'cookiefile': get_cookies_file(),
+}
+
+class ExtractionCancelled(Exception):
+    """
+    请求视频信息的客户端已断开或等待超时, 提取被放弃
+    """
+
+class ExtractorPool:
+    """
+    常驻 YoutubeDL 实例池, 避免每次请求都重新启动解释器、导入提取器和加载cookies
+    """
+    def __init__(self, size, max_uses):
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        # LIFO 使最近用过(连接和缓存最"热")的实例优先被复用
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _create(self):
+        return youtube_dl_sessions.create(EXTRACTOR_OPTIONS)
+
+    def extract(self, url, cancel_event=None):
+        """
+        提取视频信息, 返回 (info, timings), timings 中的时间单位为毫秒
+
+        cancel_event 被设置时放弃排队; 已经开始的提取无法中断, 结果仍会写入缓存
+        """
+        timings = {'mode': 'inprocess'}
+        start = time.perf_counter()
+        if cancel_event is None:
+            self._slots.acquire()
+        else:
+            while not self._slots.acquire(timeout=0.25):
+                if cancel_event.is_set():
+                    raise ExtractionCancelled(url)
+        acquired = time.perf_counter()
+        timings['queue'] = round((acquired - start) * 1000, 2)
+        try:
+            try:
+                ydl, uses = self._idle.get_nowait()
+            except queue.Empty:
+                ydl, uses = self._create(), 0
+            created = time.perf_counter()
+            timings['init'] = round((created - acquired) * 1000, 2)
+
+            healthy = False
+            try:
+                info = ydl.extract_info(url, download=False)
+                healthy = True
+            except yt_dlp.utils.DownloadError:
+                # 普通的提取失败(私有视频、地区限制等)不影响实例本身
+                healthy = True
+                raise
+            finally:
+                timings['extract'] = round((time.perf_counter() - created) * 1000, 2)
+                uses += 1
+                if healthy and uses < self.max_uses:
+                    self._idle.put((ydl, uses))
+                else:
+                    youtube_dl_sessions.release(ydl)
+        finally:
+            self._slots.release()
+
+        timings['total'] = round((time.perf_counter() - start) * 1000, 2)
+        return info, timings
+
+extractor_pool = ExtractorPool(EXTRACTOR_POOL_SIZE, EXTRACTOR_MAX_USES)
+
+def extract_info_subprocess(url, cancel_event=None):
+    """
+    使用 yt-dlp 命令行工具提取视频信息 (旧的实现, 作为备用方案保留)
+
+    cancel_event 被设置时结束子进程
+    """
+    timings = {'mode': 'subprocess'}
+    start = time.perf_counter()
+    cmd = [
+        'yt-dlp',
+        '--cookies', get_cookies_file(),
+        '--dump-json',
+        '--no-playlist',
+        '--no-warnings',
+        '--no-check-certificate',
+        url
+    ]
+
+    app.logger.info("Running command: %s", ' '.join(cmd))
+
+    # 运行命令并获取输出
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    spawned = time.perf_counter()
+    timings['spawn'] = round((spawned - start) * 1000, 2)
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=None if cancel_event is None else 0.25)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event.is_set():
+                process.kill()
+                process.communicate()
+                raise ExtractionCancelled(url)
+    finished = time.perf_counter()
+    # 包括解释器启动、提取器导入和网络请求
+    timings['process'] = round((finished - spawned) * 1000, 2)
+
+    if process.returncode != 0:
+        error_message = stderr.decode('utf-8', errors='replace')
+        app.logger.error("yt-dlp command failed: %s", error_message)
+        # 与进程内提取保持一致, 以便使用相同的错误分类逻辑
+        raise yt_dlp.utils.DownloadError(error_message.strip())
+
+    # 解析JSON输出
+    info = json.loads(stdout.decode('utf-8', errors='replace'))
+    timings['parse'] = round((time.perf_counter() - finished) * 1000, 2)
+    timings['total'] = round((time.perf_counter() - start) * 1000, 2)
+    return info, timings
+
+def extract_video_info(url, cancel_event=None):
+    """
+    根据 EXTRACTOR_MODE 选择提取方式, 返回 (info, timings)
+    """
+    if EXTRACTOR_MODE == 'subprocess':
+        info, timings = extract_info_subprocess(url, cancel_event)
+    else:
+        info, timings = extractor_pool.extract(url, cancel_event)
+    mode = timings.get('mode', EXTRACTOR_MODE)
+    for stage, value in timings.items():
+        if isinstance(value, (int, float)):
+            EXTRACTION_SECONDS.observe(value / 1000, mode=mode, stage=stage)
+    return info, timings
+
+def classify_download_error(message):
+    """
+    根据 yt-dlp 的错误信息归类, 用于错误提示和指标
+    """
+    lower = message.lower()
+    if "sign in to confirm you're not a bot" in lower:
+        return 'bot_detection'
+    if 'failed to extract any player response' in lower:
+        return 'player_response'
+    if 'unsupported url' in lower:
+        return 'unsupported_url'
+    if 'this video is private' in lower:
+        return 'private'
+    if 'video is unavailable' in lower:
+        return 'unavailable'
+    if 'geo-restricted' in lower or 'region-restricted' in lower:
+        return 'geo_restricted'
+    if 'unable to extract video data' in lower:
+        return 'extraction_failed'
+    return 'other'
+
+def format_server_timing(timings):
+    """
+    将耗时统计转换为 Server-Timing 响应头, 便于在浏览器开发者工具中查看
+    """
+    return ', '.join(
+        f"{name};dur={value}" for name, value in timings.items() if isinstance(value, (int, float))
+    )
+
+# 元数据缓存的最长有效期(秒), 0 表示禁用缓存
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 1800))
+# 签名的媒体地址会过期, 缓存条目至少比最早过期的地址提前这么多秒失效
+METADATA_CACHE_EXPIRY_MARGIN = int(os.environ.get('METADATA_CACHE_EXPIRY_MARGIN', 300))
+# 内存缓存的条目数量和总大小上限, 超出时按 LRU 淘汰
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', 512))
+METADATA_CACHE_MAX_BYTES = int(os.environ.get('METADATA_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# 与视频内容无关的跟踪参数, 规范化URL时去掉
+TRACKING_QUERY_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'pp', 'ab_channel'}
+
+def normalize_url(url):
+    """
+    规范化URL: 小写协议和主机名, 去掉片段和跟踪参数, 查询参数排序
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    query = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_QUERY_PARAMS and not k.startswith('utm_')
+    )
+    return urllib.parse.urlunsplit((
+        parts.scheme.lower(), parts.netloc.lower(), parts.path, urllib.parse.urlencode(query), ''
+    ))
+
+@functools.lru_cache(maxsize=4096)
+def metadata_cache_key(url):
+    """
+    计算缓存键: 能识别出提取器和视频ID时使用 "提取器:ID", 这样同一视频的不同URL写法共享缓存;
+    否则使用规范化后的URL
+    """
+    normalized = normalize_url(url)
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.suitable(normalized):
+            if ie.ie_key() != 'Generic':
+                try:
+                    video_id = ie.get_temp_id(normalized)
+                except Exception:
+                    video_id = None
+                if video_id:
+                    return f"{ie.ie_key()}:{video_id}"
+            break
+    return normalized
+
+def signed_url_expiry(payload):
+    """
+    找出格式列表中签名地址最早的过期时间(Unix时间戳), 没有则返回 None
+    """
+    earliest = None
+    for f in payload.get('formats', []):
+        for media_url in (f.get('url'), f.get('manifest_url')):
+            if not media_url or '?' not in media_url:
+                continue
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(media_url).query)
+            for name in ('expire', 'Expires', 'expires', 'exp'):
+                value = query.get(name, [None])[0]
+                if value and value.isdigit():
+                    expires_at = int(value)
+                    if earliest is None or expires_at < earliest:
+                        earliest = expires_at
+                    break
+    return earliest
+
+class _InFlight:
+    """
+    正在进行的提取, 同一个键的并发请求等待同一个结果
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MetadataCache:
+    """
+    视频信息缓存: TTL + 按条目数和字节数的 LRU 淘汰, 相同键的并发请求只触发一次提取;
+    配置了共享状态后端时作为第二级缓存, 重启后和其他进程都能命中
+    """
+    def __init__(self, ttl, max_entries, max_bytes, backend=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, payload)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.backend = backend
+        self.counters = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'uncacheable': 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _get_memory(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, payload = entry
+        if expires_at <= now:
+            del self._entries[key]
+            self._bytes -= size
+            self.counters['expirations'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return payload
+
+    def _put_memory(self, key, payload, expires_at, size):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, size, payload)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.counters['evictions'] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            payload = self._get_memory(key, now)
+            if payload is not None:
+                self.counters['hits'] += 1
+                return payload
+        if self.backend is None:
+            return None
+        entry = self.backend.get('metadata', key)
+        if entry is None or entry['expires_at'] <= now:
+            return None
+        with self._lock:
+            self._put_memory(key, entry['payload'], entry['expires_at'], entry['size'])
+            self.counters['hits'] += 1
+            self.counters['shared_hits'] += 1
+        return entry['payload']
+
+    def put(self, key, payload):
+        now = time.time()
+        expires_at = now + self.ttl
+        signed_expiry = signed_url_expiry(payload)
+        if signed_expiry is not None:
+            expires_at = min(expires_at, signed_expiry - METADATA_CACHE_EXPIRY_MARGIN)
+        if expires_at <= now:
+            with self._lock:
+                self.counters['uncacheable'] += 1
+            return
+        size = len(json.dumps(payload, separators=(',', ':')))
+        with self._lock:
+            self._put_memory(key, payload, expires_at, size)
+        if self.backend is not None:
+            self.backend.set(
+                'metadata', key, {'expires_at': expires_at, 'size': size, 'payload': payload}, ttl=expires_at - now
+            )
+
+    def _wait(self, flight, deadline, cancel_event):
+        # 等待其他请求的提取结果, cancel_event 被设置或超过 deadline (time.monotonic()) 时放弃
+        while not flight.done.wait(0.25):
+            if (cancel_event is not None and cancel_event.is_set()) or (deadline is not None and time.monotonic() >= deadline):
+                return False
+        return True
+
+    def get_or_load(self, key, loader, refresh=False, deadline=None, cancel_event=None):
+        """
+        返回 (payload, timings, status), status 为 'hit'、'miss' 或 'coalesced'
+
+        等待同一个键的其他请求时, cancel_event 被设置或超过 deadline 就抛出 ExtractionCancelled
+        """
+        start = time.perf_counter()
+        if self.enabled and not refresh:
+            payload = self.get(key)
+            if payload is not None:
+                return payload, {'mode': 'cache', 'total': round((time.perf_counter() - start) * 1000, 2)}, 'hit'
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+                self.counters['misses'] += 1
+            else:
+                self.counters['coalesced'] += 1
+
+        if not leader:
+            if not self._wait(flight, deadline, cancel_event):
+                raise ExtractionCancelled(key)
+            if isinstance(flight.error, ExtractionCancelled):
+                # 发起提取的请求已放弃, 由当前请求重新提取
+                return self.get_or_load(key, loader, refresh, deadline, cancel_event)
+            if flight.error is not None:
+                # 每个等待的请求抛出自己的异常副本, 不共享(也不修改)发起请求的异常的 traceback
+                raise copy.copy(flight.error) from flight.error
+            payload, timings = flight.result
+            return payload, dict(timings, mode='coalesced', total=round((time.perf_counter() - start) * 1000, 2)), 'coalesced'
+
+        try:
+            payload, timings = loader()
+            flight.result = (payload, timings)
+            if self.enabled:
+                self.put(key, payload)
+            return payload, timings, 'miss'
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        stats['ttl'] = self.ttl
+        stats['shared'] = self.backend is not None
+        return stats
+
+metadata_cache = MetadataCache(
+    METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES,
+    state_backend if state_backend.shared else None
+)
+
+def get_video_info_payload(url, refresh=False, cancel_event=None, deadline=None):
+    """
+    获取视频信息(优先使用缓存), 返回 (payload, timings, cache_status)
+    """
+    def load():
+        info, timings = extract_video_info(url, cancel_event)
+        return build_video_info_payload(info, url), timings
+    return metadata_cache.get_or_load(
+        metadata_cache_key(url), load, refresh=refresh, deadline=deadline, cancel_event=cancel_event
+    )
+
+def build_video_info_payload(info, url):
+    """
+    从 yt-dlp 的 info 字典中提取前端需要的字段
+    """
+    formats = []
+    if 'formats' in info:
+        for f in info['formats']:
+            # Be more inclusive with formats
+            formats.append({
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext'),
+                'resolution': f"{f.get('width')}x{f.get('height')}" if f.get('width') and f.get('height') else f.get('resolution'),
+                'width': f.get('width'),
+                'height': f.get('height'),
+                'format_note': f.get('format_note'),
+                'filesize': f.get('filesize'),
+                'filesize_approx': f.get('filesize_approx'),
+                'fps': f.get('fps'),
+                'vcodec': f.get('vcodec'),
+                'acodec': f.get('acodec'),
+                'tbr': f.get('tbr'),
+                'abr': f.get('abr'),
+                'vbr': f.get('vbr'),
+                'url': f.get('url'),
+                'manifest_url': f.get('manifest_url'),
+                'protocol': f.get('protocol'),
+                'language': f.get('language'),
+            })
+    # Fallback if no 'formats' array, but top-level URL exists (e.g., direct image URL)
+    elif 'url' in info: # This case might be rare for typical video URLs yt-dlp processes
+        app.logger.info("No 'formats' array, using top-level info for URL: %s", url)
+        formats.append({
+            'format_id': info.get('format_id', 'source'), # Use 'source' or 'direct' if no specific id
+            'ext': info.get('ext', 'unknown'),
+            'resolution': f"{info.get('width')}x{info.get('height')}" if info.get('width') and info.get('height') else info.get('resolution', 'N/A'),
+            'width': info.get('width'),
+            'height': info.get('height'),
+            'format_note': info.get('format_note', 'Direct Source'),
+            'filesize': info.get('filesize'), # Might be None
+            'filesize_approx': info.get('filesize_approx'),
+            'fps': info.get('fps'),
+            'vcodec': info.get('vcodec', 'N/A'),
+            'acodec': info.get('acodec', 'N/A'),
+            'tbr': info.get('tbr'),
+            'abr': info.get('abr'),
+            'vbr': info.get('vbr'),
+            'url': info.get('url'),
+            'manifest_url': info.get('manifest_url'),
+            'protocol': info.get('protocol'),
+            'language': info.get('language'),
+        })
+
+    return {
+        'id': info.get('id'),
+        'extractor_key': info.get('extractor_key'),
+        'title': info.get('title'),
+        'uploader': info.get('uploader'),
+        'duration': info.get('duration'),
+        'duration_string': info.get('duration_string'),
+        'thumbnail': info.get('thumbnail'),
+        'description': info.get('description'),
+        'webpage_url': info.get('webpage_url'),
+        'formats': formats,
+    }
+
+# 默认不返回的格式字段: 签名的媒体地址很长, 前端也用不到, 需要时传 include_urls=true
+FORMAT_URL_FIELDS = ('url', 'manifest_url')
+
+def parse_format_list_options(params):
+    """
+    解析 /get_video_info 的格式列表参数 (查询字符串或 JSON 请求体), 参数无效时抛出 ValueError
+    """
+    def as_list(value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.split(',')
+        return [str(item).strip() for item in value if str(item).strip()] or None
+
+    def as_bool(value):
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+    max_height = params.get('max_height')
+    if max_height in (None, ''):
+        max_height = None
+    else:
+        try:
+            max_height = int(max_height)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid max_height '{max_height}'.")
+
+    return {
+        'fields': as_list(params.get('fields')),
+        'max_height': max_height,
+        'vcodec': as_list(params.get('vcodec')),
+        'sort': as_list(params.get('sort')),
+        'dedupe': as_bool(params.get('dedupe', False)),
+        'include_urls': as_bool(params.get('include_urls', False)),
+    }
+
+def format_preference(f):
+    """
+    去重时保留的格式: 直接下载优先于分片协议, 然后是码率和文件大小
+    """
+    return (
+        f.get('protocol') in ('https', 'http'),
+        f.get('tbr') or 0,
+        f.get('filesize') or f.get('filesize_approx') or 0,
+    )
+
+def select_formats(formats, options):
+    """
+    按最大高度和视频编码过滤格式, 可选地合并等价格式并排序
+    """
+    selected = []
+    for f in formats:
+        height = f.get('height')
+        if options['max_height'] is not None and height and height > options['max_height']:
+            continue
+        vcodec = f.get('vcodec') or 'none'
+        # 纯音频格式不受视频编码过滤影响, 下载时需要用来合并
+        if options['vcodec'] and vcodec != 'none' and not any(vcodec.startswith(prefix) for prefix in options['vcodec']):
+            continue
+        selected.append(f)
+
+    if options['dedupe']:
+        # 容器、编码系列、分辨率、帧率和语言都相同的格式只保留一个
+        best = {}
+        for f in selected:
+            key = (
+                f.get('ext'),
+                (f.get('vcodec') or 'none').split('.')[0],
+                (f.get('acodec') or 'none').split('.')[0],
+                f.get('resolution'),
+                f.get('fps'),
+                f.get('language'),
+            )
+            if key not in best or format_preference(f) > format_preference(best[key]):
+                best[key] = f
+        kept = {id(f) for f in best.values()}
+        selected = [f for f in selected if id(f) in kept]
+
+    # sort=height,-tbr: 依次按各字段排序, "-" 表示降序, 缺少该字段的格式排在最后
+    for name in reversed(options['sort'] or []):
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        present = [f for f in selected if f.get(name) is not None]
+        missing = [f for f in selected if f.get(name) is None]
+        present.sort(key=lambda f: (isinstance(f[name], str), f[name]), reverse=descending)
+        selected = present + missing
+    return selected
+
+def slim_video_info(payload, options):
+    """
+    按请求参数裁剪视频信息: fields 选择顶层字段, "formats.<字段>" 选择格式中的字段
+    """
+    fields = options['fields']
+    format_fields = None
+    if fields is not None:
+        format_fields = [name.split('.', 1)[1] for name in fields if name.startswith('formats.')] or None
+        top_level = {name.split('.', 1)[0] for name in fields}
+        payload = {name: value for name, value in payload.items() if name in top_level}
+    else:
+        payload = dict(payload)
+
+    if 'formats' in payload:
+        formats = []
+        for f in select_formats(payload['formats'] or [], options):
+            if format_fields is not None:
+                f = {name: f.get(name) for name in format_fields}
+            elif not options['include_urls']:
+                f = {name: value for name, value in f.items() if name not in FORMAT_URL_FIELDS}
+            formats.append(f)
+        payload['formats'] = formats
+    return payload
+
+# 同时运行的下载任务数量
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 3))
+# 排队等待的任务数量上限, 超过后返回 429
+MAX_QUEUED_DOWNLOADS = int(os.environ.get('MAX_QUEUED_DOWNLOADS', 50))
+# 同一网站(提取器或主机名)同时运行的下载数量上限, 0 表示不限制
+MAX_DOWNLOADS_PER_HOST = int(os.environ.get('MAX_DOWNLOADS_PER_HOST', 2))
+
+# 任务优先级, 数值越小越先执行
+DOWNLOAD_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+def download_host_key(url):
+    """
+    用于并发限制的站点标识: 能识别提取器时使用提取器名称, 否则使用主机名
+    """
+    key = metadata_cache_key(url)
+    if key.startswith(('http://', 'https://')):
+        return urllib.parse.urlsplit(key).hostname or key
+    return key.split(':', 1)[0]
+
+class DownloadQueueFull(Exception):
+    """
+    下载队列已满, retry_after 为建议的重试等待秒数
+    """
+    def __init__(self, retry_after):
+        super().__init__('Download queue is full')
+        self.retry_after = retry_after
+
+class DownloadJob:
+    """
+    调度器中的一个下载任务
+    """
+    def __init__(self, download_id, host, priority, target, args, key=None):
+        self.download_id = download_id
+        self.key = key
+        self.host = host
+        self.priority = priority
+        self.target = target
+        self.args = args
+        self.seq = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.cancel_event = threading.Event()
+        # 附加到该任务上的请求数量, 全部取消后才真正取消任务
+        self.subscribers = 1
+        # 还没有被 /start_download 接管的预取任务
+        self.prefetch = False
+
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+class DownloadScheduler:
+    """
+    有界的下载任务调度器: 固定数量的工作线程, 按优先级和提交顺序出队, 并限制每个站点的并发数.
+    预取任务最多占用 workers - 1 个工作线程, 并且在有用户的任务排队时不会开始
+    """
+    def __init__(self, workers, max_queued, per_host_limit):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.per_host_limit = per_host_limit
+        # 预取任务可以使用的工作线程数, 至少留一个给用户的任务
+        self.prefetch_slots = self.workers - 1
+        self._cond = threading.Condition()
+        self._queue = []
+        self._running = {}
+        self._host_running = {}
+        # 已经下载完、正在后处理的任务, 它们的线程由补充的工作线程替代
+        self._handed_off = set()
+        self._seq = 0
+        self._threads = []
+        # 最近任务耗时的滑动平均, 用于估算 Retry-After
+        self._avg_duration = 30.0
+
+    def _ensure_workers(self):
+        # 在第一次提交任务时才启动工作线程
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f"download-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _ordered_queue(self):
+        return sorted(self._queue, key=DownloadJob.sort_key)
+
+    def _host_available(self, host):
+        return self.per_host_limit <= 0 or self._host_running.get(host, 0) < self.per_host_limit
+
+    def retry_after(self):
+        rounds = (len(self._queue) // self.workers) + 1
+        return int(min(300, max(1, rounds * self._avg_duration)))
+
+    def submit(self, job):
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                raise DownloadQueueFull(self.retry_after())
+            self._seq += 1
+            job.seq = self._seq
+            self._queue.append(job)
+            self._ensure_workers()
+            self._cond.notify_all()
+
+    def _running_prefetches(self):
+        # 正在下载的预取任务(已经转入后处理的不再占用工作线程)
+        return sum(1 for download_id, job in self._running.items() if job.prefetch and download_id not in self._handed_off)
+
+    def _take_next(self):
+        interactive_waiting = False
+        for job in self._ordered_queue():
+            if job.prefetch and (interactive_waiting or self._running_prefetches() >= self.prefetch_slots):
+                continue
+            if self._host_available(job.host):
+                self._queue.remove(job)
+                return job
+            if not job.prefetch:
+                interactive_waiting = True
+        return None
+
+    def prefetch_available(self):
+        """
+        现在提交的预取任务能否很快开始: 没有用户的任务在排队, 并且还有空闲的预取名额
+        """
+        with self._cond:
+            if any(not job.prefetch for job in self._queue):
+                return False
+            queued_prefetches = sum(1 for job in self._queue if job.prefetch)
+            return self._running_prefetches() + queued_prefetches < self.prefetch_slots
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._take_next()
+                while job is None:
+                    self._cond.wait()
+                    job = self._take_next()
+                job.started_at = time.time()
+                QUEUE_WAIT_SECONDS.observe(
+                    job.started_at - job.submitted_at,
+                    priority=next((name for name, value in DOWNLOAD_PRIORITIES.items() if value == job.priority), job.priority)
+                )
+                self._running[job.download_id] = job
+                self._host_running[job.host] = self._host_running.get(job.host, 0) + 1
+                # 队列顺序发生了变化
+                self._cond.notify_all()
+                queued_ids = [j.download_id for j in self._queue]
+            # 排队位置变化了, 通知推送连接
+            for download_id in queued_ids:
+                progress_notifier.notify(download_id)
+            log_context = log_download_id.set(job.download_id)
+            try:
+                job.target(*job.args, cancel_event=job.cancel_event)
+            except Exception as e:
+                app.logger.error("Unhandled error in download job %s: %s", job.download_id, e)
+            finally:
+                log_download_id.reset(log_context)
+                with self._cond:
+                    self._running.pop(job.download_id, None)
+                    handed_off = job.download_id in self._handed_off
+                    if handed_off:
+                        self._handed_off.discard(job.download_id)
+                    else:
+                        self._release_host(job.host)
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.time() - job.started_at)
+                    self._cond.notify_all()
+            if handed_off:
+                # 已经有补充的线程接替, 这个线程结束
+                return
+
+    def _release_host(self, host):
+        self._host_running[host] -= 1
+        if not self._host_running[host]:
+            del self._host_running[host]
+
+    def handoff(self, download_id):
+        """
+        任务下载完成、开始后处理时调用: 释放它占用的站点名额, 并启动一个补充的工作线程,
+        让排队的下载不必等待后处理结束. 同时后处理的任务最多 workers 个, 超出时返回 False
+        """
+        with self._cond:
+            job = self._running.get(download_id)
+            if job is None or download_id in self._handed_off or len(self._handed_off) >= self.workers:
+                return False
+            self._handed_off.add(download_id)
+            self._release_host(job.host)
+            thread = Thread(target=self._worker, name=f"download-worker-{download_id[:8]}")
+            thread.daemon = True
+            thread.start()
+            self._cond.notify_all()
+        return True
+
+    def reprioritize(self, download_id, priority):
+        """
+        修改排队中任务的优先级, 任务已经开始运行时不做任何事
+        """
+        with self._cond:
+            job = next((j for j in self._queue if j.download_id == download_id), None)
+            if job is None:
+                return
+            job.priority = priority
+            self._cond.notify_all()
+            queued_ids = [j.download_id for j in self._queue]
+        for queued_id in queued_ids:
+            progress_notifier.notify(queued_id)
+
+    def queue_position(self, download_id):
+        """
+        返回排队位置(从 1 开始), 任务不在队列中时返回 None
+        """
+        with self._cond:
+            for position, job in enumerate(self._ordered_queue(), start=1):
+                if job.download_id == download_id:
+                    return position
+        return None
+
+    def cancel(self, download_id):
+        """
+        取消任务, 返回 'cancelled' (排队中的任务被移除)、'cancelling' (运行中的任务将在下一次进度回调时停止) 或 None
+        """
+        with self._cond:
+            for job in self._queue:
+                if job.download_id == download_id:
+                    self._queue.remove(job)
+                    job.cancel_event.set()
+                    self._cond.notify_all()
+                    queued_ids = [j.download_id for j in self._queue]
+                    break
+            else:
+                job = self._running.get(download_id)
+                if job is not None:
+                    job.cancel_event.set()
+                    return 'cancelling'
+                return None
+        for queued_id in queued_ids:
+            progress_notifier.notify(queued_id)
+        return 'cancelled'
+
+    def get_job(self, download_id):
+        with self._cond:
+            job = self._running.get(download_id)
+            if job is None:
+                job = next((j for j in self._queue if j.download_id == download_id), None)
+            return job
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'prefetch_slots': self.prefetch_slots,
+                'running': len(self._running),
+                'postprocessing': len(self._handed_off),
+                'queued': len(self._queue),
+                'max_queued': self.max_queued,
+                'per_host_limit': self.per_host_limit,
+                'running_per_host': dict(self._host_running),
+            }
+
+download_scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_QUEUED_DOWNLOADS, MAX_DOWNLOADS_PER_HOST)
+
+def available_cpu_count():
+    # 容器中按 CPU 亲和性计算, 而不是宿主机的核数
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# 同时运行的 ffmpeg 后处理(合并、转换、嵌入字幕)数量, 0 表示等于可用的 CPU 核数
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', 0)) or available_cpu_count()
+# 其中同时重新编码(例如音频格式转换)的数量; 编码会占用多个核, 0 表示核数的一半
+POSTPROCESS_ENCODE_WORKERS = int(os.environ.get('POSTPROCESS_ENCODE_WORKERS', 0)) or max(1, POSTPROCESS_WORKERS // 2)
+
+# 只复制数据流、不重新编码的后处理器
+REMUX_POSTPROCESSORS = {
+    'Merger', 'EmbedSubtitle', 'VideoRemuxer', 'Metadata', 'EmbedThumbnail', 'SubtitlesConvertor',
+    'FixupM3u8', 'FixupM4a', 'FixupStretched', 'FixupDuplicateMoov', 'FixupTimestamp', 'FixupDuration',
+}
+# 重新编码的后处理器; ExtractAudio 在源编码与目标格式一致时只复制数据流, 按封装处理
+ENCODE_POSTPROCESSORS = {'ExtractAudio', 'VideoConvertor', 'ThumbnailsConvertor'}
+# 音频格式对应的 yt-dlp acodec 前缀; 源音频是这种编码时 ffmpeg 只复制数据流
+AUDIO_CODEC_PREFIXES = {'aac': 'mp4a', 'm4a': 'mp4a', 'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'vorbis', 'flac': 'flac'}
+
+def postprocess_cost(name, info, audio_format_pref=None):
+    """
+    返回后处理器的开销类别: 'remux'、'encode', 不运行 ffmpeg 的后处理器(移动文件等)返回 None
+    """
+    if name == 'ExtractAudio':
+        prefix = AUDIO_CODEC_PREFIXES.get(audio_format_pref)
+        if prefix and (info.get('acodec') or '').startswith(prefix):
+            return 'remux'
+        return 'encode'
+    if name in ENCODE_POSTPROCESSORS:
+        return 'encode'
+    if name in REMUX_POSTPROCESSORS:
+        return 'remux'
+    return None
+
+class PostprocessPool:
+    """
+    限制同时运行的 ffmpeg 进程数: 总数不超过 workers, 重新编码不超过 encode_workers;
+    空出的名额优先分配给开销小的封装操作, 同类之间按等待顺序
+    """
+    COST_ORDER = {'remux': 0, 'encode': 1}
+
+    def __init__(self, workers, encode_workers):
+        self.workers = max(1, workers)
+        self.encode_workers = max(1, min(encode_workers, self.workers))
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {'remux': 0, 'encode': 0}
+        self._seq = 0
+
+    def _eligible(self, cost):
+        if sum(self._running.values()) >= self.workers:
+            return False
+        return cost != 'encode' or self._running['encode'] < self.encode_workers
+
+    def _next_waiter(self):
+        eligible = [waiter for waiter in self._waiting if self._eligible(waiter[1])]
+        return min(eligible, default=None)
+
+    def acquire(self, cost, cancel_event=None):
+        """
+        等待一个名额; 等待期间任务被取消时返回 False
+        """
+        with self._cond:
+            self._seq += 1
+            waiter = (self.COST_ORDER[cost], cost, self._seq)
+            self._waiting.append(waiter)
+            try:
+                while self._next_waiter() != waiter:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return False
+                    self._cond.wait(0.5)
+                self._running[cost] += 1
+                return True
+            finally:
+                self._waiting.remove(waiter)
+                self._cond.notify_all()
+
+    def release(self, cost):
+        with self._cond:
+            self._running[cost] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'encode_workers': self.encode_workers,
+                'running': dict(self._running),
+                'waiting': len(self._waiting),
+            }
+
+postprocess_pool = PostprocessPool(POSTPROCESS_WORKERS, POSTPROCESS_ENCODE_WORKERS)
+
+# HLS/DASH 等分片格式同时下载的分片数
+CONCURRENT_FRAGMENT_DOWNLOADS = int(os.environ.get('CONCURRENT_FRAGMENT_DOWNLOADS', 4))
+# 所有下载共用的带宽上限(字节/秒, 可以写成 50M 这样的形式), 由正在下载的任务公平分享, 0 表示不限制
+DOWNLOAD_BANDWIDTH_LIMIT = parse_bytes(os.environ.get('DOWNLOAD_BANDWIDTH_LIMIT', '0')) or 0
+# 同一客户端(IP)发起的下载任务合计的带宽上限, 0 表示不限制
+DOWNLOAD_CLIENT_BANDWIDTH_LIMIT = parse_bytes(os.environ.get('DOWNLOAD_CLIENT_BANDWIDTH_LIMIT', '0')) or 0
+# 通过 /download_video 和 /stream_video 向客户端发送文件的总带宽上限, 0 表示不限制
+SERVE_BANDWIDTH_LIMIT = parse_bytes(os.environ.get('SERVE_BANDWIDTH_LIMIT', '0')) or 0
+# 每个客户端(IP)接收文件的带宽上限, 0 表示不限制
+SERVE_CLIENT_BANDWIDTH_LIMIT = parse_bytes(os.environ.get('SERVE_CLIENT_BANDWIDTH_LIMIT', '0')) or 0
+# 按各传输的实际速率重新分配带宽的间隔(秒)
+BANDWIDTH_REBALANCE_INTERVAL = float(os.environ.get('BANDWIDTH_REBALANCE_INTERVAL', 1))
+
+def max_min_shares(capacity, demands):
+    """
+    按最大最小公平分配 capacity: 需求低于平均份额的传输得到全部需求, 剩余部分由其他传输平分
+
+    demands 是 {传输: 需求速率}, 需求可以是 math.inf; 返回 {传输: 分得的速率}
+    """
+    if capacity == math.inf:
+        return dict(demands)
+    shares = {}
+    pending = sorted(demands.items(), key=lambda item: item[1])
+    for index, (key, demand) in enumerate(pending):
+        shares[key] = min(demand, max(capacity, 0) / (len(pending) - index))
+        capacity -= shares[key]
+    return shares
+
+class BandwidthFlow:
+    """
+    一个传输(下载任务或文件发送)的令牌桶, 速率由所属的 BandwidthShaper 分配
+    """
+    def __init__(self, shaper, client, now):
+        self.shaper = shaper
+        self.client = client
+        self.rate = math.inf
+        # 最近一个统计周期的实际速率, 以及据此估计的需求
+        self.measured = 0.0
+        self.demand = math.inf
+        self.throttled = False
+        self.closed = False
+        self._tokens = 0.0
+        self._updated = now
+        self._window_start = now
+        self._window_bytes = 0
+
+    def consume(self, amount):
+        self.shaper.consume(self, amount)
+
+    def close(self):
+        self.shaper.close(self)
+
+    def stats(self):
+        return {
+            'limit': None if self.rate == math.inf else int(self.rate),
+            'rate': int(self.measured),
+        }
+
+class BandwidthShaper:
+    """
+    带宽预算在活动传输之间的公平分配: 每个传输有自己的令牌桶, 传输开始、结束时以及
+    每个统计周期结束时按最大最小公平重新分配速率, 同一客户端的传输合计不超过 client_rate.
+    上一个周期没有用满份额的传输(例如上游本身较慢)按实际速率计算需求, 省下的带宽分给其他传输.
+    """
+    # 按实际速率估计需求时留出的增长余量, 以及需求的下限(字节/秒)
+    DEMAND_HEADROOM = 1.25
+    MIN_DEMAND = 64 * 1024
+
+    def __init__(self, name, rate, client_rate, rebalance_interval, burst_seconds=1.0):
+        self.name = name
+        self.rate = rate
+        self.client_rate = client_rate
+        self.rebalance_interval = rebalance_interval
+        self.burst_seconds = burst_seconds
+        self.total_bytes = 0
+        self._flows = []
+        self._rebalanced = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return bool(self.rate or self.client_rate)
+
+    def open(self, client=None):
+        with self._lock:
+            now = time.monotonic()
+            flow = BandwidthFlow(self, client, now)
+            self._flows.append(flow)
+            self._rebalance(now)
+        return flow
+
+    def close(self, flow):
+        with self._lock:
+            if flow.closed:
+                return
+            flow.closed = True
+            self._flows.remove(flow)
+            self._rebalance(time.monotonic())
+
+    def consume(self, flow, amount):
+        """
+        记录传输的字节数, 超出分得的速率时让调用线程等待
+
+        每次最多等待一个统计周期, 醒来后按重新分配的速率继续计算, 份额变大的传输不必等完旧的欠额
+        """
+        if amount <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if amount:
+                    self.total_bytes += amount
+                    flow._window_bytes += amount
+                if now - self._rebalanced >= self.rebalance_interval:
+                    self._rebalance(now)
+                if flow.rate == math.inf or flow.closed:
+                    return
+                flow._tokens = min(flow.rate * self.burst_seconds, flow._tokens + (now - flow._updated) * flow.rate)
+                flow._updated = now
+                flow._tokens -= amount
+                amount = 0
+                if flow._tokens >= 0:
+                    return
+                flow.throttled = True
+                wait = min(-flow._tokens / flow.rate, self.rebalance_interval)
+            time.sleep(wait)
+
+    def _rebalance(self, now):
+        for flow in self._flows:
+            elapsed = now - flow._window_start
+            if elapsed >= self.rebalance_interval:
+                # 统计周期结束: 被限速过的传输还能更快, 其余的按实际速率估计需求
+                flow.measured = flow._window_bytes / elapsed
+                if flow.throttled or flow.rate == math.inf:
+                    flow.demand = math.inf
+                else:
+                    flow.demand = max(flow.measured * self.DEMAND_HEADROOM, self.MIN_DEMAND)
+                flow.throttled = False
+                flow._window_start = now
+                flow._window_bytes = 0
+        self._rebalanced = now
+        if not self.limited:
+            return
+
+        demands = {flow: flow.demand for flow in self._flows}
+        capacity = self.rate or math.inf
+        shares = {}
+        while demands:
+            fair = max_min_shares(capacity, demands)
+            capped = False
+            if self.client_rate:
+                clients = {}
+                for flow in demands:
+                    clients.setdefault(flow.client, []).append(flow)
+                for flows in clients.values():
+                    if sum(fair[flow] for flow in flows) > self.client_rate:
+                        # 客户端上限起作用, 这些传输的份额固定下来, 其余带宽在下一轮重新分配
+                        client_shares = max_min_shares(self.client_rate, {flow: demands[flow] for flow in flows})
+                        shares.update(client_shares)
+                        capacity -= sum(client_shares.values())
+                        for flow in flows:
+                            del demands[flow]
+                        capped = True
+            if not capped:
+                shares.update(fair)
+                break
+        for flow, rate in shares.items():
+            flow.rate = max(rate, 1.0)
+            flow._tokens = min(flow._tokens, flow.rate * self.burst_seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.rate or None,
+                'client_limit': self.client_rate or None,
+                'active': len(self._flows),
+                'clients': len({flow.client for flow in self._flows}),
+                'rate': int(sum(flow.measured for flow in self._flows)),
+                'total_bytes': self.total_bytes,
+            }
+
+download_bandwidth = BandwidthShaper('download', DOWNLOAD_BANDWIDTH_LIMIT, DOWNLOAD_CLIENT_BANDWIDTH_LIMIT, BANDWIDTH_REBALANCE_INTERVAL)
+serve_bandwidth = BandwidthShaper('serve', SERVE_BANDWIDTH_LIMIT, SERVE_CLIENT_BANDWIDTH_LIMIT, BANDWIDTH_REBALANCE_INTERVAL)
+
+def client_address():
+    """
+    当前请求的客户端地址, 用于按客户端限制带宽; 部署在反向代理后面时需要代理传递真实地址
+    """
+    return request.remote_addr or 'unknown'
+
+# 完成的文件保存在产物库中, 相同参数的后续下载直接复用
+ARTIFACTS_DIR = os.path.join(DOWNLOADS_DIR, 'artifacts')
+# 每个下载任务的临时工作目录, 避免并发任务写入同一个文件
+JOBS_DIR = os.path.join(DOWNLOADS_DIR, '.jobs')
+
+def job_work_dir(download_id):
+    return os.path.join(JOBS_DIR, download_id)
+
+def download_job_key(url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs, stream=False):
+    """
+    根据视频和所有影响输出文件的选项计算任务键, 相同键的任务产生相同的文件
+    """
+    params = [
+        metadata_cache_key(url),
+        format_id or '',
+        bool(audio_only),
+        audio_format_pref if audio_only else '',
+        '' if audio_only else video_quality_pref,
+        bool(embed_subs),
+    ]
+    if stream:
+        # 流式任务合并时输出分片 MP4, 文件内容与普通任务不同
+        params.append('stream')
+    return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+# 正在传输的文件在共享状态后端中的租约有效期(秒); 发送文件的进程每隔三分之一有效期续期一次,
+# 进程退出后租约自动过期
+ARTIFACT_LEASE_TTL = int(os.environ.get('ARTIFACT_LEASE_TTL', 60))
+
+class ArtifactStore:
+    """
+    以任务键寻址的已完成文件库, 索引保存在状态后端中. 正在传输的文件在本进程中做引用计数,
+    使用共享状态后端时还在后端中登记租约, 其他进程和主机的清理也不会删除这些文件
+    """
+    def __init__(self, root, backend, lease_ttl):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.backend = backend
+        self.lease_ttl = max(3, lease_ttl)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._refs = {}
+        self._refresher = None
+
+    @staticmethod
+    def key_for_path(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def entries(self):
+        """
+        返回索引中的所有产物 (键, 信息字典)
+        """
+        return self.backend.scan('artifacts')
+
+    def lookup(self, key):
+        """
+        返回产物信息字典, 不存在(或文件已被外部删除)时返回 None
+        """
+        entry = self.backend.get('artifacts', key)
+        if entry is None:
+            return None
+        if not os.path.exists(entry['path']):
+            self.backend.delete('artifacts', key)
+            return None
+        entry['hits'] = entry.get('hits', 0) + 1
+        self.backend.set('artifacts', key, entry)
+        return dict(entry, key=key)
+
+    def contains(self, key):
+        """
+        产物是否在索引中, 不计入命中次数
+        """
+        return self.backend.get('artifacts', key) is not None
+
+    def add(self, key, src_path, suggested_filename, mimetype):
+        """
+        把下载完成的文件移动到产物库, 返回新路径
+        """
+        ext = os.path.splitext(src_path)[1]
+        shard = os.path.join(self.root, key[:2])
+        os.makedirs(shard, exist_ok=True)
+        path = os.path.join(shard, key + ext)
+        os.replace(src_path, path)
+        self.backend.set('artifacts', key, {
+            'path': path,
+            'suggested_filename': suggested_filename,
+            'mimetype': mimetype,
+            'size': os.path.getsize(path),
+            'created_at': time.time(),
+            'last_served_at': None,
+            'hits': 0,
+        })
+        return path
+
+    def _lease_key(self, path):
+        return f"{self.key_for_path(path)}:{self.owner}"
+
+    def _ensure_refresher(self):
+        # 第一次登记租约时才启动续期线程
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = Thread(target=self._refresh_leases, name='artifact-leases')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _refresh_leases(self):
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            with self._lock:
+                paths = list(self._refs)
+            for path in paths:
+                try:
+                    self.backend.set('leases', self._lease_key(path), time.time(), self.lease_ttl)
+                except Exception as e:
+                    app.logger.warning("Failed to refresh artifact lease for %s: %s", path, e)
+
+    def acquire(self, path):
+        """
+        开始向客户端传输文件, 传输期间文件不会被任何进程清理
+        """
+        with self._lock:
+            count = self._refs[path] = self._refs.get(path, 0) + 1
+        if count == 1 and self.backend.shared:
+            self.backend.set('leases', self._lease_key(path), time.time(), self.lease_ttl)
+            self._ensure_refresher()
+        key = self.key_for_path(path)
+        entry = self.backend.get('artifacts', key)
+        if entry is not None:
+            entry['last_served_at'] = time.time()
+            self.backend.set('artifacts', key, entry)
+
+    def release(self, path):
+        with self._lock:
+            count = self._refs.get(path, 0) - 1
+            if count > 0:
+                self._refs[path] = count
+            else:
+                self._refs.pop(path, None)
+        if count <= 0 and self.backend.shared:
+            self.backend.delete('leases', self._lease_key(path))
+
+    def busy_keys(self):
+        """
+        正在被任何进程传输的产物的键
+        """
+        with self._lock:
+            keys = {self.key_for_path(path) for path in self._refs}
+        if self.backend.shared:
+            keys.update(lease.split(':', 1)[0] for lease, _ in self.backend.scan('leases'))
+        return keys
+
+    def in_use(self, path):
+        return self.key_for_path(path) in self.busy_keys()
+
+    def remove(self, key):
+        """
+        删除产物, 文件正在被任何进程传输时不删除并返回 False
+        """
+        entry = self.backend.get('artifacts', key)
+        if entry is None:
+            return True
+        if key in self.busy_keys():
+            return False
+        with self._lock:
+            if self._refs.get(entry['path'], 0) > 0:
+                return False
+            self.backend.delete('artifacts', key)
+        try:
+            os.remove(entry['path'])
+        except FileNotFoundError:
+            pass
+        return True
+
+artifact_store = ArtifactStore(ARTIFACTS_DIR, state_backend, ARTIFACT_LEASE_TTL)
+
+# 产物库的容量上限(字节), 0 表示只按磁盘使用率清理
+DOWNLOADS_MAX_BYTES = int(os.environ.get('DOWNLOADS_MAX_BYTES', 0))
+# 产物库大小或磁盘使用率超过高水位时按最近下载时间(LRU)删除文件, 直到低于低水位
+DOWNLOADS_HIGH_WATERMARK = float(os.environ.get('DOWNLOADS_HIGH_WATERMARK', 0.9))
+DOWNLOADS_LOW_WATERMARK = float(os.environ.get('DOWNLOADS_LOW_WATERMARK', 0.8))
+# 超过这么多秒没有被下载过的文件会被删除, 0 表示不按时间清理
+ARTIFACT_MAX_AGE = int(os.environ.get('ARTIFACT_MAX_AGE', 7 * 86400))
+# 磁盘剩余空间低于该值(字节)时先清理, 仍然不足则拒绝新任务
+MIN_FREE_BYTES = int(os.environ.get('MIN_FREE_BYTES', 1024 * 1024 * 1024))
+# 后台清理的间隔(秒)
+LIFECYCLE_INTERVAL = int(os.environ.get('LIFECYCLE_INTERVAL', 300))
+# 工作目录和 .part 文件多久没有写入后视为崩溃遗留(秒)
+ORPHAN_GRACE_PERIOD = int(os.environ.get('ORPHAN_GRACE_PERIOD', 6 * 3600))
+# 文件完成后至少保留这么多秒才会按水位清理, 让客户端有时间下载刚完成的文件
+ARTIFACT_GRACE_PERIOD = int(os.environ.get('ARTIFACT_GRACE_PERIOD', 1800))
+
+class InsufficientStorage(Exception):
+    """
+    清理后磁盘剩余空间仍然不足, 无法开始新任务
+    """
+    def __init__(self, free_bytes):
+        super().__init__(f"Only {free_bytes} bytes free in {DOWNLOADS_DIR}")
+        self.free_bytes = free_bytes
+
+class ArtifactLifecycleManager:
+    """
+    产物库的生命周期管理: 按最长闲置时间和高低水位删除文件, 清理崩溃遗留的工作目录,
+    并在任务开始前检查剩余空间. 文件大小和访问时间都来自产物索引, 不扫描下载目录.
+    磁盘水位只按删除产物能腾出的空间计算, 刚完成的文件在 grace 秒内不会被删除.
+    """
+    def __init__(self, store, jobs_dir, max_bytes, high_watermark, low_watermark, max_age, min_free, interval, orphan_grace, grace):
+        self.store = store
+        self.jobs_dir = jobs_dir
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.max_age = max_age
+        self.min_free = min_free
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self.grace = grace
+        self.total_bytes = None
+        self.last_sweep = None
+        self.counters = {'expired': 0, 'evicted': 0, 'evicted_bytes': 0, 'orphans_removed': 0, 'rejected': 0, 'unreachable': 0}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._reconciled = False
+
+    def start(self):
+        # 第一次使用时才启动后台线程
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name='artifact-lifecycle')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                app.logger.error("Artifact lifecycle sweep failed: %s", e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _deficit(self, total, level):
+        """
+        回到 level 以下需要删除的产物字节数: 产物库上限按产物总大小计算,
+        磁盘使用率和最小剩余空间按整个磁盘计算
+        """
+        needed = 0
+        if self.max_bytes:
+            needed = total - self.max_bytes * level
+        usage = shutil.disk_usage(self.store.root)
+        return max(needed, usage.used - usage.total * level, self.min_free - usage.free)
+
+    def note_added(self, size):
+        """
+        新文件加入产物库后更新总大小, 超过高水位且删除产物能回到水位以下时立即唤醒清理线程
+        """
+        with self._lock:
+            if self.total_bytes is None:
+                return
+            self.total_bytes += size
+            total = self.total_bytes
+        if 0 < self._deficit(total, self.high_watermark) <= total:
+            self._wake.set()
+
+    def _remove(self, key, entry):
+        # 删除产物, 并把指向它的已完成记录标记为 expired
+        if not self.store.remove(key):
+            return False
+        progress_registry.expire_file(entry['path'])
+        return True
+
+    def sweep(self, force=False):
+        """
+        执行一次清理; 多个进程共享状态时同一时间段只由一个进程执行, force 时总是执行
+        """
+        if state_backend.shared and not force and not state_backend.add('locks', 'lifecycle-sweep', os.getpid(), max(1, self.interval // 2)):
+            return
+        now = time.time()
+        last_used = lambda entry: entry.get('last_served_at') or entry['created_at']
+        entries = self.store.entries()
+        total = sum(entry['size'] for _, entry in entries)
+        remaining = []
+        for key, entry in entries:
+            if self.max_age and now - last_used(entry) > self.max_age and self._remove(key, entry):
+                self.counters['expired'] += 1
+                total -= entry['size']
+            else:
+                remaining.append((key, entry))
+        needed = self._deficit(total, self.high_watermark)
+        if needed > 0:
+            # 只有完成或最近一次下载之后过了保留期、并且没有被任何进程传输的文件可以删除,
+            # 最久没有被下载的先删除
+            busy = self.store.busy_keys()
+            candidates = sorted(
+                (
+                    (key, entry) for key, entry in remaining
+                    if now - last_used(entry) >= self.grace and key not in busy
+                ),
+                key=lambda item: last_used(item[1])
+            )
+            evictable = sum(entry['size'] for _, entry in candidates)
+            target = self._deficit(total, self.low_watermark)
+            if target > evictable:
+                # 回不到低水位时只回到高水位以下; 磁盘主要被其他数据占用时删除产物也无济于事
+                target = needed
+            if target > evictable:
+                self.counters['unreachable'] += 1
+                app.logger.warning(
+                    "Storage is over the watermark but only %s of the %s bytes needed can be freed by deleting artifacts",
+                    evictable, round(target)
+                )
+            else:
+                freed = 0
+                removed = set()
+                for key, entry in candidates:
+                    if freed >= target:
+                        break
+                    if self._remove(key, entry):
+                        self.counters['evicted'] += 1
+                        self.counters['evicted_bytes'] += entry['size']
+                        freed += entry['size']
+                        removed.add(key)
+                        app.logger.info("Evicted artifact %s (%s bytes)", entry['path'], entry['size'])
+                total -= freed
+                remaining = [(key, entry) for key, entry in remaining if key not in removed]
+        self._remove_orphans(now, {key for key, _ in remaining})
+        with self._lock:
+            self.total_bytes = total
+            self.last_sweep = now
+
+    def _stale(self, path, now):
+        try:
+            return now - os.stat(path).st_mtime > self.orphan_grace
+        except FileNotFoundError:
+            return False
+
+    def _remove_orphans(self, now, indexed_keys):
+        # 崩溃的任务留下的工作目录: 不属于本进程的任务, 且很久没有写入
+        try:
+            job_dirs = list(os.scandir(self.jobs_dir))
+        except FileNotFoundError:
+            job_dirs = []
+        for entry in job_dirs:
+            if download_scheduler.get_job(entry.name) is not None:
+                continue
+            if not entry.is_dir():
+                continue
+            paths = [entry.path] + [f.path for f in os.scandir(entry.path)]
+            if all(self._stale(path, now) for path in paths):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self.counters['orphans_removed'] += 1
+                app.logger.info("Removed orphaned job directory %s", entry.path)
+        # 旧版本直接写在下载目录中的未完成文件
+        for entry in os.scandir(DOWNLOADS_DIR):
+            if entry.is_file() and entry.name.endswith(('.part', '.ytdl')) and self._stale(entry.path, now):
+                os.remove(entry.path)
+                self.counters['orphans_removed'] += 1
+        if not self._reconciled:
+            # 启动后核对一次产物目录, 删除索引中没有的文件(例如使用内存状态后端时重启前留下的文件)
+            self._reconciled = True
+            busy = self.store.busy_keys()
+            for root, _, files in os.walk(self.store.root):
+                for name in files:
+                    path = os.path.join(root, name)
+                    key = ArtifactStore.key_for_path(path)
+                    if key not in indexed_keys and key not in busy and self._stale(path, now):
+                        os.remove(path)
+                        self.counters['orphans_removed'] += 1
+
+    def admit(self):
+        """
+        任务开始前检查剩余空间, 不足时先清理, 仍然不足时抛出 InsufficientStorage
+        """
+        self.start()
+        if shutil.disk_usage(self.store.root).free >= self.min_free:
+            return
+        self.sweep(force=True)
+        free = shutil.disk_usage(self.store.root).free
+        if free < self.min_free:
+            self.counters['rejected'] += 1
+            raise InsufficientStorage(free)
+
+    def stats(self):
+        usage = shutil.disk_usage(self.store.root)
+        with self._lock:
+            return dict(
+                self.counters,
+                artifact_bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                high_watermark=self.high_watermark,
+                low_watermark=self.low_watermark,
+                max_age=self.max_age,
+                grace_period=self.grace,
+                min_free=self.min_free,
+                disk_total=usage.total,
+                disk_free=usage.free,
+                last_sweep=self.last_sweep
+            )
+
+lifecycle_manager = ArtifactLifecycleManager(
+    artifact_store,
+    JOBS_DIR,
+    DOWNLOADS_MAX_BYTES,
+    DOWNLOADS_HIGH_WATERMARK,
+    DOWNLOADS_LOW_WATERMARK,
+    ARTIFACT_MAX_AGE,
+    MIN_FREE_BYTES,
+    LIFECYCLE_INTERVAL,
+    ORPHAN_GRACE_PERIOD,
+    ARTIFACT_GRACE_PERIOD
+)
+
+# 任务日志文件 (sqlite, WAL 模式), 记录任务参数和状态变化, 重启后据此恢复中断的任务; 设为空字符串则不记录
+JOB_JOURNAL = os.environ.get('JOB_JOURNAL', os.path.join(DOWNLOADS_DIR, '.jobs.sqlite3'))
+# 已结束任务的记录保留多少秒, 期间 /download_video/<id> 在重启后仍然可用
+JOB_JOURNAL_RETENTION = int(os.environ.get('JOB_JOURNAL_RETENTION', 7 * 86400))
+# 进程写入心跳的间隔(秒); 心跳超过三个间隔没有更新的进程视为已退出, 它的任务由其他进程接管
+JOB_JOURNAL_HEARTBEAT = float(os.environ.get('JOB_JOURNAL_HEARTBEAT', 10))
+
+# 需要恢复的任务状态
+JOURNAL_ACTIVE_STATUSES = ('queued', 'started')
+
+class JobJournal:
+    """
+    只追加的任务日志: events 表按顺序记录每次状态变化, jobs 表保存每个任务的参数和最新状态
+
+    每个进程定期写入心跳; 所属进程已退出的排队中或运行中的任务由其他进程(或重启后的进程)接管,
+    使用原来的下载ID重新排队, 从工作目录中的 .part 文件继续下载
+    """
+    def __init__(self, path, retention, heartbeat):
+        self.retention = retention
+        self.heartbeat = heartbeat
+        # 进程ID可能在重启后被复用, 加上随机后缀区分
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._thread = None
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, download_id TEXT NOT NULL, status TEXT NOT NULL, '
+            'data TEXT, owner TEXT NOT NULL, at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS events_download_id ON events (download_id)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'download_id TEXT PRIMARY KEY, params TEXT NOT NULL, status TEXT NOT NULL, result TEXT, '
+            'owner TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)')
+        self._db.commit()
+
+    def start(self):
+        # 启动心跳线程和恢复线程; 心跳单独运行, 恢复大量任务时不会因为心跳过期被其他进程再次接管
+        with self._lock:
+            if self._thread is not None:
+                return
+            heartbeat = Thread(target=self._run_heartbeat, name='job-journal-heartbeat')
+            heartbeat.daemon = True
+            heartbeat.start()
+            self._thread = Thread(target=self._run, name='job-journal')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run_heartbeat(self):
+        while True:
+            try:
+                self._beat()
+            except Exception as e:
+                app.logger.error("Job journal heartbeat failed: %s", e)
+            time.sleep(self.heartbeat)
+
+    def _run(self):
+        last_compact = 0
+        while True:
+            try:
+                self.recover()
+                if time.time() - last_compact >= 3600:
+                    last_compact = time.time()
+                    self.compact()
+            except Exception as e:
+                app.logger.error("Job journal maintenance failed: %s", e)
+            time.sleep(self.heartbeat)
+
+    def _beat(self):
+        with self._lock:
+            self._write_heartbeat()
+            self._db.commit()
+
+    def _write_heartbeat(self):
+        self._db.execute(
+            'INSERT OR REPLACE INTO owners (owner, heartbeat_at) VALUES (?, ?)', (self.owner, time.time())
+        )
+
+    def _append(self, download_id, status, data, now):
+        self._db.execute(
+            'INSERT INTO events (download_id, status, data, owner, at) VALUES (?, ?, ?, ?, ?)',
+            (download_id, status, json.dumps(data, separators=(',', ':')) if data else None, self.owner, now)
+        )
+
+    def add(self, download_id, params, status='queued', result=None):
+        """
+        登记新任务及其参数
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO jobs (download_id, params, status, result, owner, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (download_id, json.dumps(params, separators=(',', ':')), status,
+                 json.dumps(result, separators=(',', ':')) if result else None, self.owner, now, now)
+            )
+            self._append(download_id, status, dict(params, **(result or {})), now)
+            self._db.commit()
+
+    def record(self, download_id, status, result=None):
+        """
+        记录状态变化; 结束状态附带结果(文件路径或错误信息)
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET status = ?, result = COALESCE(?, result), owner = ?, updated_at = ? WHERE download_id = ?',
+                (status, json.dumps(result, separators=(',', ':')) if result else None, self.owner, now, download_id)
+            )
+            if cursor.rowcount:
+                self._append(download_id, status, result, now)
+            self._db.commit()
+
+    def get(self, download_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT params, status, result, created_at, updated_at FROM jobs WHERE download_id = ?', (download_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'params': json.loads(row[0]),
+            'status': row[1],
+            'result': json.loads(row[2]) if row[2] else {},
+            'created_at': row[3],
+            'updated_at': row[4],
+        }
+
+    def history(self, download_id):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT status, data, owner, at FROM events WHERE download_id = ? ORDER BY seq', (download_id,)
+            ).fetchall()
+        return [
+            {'status': status, 'data': json.loads(data) if data else None, 'owner': owner, 'at': at}
+            for status, data, owner, at in rows
+        ]
+
+    def claim_interrupted(self):
+        """
+        接管所属进程已退出的未完成任务, 返回 [(download_id, params, status)]
+        """
+        stale_before = time.time() - self.heartbeat * 3
+        claimed = []
+        with self._lock:
+            # 在同一个事务中先写入自己的心跳, 接管的任务不会立即又被视为无主任务
+            self._write_heartbeat()
+            rows = self._db.execute(
+                'SELECT jobs.download_id, jobs.params, jobs.status, jobs.owner FROM jobs '
+                'LEFT JOIN owners ON owners.owner = jobs.owner '
+                f"WHERE jobs.status IN ({','.join('?' * len(JOURNAL_ACTIVE_STATUSES))}) "
+                'AND jobs.owner != ? AND (owners.heartbeat_at IS NULL OR owners.heartbeat_at < ?) '
+                'ORDER BY jobs.created_at',
+                JOURNAL_ACTIVE_STATUSES + (self.owner, stale_before)
+            ).fetchall()
+            for download_id, params, status, owner in rows:
+                # 多个进程同时恢复时只有一个能接管
+                cursor = self._db.execute(
+                    'UPDATE jobs SET owner = ?, updated_at = ? WHERE download_id = ? AND owner = ?',
+                    (self.owner, time.time(), download_id, owner)
+                )
+                if cursor.rowcount:
+                    self._append(download_id, 'recovered', {'previous_owner': owner}, time.time())
+                    claimed.append((download_id, json.loads(params), status))
+            self._db.execute('DELETE FROM owners WHERE heartbeat_at < ?', (stale_before,))
+            self._db.commit()
+        return claimed
+
+    def recover(self):
+        for download_id, params, status in self.claim_interrupted():
+            app.logger.info("Recovering interrupted download %s (%s) for %s", download_id, status, params['url'])
+            try:
+                result = enqueue_download(download_id=download_id, **params)
+            except (DownloadQueueFull, InsufficientStorage) as e:
+                progress_registry.create(download_id, 'error', error='The server restarted and could not resume this download.')
+                self.record(download_id, 'error', {'error': str(e) or e.__class__.__name__})
+                continue
+            if result['download_id'] != download_id:
+                # 相同的文件已经由另一个任务下载
+                progress_registry.create(download_id, 'cancelled')
+                self.record(download_id, 'cancelled', {'superseded_by': result['download_id']})
+
+    def compact(self):
+        """
+        删除超过保留期的已结束任务及其事件
+        """
+        cutoff = time.time() - self.retention
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM events WHERE download_id IN (SELECT download_id FROM jobs '
+                f"WHERE status NOT IN ({','.join('?' * len(JOURNAL_ACTIVE_STATUSES))}) AND updated_at < ?)",
+                JOURNAL_ACTIVE_STATUSES + (cutoff,)
+            )
+            self._db.execute(
+                f"DELETE FROM jobs WHERE status NOT IN ({','.join('?' * len(JOURNAL_ACTIVE_STATUSES))}) AND updated_at < ?",
+                JOURNAL_ACTIVE_STATUSES + (cutoff,)
+            )
+            self._db.commit()
+
+job_journal = JobJournal(JOB_JOURNAL, JOB_JOURNAL_RETENTION, JOB_JOURNAL_HEARTBEAT) if JOB_JOURNAL else None
+
+def journal_final_status(download_id):
+    """
+    把进度记录中的结束状态写入任务日志
+    """
+    if job_journal is None:
+        return
+    record = progress_registry.snapshot(download_id) or {}
+    status = record.get('status')
+    if status == 'completed':
+        job_journal.record(download_id, 'completed', {
+            name: record.get(name) for name in ('filename_on_server', 'suggested_filename', 'mimetype', 'total_bytes')
+        })
+    elif status in ('error', 'cancelled'):
+        job_journal.record(download_id, status, {'error': record.get('error')} if record.get('error') else None)
+    else:
+        job_journal.record(download_id, 'error', {'error': 'Download ended unexpectedly'})
+
+def restore_progress_from_journal(download_id):
+    """
+    进度记录已经过期或在重启时丢失, 但任务日志中有已完成的记录且文件还在时, 重建进度记录
+    """
+    if job_journal is None:
+        return None
+    job = job_journal.get(download_id)
+    if job is None:
+        return None
+    if job['status'] in JOURNAL_ACTIVE_STATUSES:
+        # 中断的任务还没有被恢复 (所属进程的心跳过期后才会接管)
+        return {'status': 'queued', 'progress': 0}
+    if job['status'] != 'completed':
+        return None
+    result = job['result']
+    filename = result.get('filename_on_server')
+    if not filename or not os.path.exists(filename):
+        # 任务完成过, 但文件已经被清理
+        progress_registry.create(download_id, 'expired', progress=100, error=EXPIRED_ERROR)
+        return progress_registry.snapshot(download_id)
+    size = os.path.getsize(filename)
+    progress_registry.create(
+        download_id,
+        'completed',
+        progress=100,
+        filename=os.path.basename(filename),
+        total_bytes=size,
+        downloaded_bytes=size,
+        filename_on_server=filename,
+        suggested_filename=result.get('suggested_filename'),
+        mimetype=result.get('mimetype')
+    )
+    return progress_registry.snapshot(download_id)
+
+# 正在排队或运行的任务, 键为任务键, 相同的下载请求会附加到已有任务上
+inflight_downloads = {}
+inflight_lock = threading.Lock()
+# 附加到其他进程任务上的请求数, 键为下载ID
+remote_subscribers = {}
+
+# 共享状态中任务键登记的有效期(秒), 运行中的任务会定期续期
+INFLIGHT_CLAIM_TTL = int(os.environ.get('INFLIGHT_CLAIM_TTL', 600))
+# 运行中的任务检查共享取消标记的间隔(秒)
+SHARED_STATE_POLL_INTERVAL = float(os.environ.get('SHARED_STATE_POLL_INTERVAL', 1.0))
+
+def claim_inflight_download(job_key, download_id):
+    """
+    在共享状态中登记任务键, 已被其他进程的未结束任务登记时返回该任务的下载ID
+    """
+    if not state_backend.shared:
+        return None
+    for _ in range(2):
+        if state_backend.add('inflight', job_key, download_id, INFLIGHT_CLAIM_TTL):
+            return None
+        owner = state_backend.get('inflight', job_key)
+        if owner == download_id:
+            # 重启前登记的同一个任务, 正在恢复
+            state_backend.set('inflight', job_key, download_id, INFLIGHT_CLAIM_TTL)
+            return None
+        if owner is not None and progress_registry.get_status(owner) not in FINAL_STATUSES + (None,):
+            return owner
+        # 登记对应的任务已经结束或不存在, 清除后重新登记
+        state_backend.delete('inflight', job_key)
+    return None
+
+def release_inflight_download(job_key, download_id):
+    with inflight_lock:
+        job = inflight_downloads.get(job_key)
+        if job is not None and job.download_id == download_id:
+            del inflight_downloads[job_key]
+    release_inflight_claim(job_key, download_id)
+
+def release_inflight_claim(job_key, download_id):
+    # 删除共享状态中的任务键登记和取消标记
+    if state_backend.shared:
+        if state_backend.get('inflight', job_key) == download_id:
+            state_backend.delete('inflight', job_key)
+        state_backend.delete('cancel', download_id)
+
+def shared_cancel_requested(download_id):
+    return state_backend.shared and bool(state_backend.get('cancel', download_id))
+
+def run_download_job(job_key, download_id, *args, cancel_event=None):
+    """
+    调度器执行的任务入口: 下载结束后释放任务键并清理工作目录
+    """
+    try:
+        if job_journal is not None:
+            job_journal.record(download_id, 'started')
+        if shared_cancel_requested(download_id):
+            # 排队期间在其他进程中被取消
+            progress_registry.update(download_id, status='cancelled')
+            return
+        try:
+            # 排队期间磁盘空间可能已经被占用
+            lifecycle_manager.admit()
+        except InsufficientStorage as e:
+            app.logger.error("Not starting download %s: %s", download_id, e)
+            progress_registry.update(download_id, status='error', error='Not enough disk space on the server.')
+            return
+        started = time.perf_counter()
+        download_video_task(download_id, *args, job_key=job_key, cancel_event=cancel_event)
+        elapsed = time.perf_counter() - started
+        status = progress_registry.get_status(download_id) or 'unknown'
+        DOWNLOAD_SECONDS.observe(elapsed, status=status)
+        app.logger.info(
+            "Download job %s finished with status %s in %s ms", download_id, status, round(elapsed * 1000),
+            extra={'status': status, 'ms': round(elapsed * 1000)}
+        )
+    finally:
+        journal_final_status(download_id)
+        release_inflight_download(job_key, download_id)
+        shutil.rmtree(job_work_dir(download_id), ignore_errors=True)
+
+@app.route('/')
+def index():
+    # Serves index.html from the root directory where web_server.py is located
+    return send_from_directory(os.getcwd(), 'index.html')
+
+@app.route('/<path:filename>')
+def send_static_file(filename):
+    # Serves other static files like script.js, style.css from the root directory
+    return send_from_directory(os.getcwd(), filename)
+
+def video_info_response(url, refresh=False, cancel_event=None, options=None, deadline=None):
+    """
+    获取视频信息, 返回 (响应内容, 状态码, 响应头)
+    """
+    app.logger.info("Fetching video info for URL: %s", url)
+    try:
+        payload, timings, cache_status = get_video_info_payload(url, refresh, cancel_event, deadline)
+        CACHE_REQUESTS.inc(cache='metadata', result=cache_status)
+        app.logger.info(
+            "Video info for URL: %s cache=%s timings(ms): %s", url, cache_status, timings,
+            extra={'url': url, 'cache': cache_status, 'timings': timings}
+        )
+
+        prefetch_manager.suggest(url, payload, client_address())
+        body = dict(
+            slim_video_info(payload, options or parse_format_list_options({})),
+            original_url=url, # Echo back the requested URL for reference
+            timings=timings,
+        )
+        return body, 200, {'Server-Timing': format_server_timing(timings), 'X-Cache': cache_status.upper()}
+    except ExtractionCancelled:
+        raise
+    except yt_dlp.utils.DownloadError as e_dl:
+        error_class = classify_download_error(str(e_dl))
+        ERRORS.inc(stage='info', error_class=error_class)
+
+        # YouTube bot detection
+        if error_class == 'bot_detection':
+            return {
+                'error': "YouTube bot detection triggered. Please create a cookies.txt file with your YouTube cookies.",
+                'details': "See https://github.com/yt-dlp/yt-dlp/wiki/FAQ#how-do-i-pass-cookies-to-yt-dlp for instructions."
+            }, 403, {}
+            
+        # Failed to extract player response error
+        if error_class == 'player_response':
+            return {
+                'error': "YouTube extraction failed. This may be due to YouTube API changes.",
+                'details': "Try using a different video URL or check if the video is available in your region. You can also try creating a cookies.txt file with your YouTube cookies."
+            }, 500, {}
+
+        # More specific error messages based on content
+        user_message = {
+            'unsupported_url': f"Unsupported URL: {url}. Please ensure it's a valid video page.",
+            'private': "This video is private and cannot be accessed.",
+            'unavailable': "This video is unavailable.",
+            'geo_restricted': "This video is geo-restricted and not available in your region.",
+            'extraction_failed': "Could not extract video data. The video might be private, deleted, or the URL is incorrect.",
+        }.get(error_class, f"Failed to fetch video information: {str(e_dl)}")
+
+        app.logger.error("DownloadError for URL %s: %s", url, e_dl)
+        return {'error': user_message}, 500, {}
+    except Exception as e_general:
+        ERRORS.inc(stage='info', error_class='unexpected')
+        app.logger.error("Unexpected error for URL %s: %s", url, e_general)
+        return {'error': f"An unexpected error occurred while fetching video info."}, 500, {}
+
+@app.route('/get_video_info', methods=['GET', 'POST'])
+def get_video_info():
+    # 参数可以放在查询字符串中 (GET 请求可以用 ETag 重新验证), 也可以放在 JSON 请求体中
+    data = request.args.to_dict()
+    if request.method == 'POST':
+        data.update(request.get_json() or {})
+    url = data.get('url')
+    # Options from client (e.g., audioOnly) are received but not used by this endpoint,
+    # as its primary goal is to list all available formats.
+    # client_options = data.get('options', {}) 
+
+    if not url:
+        app.logger.warning("URL is required but not provided.")
+        return jsonify({'error': 'URL is required'}), 400
+
+    try:
+        options = parse_format_list_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # ASGI 入口在客户端断开或超时后设置这个事件, 并给出请求的截止时间 (time.monotonic())
+    cancel_event = request.environ.get('ytdlp_webui.cancel_event')
+    deadline = request.environ.get('ytdlp_webui.deadline')
+    try:
+        body, status, headers = video_info_response(
+            url, refresh=data.get('refresh') in (True, 'true', '1'), cancel_event=cancel_event, options=options,
+            deadline=deadline
+        )
+    except ExtractionCancelled:
+        return jsonify({'error': 'Timed out while fetching video information. Please try again.'}), 504
+
+    response = jsonify(body)
+    response.status_code = status
+    response.headers.update(headers)
+    if status == 200:
+        # 耗时统计每次都不同, 不参与 ETag 计算
+        content = {name: value for name, value in body.items() if name != 'timings'}
+        response.set_etag(hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest(), weak=True)
+        response.make_conditional(request)
+    return response
+
+# 大于这个字节数的 JSON 响应按客户端支持的编码用 brotli 或 gzip 压缩, 0 表示不压缩
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+
+@app.after_request
+def compress_response(response):
+    """
+    压缩较大的 JSON 响应; 文件和推送流不压缩
+    """
+    if (
+        RESPONSE_COMPRESSION_MIN_SIZE <= 0
+        or response.mimetype != 'application/json'
+        or response.direct_passthrough
+        or response.is_streamed
+        or response.status_code in (204, 304)
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < RESPONSE_COMPRESSION_MIN_SIZE:
+        return response
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """
+    返回视频信息缓存的命中/未命中/淘汰计数
+    """
+    return jsonify(metadata_cache.stats())
+
+# 推送进度时每个任务每秒最多发送的事件数, 状态变化不受限制
+PROGRESS_STREAM_MAX_RATE = float(os.environ.get('PROGRESS_STREAM_MAX_RATE', 4))
+# 推送连接空闲时发送心跳的间隔(秒), 防止代理断开连接
+PROGRESS_STREAM_KEEPALIVE = float(os.environ.get('PROGRESS_STREAM_KEEPALIVE', 15))
+
+def progress_snapshot(download_id):
+    """
+    返回可序列化的进度副本, 任务不存在时返回 None
+    """
+    progress_data = progress_registry.snapshot(download_id) or restore_progress_from_journal(download_id)
+    if progress_data is None:
+        return None
+    
+    if progress_data['status'] == 'queued':
+        progress_data['queue_position'] = download_scheduler.queue_position(download_id)
+    
+    return progress_data
+
+@app.route('/download_progress/<download_id>', methods=['GET'])
+def get_download_progress(download_id):
+    """
+    获取特定下载任务的进度
+    """
+    progress_data = progress_snapshot(download_id)
+    if progress_data is None:
+        return jsonify({'error': 'Download ID not found'}), 404
+    
+    return jsonify(progress_data)
+
+class ProgressEventStream:
+    """
+    Server-Sent Events 推送的状态: 合并同一任务的连续更新, 按 PROGRESS_STREAM_MAX_RATE 限速,
+    状态变化立即发送, 所有任务结束后结束
+
+    wakeup 是一个带 set()/clear() 的对象, 由 progress_notifier 唤醒; 等待方式由调用方决定
+    (工作线程中的 threading.Event 或 ASGI 入口中的 asyncio 事件)
+    """
+    def __init__(self, download_ids, wakeup):
+        self.download_ids = download_ids
+        self.wakeup = wakeup
+        self.min_interval = 1.0 / PROGRESS_STREAM_MAX_RATE if PROGRESS_STREAM_MAX_RATE > 0 else 0
+        self.last_sent = {}
+        self.last_sent_at = {}
+        self.pending = set(download_ids)
+        self.last_write = time.monotonic()
+
+    def open(self):
+        progress_notifier.subscribe(self.download_ids, self.wakeup)
+        # 告诉浏览器断线后 3 秒重连
+        return 'retry: 3000\n\n'
 
-@app.route('/<path:filename>')
-def send_static_file(filename):
-    # Serves other static files like script.js, style.css from the root directory
-    return send_from_directory(os.getcwd(), filename)
+    def close(self):
+        progress_notifier.unsubscribe(self.download_ids, self.wakeup)
 
-@app.route('/get_video_info', methods=['POST'])
-def get_video_info():
-    data = request.get_json()
-    url = data.get('url')
-    # Options from client (e.g., audioOnly) are received but not used by this endpoint,
-    # as its primary goal is to list all available formats.
-    # client_options = data.get('options', {}) 
+    @property
+    def finished(self):
+        return not self.pending
 
-    if not url:
-        app.logger.warning("URL is required but not provided.")
-        return jsonify({'error': 'URL is required'}), 400
+    def poll(self):
+        """
+        返回 (需要发送的事件, 下次检查前最多等待的秒数)
+        """
+        self.wakeup.clear()
+        events = []
+        now = time.monotonic()
+        timeout = PROGRESS_STREAM_KEEPALIVE
+        if progress_registry.backend is not None:
+            # 其他进程的任务不会触发本进程的通知, 需要定期重新读取共享存储
+            timeout = min(timeout, PROGRESS_STORE_INTERVAL)
+        for download_id in list(self.pending):
+            snapshot = progress_snapshot(download_id)
+            if snapshot is None:
+                snapshot = {'status': 'error', 'error': 'Download ID not found'}
+            previous = self.last_sent.get(download_id)
+            if snapshot == previous:
+                continue
+            status_changed = previous is None or previous['status'] != snapshot['status']
+            wait = self.last_sent_at.get(download_id, 0) + self.min_interval - now
+            if not status_changed and wait > 0:
+                # 限速: 稍后发送最新的状态
+                timeout = min(timeout, wait)
+                continue
+            self.last_sent[download_id] = snapshot
+            self.last_sent_at[download_id] = now
+            self.last_write = now
+            events.append(f"event: progress\ndata: {json.dumps(dict(snapshot, download_id=download_id))}\n\n")
+            if snapshot['status'] in FINAL_STATUSES:
+                self.pending.discard(download_id)
+        return events, timeout
 
-    app.logger.info(f"Fetching video info for URL: {url}")
+    def keepalive(self):
+        """
+        等待超时后调用, 连接空闲太久时返回心跳注释
+        """
+        now = time.monotonic()
+        if now - self.last_write >= PROGRESS_STREAM_KEEPALIVE:
+            self.last_write = now
+            return ': keepalive\n\n'
+        return None
+
+def progress_event_stream(download_ids):
+    """
+    Server-Sent Events 生成器, 在 WSGI 工作线程中等待进度通知
+    """
+    wakeup = threading.Event()
+    stream = ProgressEventStream(download_ids, wakeup)
     try:
-        # 获取cookies文件路径
-        cookies_file = os.environ.get('COOKIES_FILE', os.path.join(os.getcwd(), 'config', 'cookies.txt'))
-        
-        # 检查cookies文件是否存在
-        if os.path.exists(cookies_file):
-            app.logger.info(f"Using cookies file for video info: {cookies_file} (size: {os.path.getsize(cookies_file)} bytes)")
-        else:
-            app.logger.warning(f"Cookies file not found for video info: {cookies_file}")
-        
-        # 使用subprocess调用yt-dlp命令行工具来获取视频信息
-        import subprocess
-        import json
-        
-        # 构建yt-dlp命令
-        cmd = [
-            'yt-dlp',
-            '--cookies', cookies_file,
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings',
-            '--no-check-certificate',
-            url
-        ]
-        
-        app.logger.info(f"Running command: {' '.join(cmd)}")
-        
-        # 运行命令并获取输出
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            error_message = stderr.decode('utf-8', errors='replace')
-            app.logger.error(f"yt-dlp command failed: {error_message}")
-            raise Exception(f"Failed to extract video info: {error_message}")
-        
-        # 解析JSON输出
-        info = json.loads(stdout.decode('utf-8', errors='replace'))
-        
-        # 下面的代码与YoutubeDL API版本相同
-        formats = []
-        if 'formats' in info:
-            for f in info['formats']:
-                # Be more inclusive with formats
-                formats.append({
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'resolution': f"{f.get('width')}x{f.get('height')}" if f.get('width') and f.get('height') else f.get('resolution'),
-                    'format_note': f.get('format_note'),
-                    'filesize': f.get('filesize'),
-                    'filesize_approx': f.get('filesize_approx'),
-                    'fps': f.get('fps'),
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                    'tbr': f.get('tbr'),
-                    'abr': f.get('abr'),
-                    'vbr': f.get('vbr'),
-                    'url': f.get('url'),
-                    'manifest_url': f.get('manifest_url'),
-                    'protocol': f.get('protocol'),
-                    'language': f.get('language'),
-                })
-        # Fallback if no 'formats' array, but top-level URL exists (e.g., direct image URL)
-        elif 'url' in info: # This case might be rare for typical video URLs yt-dlp processes
-            app.logger.info(f"No 'formats' array, using top-level info for URL: {url}")
-            formats.append({
-                'format_id': info.get('format_id', 'source'), # Use 'source' or 'direct' if no specific id
-                'ext': info.get('ext', 'unknown'),
-                'resolution': f"{info.get('width')}x{info.get('height')}" if info.get('width') and info.get('height') else info.get('resolution', 'N/A'),
-                'format_note': info.get('format_note', 'Direct Source'),
-                'filesize': info.get('filesize'), # Might be None
-                'filesize_approx': info.get('filesize_approx'),
-                'fps': info.get('fps'),
-                'vcodec': info.get('vcodec', 'N/A'),
-                'acodec': info.get('acodec', 'N/A'),
-                'tbr': info.get('tbr'),
-                'abr': info.get('abr'),
-                'vbr': info.get('vbr'),
-                'url': info.get('url'),
-                'manifest_url': info.get('manifest_url'),
-                'protocol': info.get('protocol'),
-                'language': info.get('language'),
-            })
+        yield stream.open()
+        while True:
+            events, timeout = stream.poll()
+            yield from events
+            if stream.finished:
+                break
+            if not wakeup.wait(timeout):
+                heartbeat = stream.keepalive()
+                if heartbeat:
+                    yield heartbeat
+    finally:
+        stream.close()
 
-        return jsonify({
-            'title': info.get('title'),
-            'uploader': info.get('uploader'),
-            'duration': info.get('duration'),
-            'duration_string': info.get('duration_string'),
-            'thumbnail': info.get('thumbnail'),
-            'description': info.get('description'),
-            'webpage_url': info.get('webpage_url'),
-            'formats': formats,
-            'original_url': url # Echo back the requested URL for reference
-        })
-    except yt_dlp.utils.DownloadError as e_dl:
-        error_message_lower = str(e_dl).lower()
-        user_message = f"Failed to fetch video information: {str(e_dl)}" # Default detailed message
+def progress_stream_response(download_ids):
+    response = app.response_class(progress_event_stream(download_ids), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 禁用 nginx 的响应缓冲, 否则事件会被攒起来
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-        # More specific error messages based on content
-        if "unsupported url" in error_message_lower:
-            user_message = f"Unsupported URL: {url}. Please ensure it's a valid video page."
-        elif "this video is private" in error_message_lower:
-            user_message = "This video is private and cannot be accessed."
-        elif "video is unavailable" in error_message_lower:
-            user_message = "This video is unavailable."
-        elif "geo-restricted" in error_message_lower or "region-restricted" in error_message_lower:
-            user_message = "This video is geo-restricted and not available in your region."
-        elif "unable to extract video data" in error_message_lower: # Common yt-dlp error
-            user_message = "Could not extract video data. The video might be private, deleted, or the URL is incorrect."
-        
-        # Check for specific YouTube errors
-        error_str = str(e_dl)
-        
-        # YouTube bot detection
-        if "Sign in to confirm you're not a bot" in error_str:
-            return jsonify({
-                'error': "YouTube bot detection triggered. Please create a cookies.txt file with your YouTube cookies.",
-                'details': "See https://github.com/yt-dlp/yt-dlp/wiki/FAQ#how-do-i-pass-cookies-to-yt-dlp for instructions."
-            }), 403
-            
-        # Failed to extract player response error
-        if "Failed to extract any player response" in error_str:
-            return jsonify({
-                'error': "YouTube extraction failed. This may be due to YouTube API changes.",
-                'details': "Try using a different video URL or check if the video is available in your region. You can also try creating a cookies.txt file with your YouTube cookies."
-            }), 500
-        
-        app.logger.error(f"DownloadError for URL {url}: {str(e_dl)}")
-        return jsonify({'error': user_message}), 500
-    except Exception as e_general:
-        app.logger.error(f"Unexpected error for URL {url}: {str(e_general)}")
-        return jsonify({'error': f"An unexpected error occurred while fetching video info."}), 500
+@app.route('/progress_stream/<download_id>', methods=['GET'])
+def stream_download_progress(download_id):
+    """
+    以 Server-Sent Events 推送单个下载任务的进度
+    """
+    if download_id not in progress_registry:
+        return jsonify({'error': 'Download ID not found'}), 404
+    return progress_stream_response([download_id])
 
+@app.route('/progress_stream', methods=['GET'])
+def stream_multiple_download_progress():
+    """
+    在一个连接上推送多个下载任务的进度, 任务ID用逗号分隔: /progress_stream?ids=a,b,c
+    """
+    download_ids = list(dict.fromkeys(i for i in request.args.get('ids', '').split(',') if i))
+    if not download_ids:
+        return jsonify({'error': 'At least one download ID is required'}), 400
+    return progress_stream_response(download_ids)
 
-@app.route('/download_progress/<download_id>', methods=['GET'])
-def get_download_progress(download_id):
+def enqueue_download(url, format_id, audio_only, audio_format_pref='best', video_quality_pref='best', embed_subs=False, stream=False, priority='normal', client=None, download_id=None, prefetch=False):
     """
-    获取特定下载任务的进度
+    提交下载请求: 复用产物库中的文件、附加到相同参数的任务上, 或者放入调度队列
+
+    返回描述结果的字典; 队列已满时抛出 DownloadQueueFull, 磁盘空间不足时抛出 InsufficientStorage.
+    prefetch 为 True 时只在没有可复用的文件和任务时提交新任务, 否则返回 None; 预取任务不写入任务日志
     """
-    if download_id not in download_progress:
-        return jsonify({'error': 'Download ID not found'}), 404
+    job_key = download_job_key(url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs, stream)
+    if prefetch and artifact_store.contains(job_key):
+        return None
+    if not prefetch:
+        # 接管预取的任务或文件; 预取的格式猜错时取消同一视频的预取
+        prefetch_manager.claim(url, job_key)
+    # 写入任务日志的参数, 恢复任务时原样传回本函数
+    params = {
+        'url': url,
+        'format_id': format_id,
+        'audio_only': audio_only,
+        'audio_format_pref': audio_format_pref,
+        'video_quality_pref': video_quality_pref,
+        'embed_subs': embed_subs,
+        'stream': stream,
+        'priority': priority,
+        'client': client,
+    }
     
-    progress_data = download_progress[download_id].copy()
+    # 生成唯一下载ID; 恢复中断的任务时沿用原来的ID, 以便从工作目录中已下载的部分继续
+    download_id = download_id or str(uuid.uuid4())
     
-    # 如果下载已完成，从进度字典中移除该条目
-    if progress_data['status'] == 'completed':
-        # 保留一段时间后清理
-        pass
+    # 相同的文件已经下载过, 直接使用产物库中的文件
+    artifact = artifact_store.lookup(job_key)
+    if artifact is not None:
+        progress_registry.create(
+            download_id,
+            'completed',
+            progress=100,
+            filename=os.path.basename(artifact['path']),
+            total_bytes=artifact['size'],
+            downloaded_bytes=artifact['size'],
+            filename_on_server=artifact['path'],
+            suggested_filename=artifact['suggested_filename'],
+            mimetype=artifact['mimetype']
+        )
+        CACHE_REQUESTS.inc(cache='artifact', result='hit')
+        if job_journal is not None:
+            job_journal.add(download_id, params, 'completed', {
+                'filename_on_server': artifact['path'],
+                'suggested_filename': artifact['suggested_filename'],
+                'mimetype': artifact['mimetype'],
+                'total_bytes': artifact['size'],
+            })
+        app.logger.info("Serving %s from artifact store: %s", url, artifact['path'])
+        return {
+            'download_id': download_id,
+            'status': 'completed',
+            'cached': True
+        }
     
-    # 确保所有值都是可序列化的
-    for key in list(progress_data.keys()):
-        if not isinstance(progress_data[key], (str, int, float, bool, list, dict, type(None))):
-            progress_data[key] = str(progress_data[key])
+    with inflight_lock:
+        # 相同参数的任务正在排队或下载, 附加到该任务上
+        existing = inflight_downloads.get(job_key)
+        if existing is not None and prefetch:
+            return None
+        if existing is not None:
+            if existing.prefetch:
+                # 预取任务由这个请求接管, 按请求的优先级继续并写入任务日志
+                existing.prefetch = False
+                download_scheduler.reprioritize(existing.download_id, DOWNLOAD_PRIORITIES[priority])
+                if job_journal is not None:
+                    job_journal.add(existing.download_id, params)
+            else:
+                existing.subscribers += 1
+            CACHE_REQUESTS.inc(cache='artifact', result='deduplicated')
+            app.logger.info("Attaching download request for %s to in-flight job %s", url, existing.download_id)
+            return {
+                'download_id': existing.download_id,
+                'status': progress_registry.get_status(existing.download_id),
+                'queue_position': download_scheduler.queue_position(existing.download_id),
+                'deduplicated': True
+            }
+        
+        # 任务可能正在其他工作进程或节点上运行
+        owner = claim_inflight_download(job_key, download_id)
+        if owner is not None and prefetch:
+            return None
+        if owner is not None:
+            remote_subscribers[owner] = remote_subscribers.get(owner, 0) + 1
+            CACHE_REQUESTS.inc(cache='artifact', result='deduplicated')
+            app.logger.info("Attaching download request for %s to job %s running in another process", url, owner)
+            return {
+                'download_id': owner,
+                'status': progress_registry.get_status(owner),
+                'queue_position': None,
+                'deduplicated': True
+            }
+        
+        try:
+            lifecycle_manager.admit()
+        except InsufficientStorage:
+            release_inflight_claim(job_key, download_id)
+            raise
+        
+        # 把任务放入调度队列，由工作线程按优先级和站点并发限制执行
+        job = DownloadJob(
+            download_id,
+            download_host_key(url),
+            DOWNLOAD_PRIORITIES[priority],
+            run_download_job,
+            (job_key, download_id, url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs, stream, client),
+            key=job_key
+        )
+        job.prefetch = prefetch
+        progress_registry.create(download_id, 'queued')
+        try:
+            download_scheduler.submit(job)
+        except DownloadQueueFull:
+            progress_registry.remove(download_id)
+            release_inflight_claim(job_key, download_id)
+            raise
+        if job_journal is not None and not prefetch:
+            job_journal.add(download_id, params)
+        inflight_downloads[job_key] = job
+        CACHE_REQUESTS.inc(cache='artifact', result='miss')
     
-    return jsonify(progress_data)
+    return {
+        'download_id': download_id,
+        'status': 'queued',
+        'queue_position': download_scheduler.queue_position(download_id)
+    }
 
 @app.route('/start_download', methods=['GET'])
 def start_download():
@@ -291,118 +3452,1060 @@ def start_download():
     video_quality_pref = request.args.get('videoQuality', 'best')
     embed_subs_str = request.args.get('embedSubs', 'false')
     embed_subs = embed_subs_str.lower() == 'true'
+    stream = request.args.get('stream', 'false').lower() == 'true'
     
-    # 生成唯一下载ID
-    download_id = str(uuid.uuid4())
+    priority_name = request.args.get('priority', 'normal').lower()
+    if priority_name not in DOWNLOAD_PRIORITIES:
+        return jsonify({'error': f"Invalid priority '{priority_name}'. Use one of: {', '.join(DOWNLOAD_PRIORITIES)}."}), 400
     
-    # 在新线程中启动下载，传递所有需要的参数
-    thread = Thread(target=download_video_task, args=(download_id, url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs))
-    thread.daemon = True
-    thread.start()
+    try:
+        result = enqueue_download(url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs, stream, priority_name, client_address())
+    except InsufficientStorage as e:
+        app.logger.warning("Rejecting download request for %s: %s", url, e)
+        return jsonify({'error': 'Not enough disk space on the server. Please try again later.'}), 507
+    except DownloadQueueFull as e:
+        app.logger.warning("Download queue full, rejecting request for %s", url)
+        response = jsonify({
+            'error': 'Too many downloads are queued. Please try again later.',
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    return jsonify(result)
+
+def cancel_download_job(download_id):
+    """
+    取消下载任务, 返回 'cancelled'、'cancelling'、'detached' 或 None(任务已经结束)
+
+    还有其他请求在等待同一个任务时只减少引用而不取消
+    """
+    status = progress_registry.get_status(download_id)
+    with inflight_lock:
+        job = download_scheduler.get_job(download_id)
+        if job is not None and job.subscribers > 1:
+            # 还有其他请求在等待同一个任务, 只减少引用而不取消
+            job.subscribers -= 1
+            return 'detached'
+        if job is None and remote_subscribers.get(download_id, 0) > 0:
+            # 本进程附加到其他进程任务上的请求, 同样只减少引用
+            remote_subscribers[download_id] -= 1
+            if not remote_subscribers[download_id]:
+                del remote_subscribers[download_id]
+            return 'detached'
+        result = download_scheduler.cancel(download_id)
+    if job is not None and result == 'cancelled':
+        # 排队中被取消的任务不会运行, 在这里释放任务键
+        release_inflight_download(job.key, download_id)
+    if job is None and state_backend.shared and status not in FINAL_STATUSES:
+        # 任务属于其他进程, 通过共享取消标记通知它
+        state_backend.set('cancel', download_id, True, INFLIGHT_CLAIM_TTL)
+        result = 'cancelling'
+    if result == 'cancelled':
+        progress_registry.update(download_id, status='cancelled')
+        if job is not None and job_journal is not None:
+            job_journal.record(download_id, 'cancelled')
+    if result is not None:
+        app.logger.info("Cancel requested for download %s: %s", download_id, result)
+    return result
+
+@app.route('/cancel_download/<download_id>', methods=['POST'])
+def cancel_download(download_id):
+    """
+    取消排队中或正在运行的下载任务
+    """
+    status = progress_registry.get_status(download_id)
+    if status is None:
+        return jsonify({'error': 'Download ID not found'}), 404
     
-    return jsonify({
-        'download_id': download_id,
-        'status': 'started'
-    })
+    result = cancel_download_job(download_id)
+    if result is None:
+        return jsonify({'error': f"Download is already {status}"}), 409
+    return jsonify({'download_id': download_id, 'status': result})
+
+# 获取视频信息后在后台预先下载最可能被选择的格式, start_download 直接接管预取的任务或文件
+SPECULATIVE_PREFETCH = os.environ.get('SPECULATIVE_PREFETCH', 'false').lower() == 'true'
+# 预取的格式(yt-dlp 格式选择语法), 按视频信息中的格式列表选出一个 format_id
+PREFETCH_FORMAT = os.environ.get('PREFETCH_FORMAT', 'best[height<=1080][ext=mp4]/bestvideo[height<=1080][ext=mp4]/best')
+# 同时进行的预取任务数
+PREFETCH_MAX_ACTIVE = int(os.environ.get('PREFETCH_MAX_ACTIVE', 2))
+# 没有被接管的预取(下载中和已完成)合计占用的字节数上限, 超出时不再预取并先删除最早的文件
+PREFETCH_MAX_BYTES = parse_bytes(os.environ.get('PREFETCH_MAX_BYTES', '2G')) or 0
+# 预取任务或文件多久(秒)没有被接管就取消或删除
+PREFETCH_TTL = int(os.environ.get('PREFETCH_TTL', 300))
+
+PREFETCH_REQUESTS = metrics.counter(
+    'ytdlp_prefetch_total', 'Speculative prefetch decisions and outcomes', ('result',)
+)
+PREFETCH_WASTED_BYTES = metrics.counter(
+    'ytdlp_prefetch_wasted_bytes_total', 'Bytes downloaded by prefetches that were cancelled or evicted without being used'
+)
+
+class PrefetchEntry:
+    """
+    一个还没有被接管的预取任务
+    """
+    def __init__(self, download_id, job_key, url, estimated_size):
+        self.download_id = download_id
+        self.job_key = job_key
+        self.url_key = metadata_cache_key(url)
+        self.estimated_size = estimated_size
+        self.started_at = time.time()
+        self.finished_at = None
+        self.size = 0
+
+class PrefetchManager:
+    """
+    推测式预取: 获取视频信息后以低优先级下载 PREFETCH_FORMAT 选出的格式, 参数与前端点击该格式时相同,
+    因此 start_download 通过任务键直接附加到预取任务上或复用它的产物. 超过 ttl 没有被接管的预取
+    被取消或删除, 没有接管的预取合计不超过 max_bytes.
+
+    其他进程的接管通过状态后端中的 prefetch 标记告知发起预取的进程
+    """
+    def __init__(self, enabled, format_spec, max_active, max_bytes, ttl):
+        self.enabled = enabled
+        self.format_spec = format_spec
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.counters = {
+            'started': 0, 'hit': 0, 'hit_finished': 0, 'miss': 0,
+            'cancelled': 0, 'evicted': 0, 'failed': 0, 'skipped': 0, 'wasted_bytes': 0,
+        }
+        self._entries = {}
+        self._selector = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_reaper(self):
+        # 第一次预取时才启动后台线程
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name='prefetch-reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(1, min(30, self.ttl / 4)))
+            try:
+                self.sweep()
+            except Exception as e:
+                app.logger.error("Prefetch sweep failed: %s", e)
+
+    def predict_format(self, payload):
+        """
+        用 format_spec 从视频信息的格式列表中选出前端会提交的 format_id, 没有合适的格式时返回 None
+        """
+        formats = payload.get('formats') or []
+        if not formats:
+            return None
+        if self._selector is None:
+            self._selector = yt_dlp.YoutubeDL({'quiet': True}, auto_init=False).build_format_selector(self.format_spec)
+        ctx = {
+            'formats': [dict(f) for f in formats],
+            'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+            'incomplete_formats': False,
+        }
+        selected = next(iter(self._selector(ctx)), None)
+        if selected is None:
+            return None
+        # 选中的是视频+音频的组合时, 前端提交的是视频格式, 下载时再合并最佳音频
+        return (selected.get('requested_formats') or [selected])[0]
+
+    def suggest(self, url, payload, client=None):
+        """
+        视频信息请求成功后调用, 在名额和预算允许时开始预取
+        """
+        if not self.enabled:
+            return
+        try:
+            selected = self.predict_format(payload)
+        except Exception as e:
+            app.logger.warning("Could not choose a format to prefetch for %s: %s", url, e)
+            selected = None
+        if selected is None or not selected.get('format_id'):
+            return
+        estimated_size = selected.get('filesize') or selected.get('filesize_approx') or 0
+        if not estimated_size and selected.get('tbr') and payload.get('duration'):
+            estimated_size = int(selected['tbr'] * 125 * payload['duration'])
+        with self._lock:
+            pending_bytes = sum(entry.size or entry.estimated_size for entry in self._entries.values())
+            active = sum(1 for entry in self._entries.values() if entry.finished_at is None)
+            # 用户的任务在排队或者预取名额已满时不预取, 预取不能让用户的下载等待
+            if (active >= self.max_active or not download_scheduler.prefetch_available()
+                    or (self.max_bytes and pending_bytes + estimated_size > self.max_bytes)):
+                self.counters['skipped'] += 1
+                PREFETCH_REQUESTS.inc(result='skipped')
+                return
+        try:
+            result = enqueue_download(url, selected['format_id'], False, priority='low', client=client, prefetch=True)
+        except (DownloadQueueFull, InsufficientStorage):
+            result = None
+        if result is None:
+            # 文件已经存在、正在下载, 或者没有空间
+            return
+        job_key = download_job_key(url, selected['format_id'], False, 'best', 'best', False)
+        with self._lock:
+            self._entries[job_key] = PrefetchEntry(result['download_id'], job_key, url, estimated_size)
+            self.counters['started'] += 1
+            self._ensure_reaper()
+        job = download_scheduler.get_job(result['download_id'])
+        if job is not None and not job.prefetch:
+            # 提交之后、登记之前已经被 start_download 接管
+            with self._lock:
+                self._entries.pop(job_key, None)
+            self._hit(False)
+        if state_backend.shared:
+            state_backend.set('prefetch', job_key, 'pending', self.ttl * 2)
+        PREFETCH_REQUESTS.inc(result='started')
+        app.logger.info("Prefetching format %s of %s as %s", selected['format_id'], url, result['download_id'])
+
+    def claim(self, url, job_key):
+        """
+        start_download 调用: 任务键相同的预取算作命中, 同一视频的其他预取猜错了格式, 取消并删除
+        """
+        if not self.enabled:
+            return
+        url_key = metadata_cache_key(url)
+        with self._lock:
+            entry = self._entries.pop(job_key, None)
+            missed = [e for e in self._entries.values() if e.url_key == url_key]
+            for e in missed:
+                del self._entries[e.job_key]
+        if entry is not None:
+            self._hit(entry.finished_at is not None)
+        elif state_backend.shared and state_backend.get('prefetch', job_key) == 'pending':
+            # 预取由其他进程发起, 标记为已接管, 那个进程不会再取消或删除它
+            state_backend.set('prefetch', job_key, 'adopted', self.ttl * 2)
+            self._hit(artifact_store.contains(job_key))
+        for e in missed:
+            self._discard(e, 'miss')
+
+    def _hit(self, finished):
+        with self._lock:
+            self.counters['hit'] += 1
+            if finished:
+                self.counters['hit_finished'] += 1
+        PREFETCH_REQUESTS.inc(result='hit_finished' if finished else 'hit')
+
+    def _discard(self, entry, reason):
+        # 取消没有用到的预取任务或删除它下载的文件, 已经下载的字节计为浪费
+        record = progress_registry.snapshot(entry.download_id) or {}
+        if record.get('status') == 'completed':
+            wasted = entry.size or record.get('total_bytes') or 0
+            if not artifact_store.remove(entry.job_key):
+                # 文件正在传输, 由产物库的清理按时间处理
+                wasted = 0
+        else:
+            wasted = record.get('downloaded_bytes') or 0
+            if record.get('status') not in FINAL_STATUSES:
+                cancel_download_job(entry.download_id)
+        with self._lock:
+            self.counters[reason] += 1
+            self.counters['wasted_bytes'] += wasted
+        PREFETCH_REQUESTS.inc(result=reason)
+        PREFETCH_WASTED_BYTES.inc(wasted)
+        app.logger.info("Discarded prefetch %s (%s, %s bytes wasted)", entry.download_id, reason, wasted)
+
+    def sweep(self):
+        """
+        取消或删除超过 ttl 没有被接管的预取, 并把没有接管的预取控制在 max_bytes 以内
+        """
+        now = time.time()
+        expired = []
+        failed = []
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            if state_backend.shared and state_backend.get('prefetch', entry.job_key) == 'adopted':
+                # 已经被其他进程接管, 命中由那个进程统计
+                with self._lock:
+                    self._entries.pop(entry.job_key, None)
+                continue
+            record = progress_registry.snapshot(entry.download_id) or {}
+            status = record.get('status')
+            if status == 'completed' and entry.finished_at is None:
+                entry.finished_at = now
+                entry.size = record.get('total_bytes') or 0
+            elif status in FINAL_STATUSES and status != 'completed':
+                failed.append(entry)
+                continue
+            if now - (entry.finished_at or entry.started_at) > self.ttl:
+                expired.append(entry)
+        if self.max_bytes:
+            # 超出预算时先删除最早完成的文件, 再取消最早开始的任务
+            remaining = sorted(
+                (entry for entry in entries if entry not in expired and entry not in failed),
+                key=lambda entry: (entry.finished_at is None, entry.finished_at or entry.started_at)
+            )
+            total = sum(entry.size or entry.estimated_size for entry in remaining)
+            for entry in remaining:
+                if total <= self.max_bytes:
+                    break
+                expired.append(entry)
+                total -= entry.size or entry.estimated_size
+        for entry in failed + expired:
+            with self._lock:
+                if self._entries.pop(entry.job_key, None) is None:
+                    # 刚好被接管
+                    continue
+            if entry in failed:
+                with self._lock:
+                    self.counters['failed'] += 1
+                PREFETCH_REQUESTS.inc(result='failed')
+            else:
+                self._discard(entry, 'evicted' if entry.finished_at is not None else 'cancelled')
+
+    def stats(self):
+        with self._lock:
+            resolved = self.counters['hit'] + self.counters['miss'] + self.counters['cancelled'] + self.counters['evicted']
+            return dict(
+                self.counters,
+                enabled=self.enabled,
+                pending=len(self._entries),
+                hit_rate=round(self.counters['hit'] / resolved, 3) if resolved else None,
+            )
+
+prefetch_manager = PrefetchManager(SPECULATIVE_PREFETCH, PREFETCH_FORMAT, PREFETCH_MAX_ACTIVE, PREFETCH_MAX_BYTES, PREFETCH_TTL)
+
+# 一个批量下载最多包含的条目数
+BATCH_MAX_ENTRIES = int(os.environ.get('BATCH_MAX_ENTRIES', 500))
+# 每个批量下载同时排队或运行的条目数, 其余条目在展开后等待, 不占满下载队列
+BATCH_MAX_PENDING = int(os.environ.get('BATCH_MAX_PENDING', MAX_CONCURRENT_DOWNLOADS * 2))
+
+class DownloadBatch:
+    """
+    一组一起提交的下载, 条目按需展开并逐个放入下载队列
+    """
+    def __init__(self, batch_id, urls, playlist_url, options, priority):
+        self.batch_id = batch_id
+        self.urls = urls
+        self.playlist_url = playlist_url
+        self.options = options
+        self.priority = priority
+        self.status = 'expanding'
+        self.title = None
+        self.error = None
+        self.entries = []
+        self.created_at = time.time()
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'title': self.title,
+            'error': self.error,
+            'entries': self.entries,
+            'created_at': self.created_at,
+        }
+
+class BatchManager:
+    """
+    批量和播放列表下载: 在后台线程中流式展开播放列表(只做扁平提取), 限制每个批次占用的队列位置,
+    并汇总各条目的进度. 批次信息保存在状态后端中, 其他进程也可以查询和取消.
+    """
+    def __init__(self, max_entries, max_pending, ttl):
+        self.max_entries = max_entries
+        self.max_pending = max(1, max_pending)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def create(self, urls, playlist_url, options, priority):
+        batch = DownloadBatch(str(uuid.uuid4()), urls, playlist_url, options, priority)
+        with self._lock:
+            self._batches[batch.batch_id] = batch
+        self._store(batch)
+        thread = Thread(target=self._run, args=(batch,), name=f"batch-{batch.batch_id[:8]}")
+        thread.daemon = True
+        thread.start()
+        return batch
+
+    def _store(self, batch):
+        ttl = ProgressRegistry.ACTIVE_TTL if batch.status == 'expanding' else self.ttl
+        state_backend.set('batches', batch.batch_id, batch.to_dict(), ttl)
+
+    def _iter_sources(self, batch):
+        # 返回 (url, title); 播放列表只做扁平提取, 条目在迭代时才逐页获取
+        for url in batch.urls:
+            yield url, None
+        if not batch.playlist_url:
+            return
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': 'in_playlist',
+            'lazy_playlist': True,
+            'skip_download': True,
+            'nocheckcertificate': True,
+            'cookiefile': get_cookies_file(),
+        }
+        with youtube_dl_sessions.session(ydl_opts) as ydl:
+            info = ydl.extract_info(batch.playlist_url, download=False, process=False)
+            if info.get('_type') not in ('playlist', 'multi_video'):
+                # 不是播放列表, 当作单个视频下载
+                yield batch.playlist_url, info.get('title')
+                return
+            batch.title = info.get('title')
+            for entry in info.get('entries') or []:
+                if entry is None:
+                    continue
+                url = entry.get('webpage_url') or entry.get('url')
+                if not url and entry.get('formats'):
+                    # 有些提取器(例如通用提取器)直接返回解析好的条目, 没有单独的页面地址
+                    url = entry['formats'][-1].get('url')
+                if url:
+                    yield url, entry.get('title')
+
+    def _pending(self, batch):
+        return [
+            entry['download_id'] for entry in batch.entries
+            if entry.get('download_id') and progress_registry.get_status(entry['download_id']) not in FINAL_STATUSES
+        ]
+
+    def _wait_for_slot(self, batch):
+        # 本批次排队和运行的条目达到上限时, 等待其中一个结束
+        event = threading.Event()
+        while not batch.cancel_event.is_set():
+            pending = self._pending(batch)
+            if len(pending) < self.max_pending:
+                return True
+            progress_notifier.subscribe(pending, event)
+            event.wait(1.0)
+            progress_notifier.unsubscribe(pending, event)
+            event.clear()
+            if shared_cancel_requested(batch.batch_id):
+                batch.cancel_event.set()
+        return False
+
+    def _submit(self, batch, url, title):
+        entry = {'url': url, 'title': title}
+        while not batch.cancel_event.is_set():
+            try:
+                result = enqueue_download(url, priority=batch.priority, **batch.options)
+                entry['download_id'] = result['download_id']
+                break
+            except DownloadQueueFull as e:
+                # 队列被其他请求占满, 稍后重试
+                batch.cancel_event.wait(min(e.retry_after, 5))
+            except InsufficientStorage:
+                entry['error'] = 'Not enough disk space on the server.'
+                break
+        batch.entries.append(entry)
+
+    def _run(self, batch):
+        try:
+            for url, title in self._iter_sources(batch):
+                if shared_cancel_requested(batch.batch_id):
+                    batch.cancel_event.set()
+                if len(batch.entries) >= self.max_entries:
+                    batch.error = f"Batch truncated to {self.max_entries} entries"
+                    break
+                if not self._wait_for_slot(batch):
+                    break
+                self._submit(batch, url, title)
+                self._store(batch)
+        except Exception as e:
+            app.logger.error("Batch %s expansion failed: %s", batch.batch_id, e)
+            batch.error = str(e)
+        batch.status = 'cancelled' if batch.cancel_event.is_set() else 'expanded'
+        self._store(batch)
+        # 展开结束后批次信息只从状态后端读取
+        with self._lock:
+            self._batches.pop(batch.batch_id, None)
+        app.logger.info("Batch %s expanded into %s downloads", batch.batch_id, len(batch.entries))
+
+    def cancel(self, batch_id):
+        """
+        停止展开并取消批次中的所有下载, 批次不存在时返回 False
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is not None:
+            batch.cancel_event.set()
+            entries = list(batch.entries)
+        else:
+            data = state_backend.get('batches', batch_id)
+            if data is None:
+                return False
+            if data['status'] == 'expanding':
+                # 批次在其他进程中展开
+                state_backend.set('cancel', batch_id, True, INFLIGHT_CLAIM_TTL)
+            else:
+                data['status'] = 'cancelled'
+                state_backend.set('batches', batch_id, data, self.ttl)
+            entries = data['entries']
+        for entry in entries:
+            if entry.get('download_id') and progress_registry.get_status(entry['download_id']) not in FINAL_STATUSES:
+                cancel_download_job(entry['download_id'])
+        return True
+
+    def snapshot(self, batch_id):
+        """
+        返回批次的汇总进度, 不存在时返回 None
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        data = batch.to_dict() if batch is not None else state_backend.get('batches', batch_id)
+        if data is None:
+            return None
+        entries = []
+        by_status = {}
+        progress_sum = 0.0
+        downloaded_bytes = 0
+        total_bytes = 0
+        for entry in list(data['entries']):
+            item = dict(entry)
+            record = progress_registry.snapshot(entry['download_id']) if entry.get('download_id') else None
+            if record is not None:
+                item['status'] = record['status']
+                item['progress'] = 100 if record['status'] == 'completed' else record['progress']
+                downloaded_bytes += record.get('downloaded_bytes') or 0
+                total_bytes += record.get('total_bytes') or 0
+            else:
+                item['status'] = 'error' if entry.get('error') else 'unknown'
+                item['progress'] = 0
+            by_status[item['status']] = by_status.get(item['status'], 0) + 1
+            progress_sum += item['progress']
+            entries.append(item)
+        active = sum(count for status, count in by_status.items() if status not in FINAL_STATUSES + ('unknown',))
+        if data['status'] == 'expanding' or active:
+            status = data['status'] if data['status'] != 'expanded' else 'downloading'
+        else:
+            status = 'cancelled' if data['status'] == 'cancelled' else 'completed'
+        return {
+            'batch_id': batch_id,
+            'status': status,
+            'expanding': data['status'] == 'expanding',
+            'title': data['title'],
+            'error': data['error'],
+            'total': len(entries),
+            'by_status': by_status,
+            'progress': round(progress_sum / len(entries), 1) if entries else 0,
+            'downloaded_bytes': downloaded_bytes,
+            'total_bytes': total_bytes,
+            'entries': entries,
+        }
+
+batch_manager = BatchManager(BATCH_MAX_ENTRIES, BATCH_MAX_PENDING, PROGRESS_TTL)
+
+@app.route('/batch_download', methods=['POST'])
+def batch_download():
+    """
+    批量下载: 请求体中提供 urls (URL列表) 和/或 playlist_url (播放列表), 以及与 /start_download 相同的下载选项
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls') or []
+    playlist_url = data.get('playlist_url')
+    if not isinstance(urls, list) or not all(isinstance(url, str) and url for url in urls):
+        return jsonify({'error': 'urls must be a list of URLs.'}), 400
+    if not urls and not playlist_url:
+        return jsonify({'error': 'Provide urls or playlist_url.'}), 400
+    if len(urls) > BATCH_MAX_ENTRIES:
+        return jsonify({'error': f"A batch can contain at most {BATCH_MAX_ENTRIES} URLs."}), 400
+    
+    priority_name = str(data.get('priority', 'low')).lower()
+    if priority_name not in DOWNLOAD_PRIORITIES:
+        return jsonify({'error': f"Invalid priority '{priority_name}'. Use one of: {', '.join(DOWNLOAD_PRIORITIES)}."}), 400
+    
+    # 各条目的格式不同, 不指定 format_id 时由 yt-dlp 选择最佳格式
+    options = {
+        'format_id': data.get('format_id'),
+        'audio_only': bool(data.get('audioOnly', False)),
+        'audio_format_pref': data.get('audioFormat', 'best'),
+        'video_quality_pref': str(data.get('videoQuality', 'best')),
+        'embed_subs': bool(data.get('embedSubs', False)),
+        'client': client_address(),
+    }
+    batch = batch_manager.create(urls, playlist_url, options, priority_name)
+    app.logger.info("Created batch %s with %s URLs, playlist: %s", batch.batch_id, len(urls), playlist_url)
+    return jsonify({'batch_id': batch.batch_id, 'status': batch.status})
+
+@app.route('/batch_progress/<batch_id>', methods=['GET'])
+def get_batch_progress(batch_id):
+    """
+    返回批量下载的汇总进度和每个条目的状态
+    """
+    snapshot = batch_manager.snapshot(batch_id)
+    if snapshot is None:
+        return jsonify({'error': 'Batch ID not found'}), 404
+    return jsonify(snapshot)
+
+@app.route('/cancel_batch/<batch_id>', methods=['POST'])
+def cancel_batch(batch_id):
+    """
+    取消批量下载中尚未完成的所有条目
+    """
+    if not batch_manager.cancel(batch_id):
+        return jsonify({'error': 'Batch ID not found'}), 404
+    return jsonify({'batch_id': batch_id, 'status': 'cancelled'})
+
+@app.route('/download_queue', methods=['GET'])
+def get_download_queue():
+    """
+    返回调度器的运行和排队情况
+    """
+    return jsonify(dict(
+        download_scheduler.stats(),
+        progress=progress_registry.stats(),
+        storage=lifecycle_manager.stats(),
+        postprocess=postprocess_pool.stats(),
+        sessions=youtube_dl_sessions.stats(),
+        bandwidth={'download': download_bandwidth.stats(), 'serve': serve_bandwidth.stats()},
+        prefetch=prefetch_manager.stats(),
+    ))
+
+metrics.gauge(
+    'ytdlp_download_jobs', 'Download jobs running or waiting in the scheduler queue', ('state',),
+    lambda: {(state,): download_scheduler.stats()[state] for state in ('running', 'queued')}
+)
+metrics.gauge(
+    'ytdlp_progress_records', 'Progress records held in memory by each worker process', ('status',),
+    lambda: {(status,): count for status, count in progress_registry.stats()['by_status'].items()}
+)
+metrics.gauge(
+    'ytdlp_metadata_cache', 'Entries and approximate bytes held by the in-memory video info cache', ('unit',),
+    lambda: {(unit,): metadata_cache.stats()[unit] for unit in ('entries', 'bytes')}
+)
+metrics.gauge(
+    'ytdlp_storage_bytes', 'Bytes used by finished files and free/total space on the downloads volume', ('kind',),
+    lambda: {
+        (kind,): value for kind, value in lifecycle_manager.stats().items()
+        if kind in ('artifact_bytes', 'disk_free', 'disk_total')
+    },
+    merge='max'
+)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus 抓取接口, 多进程部署时汇总所有工作进程发布的指标
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# 已完成文件的发送方式: direct 由本服务发送 (gunicorn 下使用 sendfile),
+# x-accel-redirect 交给 nginx 发送, x-sendfile 交给 Apache/lighttpd 发送
+FILE_SENDING_MODE = os.environ.get('FILE_SENDING_MODE', 'direct').lower()
+# nginx 中映射到 DOWNLOADS_DIR 的 internal location
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '/internal-downloads/')
+# 服务器不支持 sendfile 时每次读取的块大小
+FILE_SEND_BLOCK_SIZE = int(os.environ.get('FILE_SEND_BLOCK_SIZE', 256 * 1024))
+
+class FileRange:
+    """
+    文件中一段区间的只读文件对象, 交给 wsgi.file_wrapper 发送
+
+    gunicorn 的 file_wrapper 会通过 fileno() 和当前偏移量调用 sendfile,
+    其他服务器按块调用 read(). 关闭时调用 on_close 释放文件引用.
+    限制发送带宽时不提供 fileno(), 让服务器逐块读取, 每块占用 bandwidth 的份额.
+    """
+    def __init__(self, path, start, length, on_close=None, bandwidth=None):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+        self._on_close = on_close
+        self._bandwidth = bandwidth
+
+    def fileno(self):
+        if self._bandwidth is not None and self._bandwidth.shaper.limited:
+            raise io.UnsupportedOperation('fileno')
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size) if size else b''
+        self._remaining -= len(data)
+        if self._bandwidth is not None:
+            self._bandwidth.consume(len(data))
+        return data
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        if self._bandwidth is not None:
+            self._bandwidth.close()
+        if self._on_close is not None:
+            self._on_close()
+
+def content_disposition_options(download_name):
+    """
+    生成 Content-Disposition 的文件名参数, 非 ASCII 文件名使用 filename*
+    """
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = urllib.parse.quote(download_name, safe="!#$&+^`|~")
+        return {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    return {'filename': download_name}
+
+def send_artifact_file(path, download_name, mimetype, on_close=None):
+    """
+    以附件形式发送文件, 支持 Range/If-Range 和 ETag/Last-Modified 条件请求
+
+    on_close 在文件发送结束(或确定不需要发送)后调用一次
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', **content_disposition_options(download_name))
+    response.last_modified = int(stat.st_mtime)
+    response.set_etag(f'{stat.st_mtime_ns:x}-{size:x}')
+    response.cache_control.no_cache = True
+
+    if FILE_SENDING_MODE in ('x-accel-redirect', 'x-sendfile'):
+        # 由前端代理读取文件并处理 Range 和条件请求
+        if FILE_SENDING_MODE == 'x-accel-redirect':
+            relative = os.path.relpath(path, DOWNLOADS_DIR).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + urllib.parse.quote(relative)
+        else:
+            response.headers['X-Sendfile'] = path
+        response.content_length = 0
+        if on_close is not None:
+            on_close()
+        return response
+
+    response.content_length = size
+    environ = request.environ
+    byte_range = parse_range_header(environ.get('HTTP_RANGE'))
+    if 'HTTP_RANGE' in environ and (byte_range is None or len(byte_range.ranges) != 1):
+        # 按 RFC 9110 忽略无法解析的 Range, 多个区间也不拆成 multipart 响应, 都发送整个文件
+        environ = dict(environ)
+        del environ['HTTP_RANGE']
+    try:
+        response.make_conditional(environ, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable as e:
+        if on_close is not None:
+            on_close()
+        return e.get_response(environ)
+
+    if response.status_code == 206:
+        start, length = response.content_range.start, response.content_length
+    elif response.status_code == 200:
+        start, length = 0, size
+    else:
+        # 304 和 412 没有响应体
+        response.response = []
+        if on_close is not None:
+            on_close()
+        return response
+    if request.method == 'HEAD':
+        response.response = []
+        if on_close is not None:
+            on_close()
+        return response
+    file = FileRange(path, start, length, on_close, serve_bandwidth.open(client_address()))
+    response.response = wrap_file(request.environ, file, FILE_SEND_BLOCK_SIZE)
+    return response
 
 @app.route('/download_video/<download_id>', methods=['GET'])
 def download_completed_video(download_id):
     """
     下载已完成处理的视频文件
     """
-    if download_id not in download_progress:
+    progress_data = progress_registry.snapshot(download_id) or restore_progress_from_journal(download_id)
+    if progress_data is None:
         return jsonify({'error': 'Download ID not found'}), 404
     
-    progress_data = download_progress[download_id]
-    
+    if progress_data['status'] == 'expired':
+        return jsonify({'error': EXPIRED_ERROR, 'status': 'expired'}), 410
     if progress_data['status'] != 'completed':
         return jsonify({'error': 'Download not completed yet'}), 400
     
     filename = progress_data.get('filename_on_server')
     if not filename or not os.path.exists(filename):
-        return jsonify({'error': 'File not found on server'}), 404
+        # 文件在记录更新之前被删除(例如被其他进程清理)
+        progress_registry.update(download_id, status='expired', error=EXPIRED_ERROR)
+        return jsonify({'error': EXPIRED_ERROR, 'status': 'expired'}), 410
     
     suggested_filename = progress_data.get('suggested_filename', os.path.basename(filename))
     mimetype = progress_data.get('mimetype', 'application/octet-stream')
     
-    return send_from_directory(
-        directory=os.path.dirname(filename),
-        path=os.path.basename(filename),
-        as_attachment=True,
-        download_name=suggested_filename,
-        mimetype=mimetype
-    )
+    # 传输期间持有引用, 防止文件被清理
+    artifact_store.acquire(filename)
+    try:
+        return send_artifact_file(filename, suggested_filename, mimetype, on_close=lambda: artifact_store.release(filename))
+    except Exception:
+        artifact_store.release(filename)
+        raise
+
+# 流式任务合并时 ffmpeg 输出的分片 MP4 只追加写入, 可以边写边读
+STREAM_MOVFLAGS = ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+# 边下载边发送时检查文件增长的间隔(秒)
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', 0.25))
+# 等待任务开始写入文件的最长时间(秒), 包括排队时间
+STREAM_START_TIMEOUT = float(os.environ.get('STREAM_START_TIMEOUT', 300))
+
+class StreamAborted(Exception):
+    """
+    任务在发送过程中失败或被取消, 中断连接让客户端知道文件不完整
+    """
+
+def prepare_streaming_download(ydl, info, rewrites_output):
+    """
+    调整流式任务的下载方式, 返回下载中的文件能否边写边读
+
+    单个格式由原生下载器按顺序写入 .part 文件. 需要合并的格式改由 ffmpeg
+    同时下载各路流并直接封装成分片 MP4, 而不是分别下载后再合并.
+    ffmpeg 下载时没有进度回调, 不受下载带宽分配的限制, 所以配置了下载带宽上限时
+    需要合并的格式仍由原生下载器分别下载后合并, 不能边下载边发送.
+    """
+    if rewrites_output:
+        # 音频转换和嵌入字幕会在下载完成后重写文件
+        return False
+    if info.get('requested_formats'):
+        if download_bandwidth.limited:
+            return False
+        ydl.params['external_downloader'] = {'default': 'ffmpeg'}
+    if info.get('ext') == 'mp4':
+        ydl.params['external_downloader_args'] = {'ffmpeg_o': STREAM_MOVFLAGS}
+    downloader = yt_dlp.downloader.get_suitable_downloader(info, ydl.params)
+    if info.get('requested_formats') and downloader is not yt_dlp.downloader.FFmpegFD:
+        # ffmpeg 不可用或不支持这些格式(例如 DASH 分片), 仍然分别下载后合并
+        ydl.params.pop('external_downloader', None)
+        return False
+    # ffmpeg 只有输出分片 MP4 时才是顺序写入的
+    return downloader is not yt_dlp.downloader.FFmpegFD or info.get('ext') == 'mp4'
 
-def download_video_task(download_id, url, format_id, audio_only, audio_format_pref='best', video_quality_pref='best', embed_subs=False):
+def find_streaming_file(work_dir):
+    """
+    返回工作目录中正在写入的文件, 还没有开始写入时返回 None
+    """
+    try:
+        entries = [
+            entry for entry in os.scandir(work_dir)
+            if entry.is_file() and '-Frag' not in entry.name and not entry.name.endswith(('.ytdl', '.temp'))
+        ]
+    except FileNotFoundError:
+        return None
+    if not entries:
+        return None
+    # 优先选择 .part 文件, 多个文件时选最近写入的
+    entry = max(entries, key=lambda e: (e.name.endswith('.part'), e.stat().st_mtime))
+    return entry.path
+
+def stream_growing_file(download_id, file, client):
+    """
+    从头发送正在写入的文件, 追上写入位置后等待新数据, 直到任务结束
+    """
+    event = threading.Event()
+    progress_notifier.subscribe([download_id], event)
+    bandwidth = serve_bandwidth.open(client)
+    try:
+        while True:
+            data = file.read(FILE_SEND_BLOCK_SIZE)
+            if data:
+                bandwidth.consume(len(data))
+                yield data
+                continue
+            status = progress_registry.get_status(download_id)
+            if status in FINAL_STATUSES:
+                # 状态变化前写入的数据可能还没读完
+                data = file.read()
+                if status != 'completed':
+                    raise StreamAborted(f"Download {download_id} {status} while streaming")
+                if data:
+                    bandwidth.consume(len(data))
+                    yield data
+                return
+            event.wait(STREAM_POLL_INTERVAL)
+            event.clear()
+    finally:
+        progress_notifier.unsubscribe([download_id], event)
+        bandwidth.close()
+        file.close()
+
+@app.route('/stream_video/<download_id>', methods=['GET'])
+def stream_video(download_id):
+    """
+    边下载边发送文件, 需要以 stream=true 开始下载; 任务已完成时等同于 /download_video
+    """
+    event = threading.Event()
+    progress_notifier.subscribe([download_id], event)
+    deadline = time.monotonic() + STREAM_START_TIMEOUT
+    try:
+        while True:
+            progress_data = progress_registry.snapshot(download_id)
+            if progress_data is None:
+                return jsonify({'error': 'Download ID not found'}), 404
+            status = progress_data['status']
+            if status == 'completed':
+                return download_completed_video(download_id)
+            if status in FINAL_STATUSES:
+                return jsonify({'error': f"Download {status}", 'details': progress_data.get('error')}), 409
+            if progress_data.get('streamable') is False:
+                return jsonify({'error': 'This download cannot be streamed. Wait for it to complete and use /download_video.'}), 409
+            if progress_data.get('streamable'):
+                path = find_streaming_file(job_work_dir(download_id))
+                if path is not None:
+                    try:
+                        file = open(path, 'rb')
+                        break
+                    except FileNotFoundError:
+                        # 文件刚好被重命名, 重新查找
+                        continue
+            if time.monotonic() >= deadline:
+                return jsonify({'error': 'Download did not start in time'}), 504
+            event.wait(STREAM_POLL_INTERVAL)
+            event.clear()
+    finally:
+        progress_notifier.unsubscribe([download_id], event)
+
+    name = os.path.basename(path)
+    if name.endswith('.part'):
+        name = name[:-len('.part')]
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = Response(stream_growing_file(download_id, file, client_address()), mimetype=mimetype, direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', **content_disposition_options(progress_data.get('suggested_filename') or name))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def download_video_task(download_id, url, format_id, audio_only, audio_format_pref='best', video_quality_pref='best', embed_subs=False, stream=False, client=None, job_key=None, cancel_event=None):
     """
     后台下载视频任务
     """
     filename_on_server = None
+    # 当前占用的后处理名额; 后处理器出错时没有 finished 回调, 任务结束时归还
+    postprocess_held = []
     
     # 初始化下载进度记录
-    download_progress[download_id] = {
-        'status': 'waiting',
-        'progress': 0,
-        'filename': '',
-        'speed': '',
-        'eta': '',
-        'total_bytes': 0,
-        'downloaded_bytes': 0,
-        'error': None
-    }
+    progress_registry.create(download_id)
 
     if not url:
         app.logger.warning("Download request failed: URL is required.")
-        return jsonify({'error': 'URL is required for download.'}), 400
-    if not format_id and not audio_only: # format_id is crucial unless it's audio_only where we can be more flexible
-        app.logger.warning(f"Download request for {url} failed: Format ID is required for video downloads.")
-        return jsonify({'error': 'Format ID is required for video downloads.'}), 400
+        progress_registry.update(download_id, status='error', error='URL is required for download.')
+        return
+    # 没有指定 format_id 时(例如批量下载)由 yt-dlp 选择最佳格式
 
-    app.logger.info(f"Download request for URL: {url}, Format ID: {format_id}, Options: audio_only={audio_only}, audio_format={audio_format_pref}, video_quality={video_quality_pref}, embed_subs={embed_subs}")
+    app.logger.info(
+        "Download request for URL: %s, Format ID: %s, Options: audio_only=%s, audio_format=%s, video_quality=%s, embed_subs=%s",
+        url, format_id, audio_only, audio_format_pref, video_quality_pref, embed_subs,
+        extra={'url': url, 'format_id': format_id}
+    )
 
+    # 任务在下载带宽中的份额, 随其他任务的开始和结束重新分配
+    bandwidth = download_bandwidth.open(client)
     try:
-        if not os.path.exists(DOWNLOADS_DIR):
-            os.makedirs(DOWNLOADS_DIR)
+        # 每个任务使用独立的工作目录, 完成后再移动到产物库
+        work_dir = job_work_dir(download_id)
+        os.makedirs(work_dir, exist_ok=True)
             
         # 不需要创建进度钩子实例，因为我们现在使用函数
 
         # --- Construct ydl_opts based on user preferences ---
         # 定义一个内部函数，而不是使用lambda
+        last_shared_check = [0.0]
+        last_downloaded = [0]
+        file_started = [None]
+        last_bandwidth_report = [0.0]
         def hook_wrapper(d):
+            if d['status'] == 'downloading':
+                # 按本次回调新下载的字节数占用任务的带宽份额; 开始下载下一个文件时计数从零开始
+                downloaded = d.get('downloaded_bytes') or 0
+                delta = downloaded - last_downloaded[0] if downloaded >= last_downloaded[0] else downloaded
+                last_downloaded[0] = downloaded
+                if file_started[0] is None:
+                    file_started[0] = time.perf_counter()
+                bandwidth.consume(delta)
+                now = time.monotonic()
+                if now - last_bandwidth_report[0] >= BANDWIDTH_REBALANCE_INTERVAL:
+                    # 把分得的速率和实际速率写入进度
+                    last_bandwidth_report[0] = now
+                    progress_registry.update(download_id, bandwidth=bandwidth.stats())
+            elif d['status'] == 'finished':
+                # 记录每个文件的传输速率; 续传或已存在的文件没有 downloading 回调, 不计入
+                if file_started[0] is not None:
+                    elapsed = time.perf_counter() - file_started[0]
+                    size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                    if elapsed > 0 and size:
+                        DOWNLOAD_THROUGHPUT.observe(size / elapsed)
+                file_started[0] = None
+                last_downloaded[0] = 0
+            if state_backend.shared and cancel_event is not None:
+                now = time.monotonic()
+                if now - last_shared_check[0] >= SHARED_STATE_POLL_INTERVAL:
+                    # 检查其他进程发来的取消请求, 并为任务键续期
+                    last_shared_check[0] = now
+                    if shared_cancel_requested(download_id):
+                        cancel_event.set()
+                    elif job_key:
+                        state_backend.set('inflight', job_key, download_id, INFLIGHT_CLAIM_TTL)
+            # 用户取消时中断 yt-dlp 的下载
+            if cancel_event is not None and cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled('Download cancelled by user')
             progress_hook(d, download_id)
-            
-        # 获取cookies文件路径
-        cookies_file = os.environ.get('COOKIES_FILE', os.path.join(os.getcwd(), 'config', 'cookies.txt'))
-        
-        # 检查cookies文件是否存在
-        if os.path.exists(cookies_file):
-            app.logger.info(f"Using cookies file: {cookies_file} (size: {os.path.getsize(cookies_file)} bytes)")
-        else:
-            app.logger.warning(f"Cookies file not found: {cookies_file}")
-        
+
+        postprocess_stages = []
+        stage_started = [None]
+        last_event = [None]
+        def postprocessor_hook(d):
+            # 后处理(合并、转换、嵌入字幕)在有界的 postprocess_pool 中运行, 每个阶段的耗时写入进度
+            if d is last_event[0]:
+                # yt-dlp 为通过选项添加的后处理器注册了两次钩子, 同一个事件会收到两次
+                return
+            last_event[0] = d
+            name = d.get('postprocessor') or 'unknown'
+            if d['status'] == 'started':
+                if not postprocess_stages:
+                    # 下载已经结束, 让出下载名额和带宽份额
+                    download_scheduler.handoff(download_id)
+                    bandwidth.close()
+                cost = postprocess_cost(name, d.get('info_dict') or {}, audio_format_pref if audio_only else None)
+                stage = {'name': name, 'status': 'running'}
+                postprocess_stages.append(stage)
+                if cost:
+                    stage.update(status='waiting', cost=cost)
+                    progress_registry.update(download_id, status='processing', postprocess=[dict(s) for s in postprocess_stages])
+                    wait_started = time.perf_counter()
+                    if not postprocess_pool.acquire(cost, cancel_event):
+                        raise yt_dlp.utils.DownloadCancelled('Download cancelled by user')
+                    postprocess_held.append(cost)
+                    waited = time.perf_counter() - wait_started
+                    POSTPROCESS_WAIT_SECONDS.observe(waited, cost=cost)
+                    stage.update(status='running', wait_ms=round(waited * 1000))
+                stage_started[0] = time.perf_counter()
+                progress_registry.update(download_id, status='processing', postprocess=[dict(s) for s in postprocess_stages])
+            elif d['status'] == 'finished' and postprocess_stages and postprocess_stages[-1]['name'] == name:
+                stage = postprocess_stages[-1]
+                elapsed = time.perf_counter() - stage_started[0]
+                POSTPROCESS_SECONDS.observe(elapsed, postprocessor=name)
+                stage.update(status='finished', ms=round(elapsed * 1000))
+                if stage.get('cost'):
+                    postprocess_pool.release(postprocess_held.pop())
+                progress_registry.update(download_id, postprocess=[dict(s) for s in postprocess_stages])
+
+        # cookies 由 shared_cookies 加载一次, 文件修改后自动重新加载
+        cookies_file = shared_cookies.path
+
         ydl_opts = {
             'noplaylist': True,
             'overwrites': True, # Important for retries or if filename clashes (though we try to make them unique)
+            # 恢复中断的任务时从工作目录中的 .part 文件继续下载
+            'continuedl': True,
             'quiet': True,
             'no_warnings': True,
             # 添加跳过SSL证书验证的选项，解决Twitter等网站的下载问题
             'nocheckcertificate': True,
             'no_check_certificate': True,
             'prefer_insecure': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            },
+            'http_headers': DOWNLOAD_HTTP_HEADERS,
             # 添加cookies文件配置，解决YouTube机器人检测问题
             'cookiesfrombrowser': None,  # 禁用浏览器cookies，强制使用cookies文件
             'cookiefile': cookies_file,
             'cookies': cookies_file,  # 同时使用cookies参数，以确保兼容性
             # 添加重试次数，提高下载成功率
             'retries': 10,
+            # HLS/DASH 分片并行下载
+            'concurrent_fragment_downloads': CONCURRENT_FRAGMENT_DOWNLOADS,
             # Use a more unique filename template to avoid issues with concurrent downloads or special characters.
             # %(id)s (video ID) and %(format_id)s are good for uniqueness.
-            'outtmpl': os.path.join(DOWNLOADS_DIR, '%(id)s_%(format_id)s.%(ext)s'),
+            'outtmpl': os.path.join(work_dir, '%(id)s_%(format_id)s.%(ext)s'),
             # 添加进度钩子函数
             'progress_hooks': [hook_wrapper],
+            'postprocessor_hooks': [postprocessor_hook],
         }
         
         postprocessors = []
@@ -422,7 +4525,13 @@ def download_video_task(download_id, url, format_id, audio_only, audio_format_pr
             # Format selection for audio_only:
             # If 'best' audio format is chosen, 'bestaudio/best' lets yt-dlp pick the container.
             # If a specific audio_format_pref is given, request it directly.
-            ydl_opts['format'] = 'bestaudio/best' if audio_format_pref == 'best' else f'bestaudio[ext={audio_format_pref}]/bestaudio'
+            # 优先选择编码已经符合目标格式的音频流, 转换时只需复制数据流而不必重新编码
+            if audio_format_pref == 'best':
+                ydl_opts['format'] = 'bestaudio/best'
+            elif audio_format_pref in AUDIO_CODEC_PREFIXES:
+                ydl_opts['format'] = f'bestaudio[acodec^={AUDIO_CODEC_PREFIXES[audio_format_pref]}]/bestaudio[ext={audio_format_pref}]/bestaudio'
+            else:
+                ydl_opts['format'] = f'bestaudio[ext={audio_format_pref}]/bestaudio'
 
         else: # Video download (or video + audio)
             # 修改：确保视频下载包含音频轨道
@@ -441,7 +4550,7 @@ def download_video_task(download_id, url, format_id, audio_only, audio_format_pr
                     # It prefers formats that are already combined or allows merging.
                     ydl_opts['format'] = f"{selected_format}[height<=?{quality_val}]/bestvideo[height<=?{quality_val}]+bestaudio/best[height<=?{quality_val}]"
                 except ValueError:
-                    app.logger.warning(f"Invalid video_quality_pref '{video_quality_pref}', defaulting to '{selected_format}'.")
+                    app.logger.warning("Invalid video_quality_pref '%s', defaulting to '%s'.", video_quality_pref, selected_format)
                     ydl_opts['format'] = selected_format # Fallback to selected_format if quality is not 'best' or numeric
             else:
                 ydl_opts['format'] = selected_format # Use the format_id or default if quality is 'best'
@@ -457,27 +4566,51 @@ def download_video_task(download_id, url, format_id, audio_only, audio_format_pr
             ydl_opts['postprocessors'] = postprocessors
         # --- End of ydl_opts construction ---
 
-        # 创建一个可序列化的选项副本用于日志记录
-        log_opts = ydl_opts.copy()
-        log_opts.pop('progress_hooks', None)  # 移除不可序列化的钩子函数
-        app.logger.debug(f"Attempting download with effective yt-dlp opts: {json.dumps(log_opts, indent=2)}")
+        # 只在开启调试日志时创建可序列化的选项副本, 否则每个任务都要白白做一次 JSON 编码
+        if app.logger.isEnabledFor(logging.DEBUG):
+            log_opts = ydl_opts.copy()
+            log_opts.pop('progress_hooks', None)  # 移除不可序列化的钩子函数
+            log_opts.pop('postprocessor_hooks', None)
+            app.logger.debug("Attempting download with effective yt-dlp opts: %s", json.dumps(log_opts, indent=2, default=str))
         
         # Perform download
-        with YoutubeDL(ydl_opts) as ydl:
+        setup_started = time.perf_counter()
+        with youtube_dl_sessions.session(ydl_opts) as ydl:
+            DOWNLOAD_SETUP_SECONDS.observe(time.perf_counter() - setup_started)
             try:
-                info = ydl.extract_info(url, download=True)
+                if stream:
+                    info = ydl.extract_info(url, download=False)
+                    streamable = prepare_streaming_download(ydl, info, rewrites_output=bool(postprocessors) or embed_subs)
+                    progress_registry.update(download_id, streamable=streamable, suggested_filename=f"{info.get('title', 'video')}.{info.get('ext')}")
+                    info = ydl.process_ie_result(info, download=True)
+                else:
+                    info = ydl.extract_info(url, download=True)
+            except yt_dlp.utils.DownloadCancelled:
+                app.logger.info("Download cancelled: %s for %s", download_id, url)
+                progress_registry.update(download_id, status='cancelled')
+                return
             except yt_dlp.utils.DownloadError as de_inner:
-                app.logger.error(f"yt-dlp DownloadError during download for {url}: {str(de_inner)}")
-                download_progress[download_id]['status'] = 'error'
-                download_progress[download_id]['error'] = f"Download failed: {str(de_inner)}"
+                ERRORS.inc(stage='download', error_class=classify_download_error(str(de_inner)))
+                app.logger.error("yt-dlp DownloadError during download for %s: %s", url, de_inner)
+                progress_registry.update(
+                    download_id,
+                    status='error',
+                    error=f"Download failed: {str(de_inner)}"
+                )
                 return
             except Exception as e_inner_extract:
-                app.logger.error(f"yt-dlp generic error during download for {url}: {str(e_inner_extract)}")
-                download_progress[download_id]['status'] = 'error'
-                download_progress[download_id]['error'] = f"An error occurred during video processing: {str(e_inner_extract)}"
+                ERRORS.inc(stage='download', error_class='unexpected')
+                app.logger.error("yt-dlp generic error during download for %s: %s", url, e_inner_extract)
+                progress_registry.update(
+                    download_id,
+                    status='error',
+                    error=f"An error occurred during video processing: {str(e_inner_extract)}"
+                )
                 return
 
-            filename_on_server = ydl.prepare_filename(info)
+            # 后处理(合并、音频转换)可能改变扩展名, 优先使用最终的文件路径
+            requested_downloads = info.get('requested_downloads') or [{}]
+            filename_on_server = requested_downloads[0].get('filepath') or ydl.prepare_filename(info)
             
             # Determine suggested filename for client (more robustly)
             title = info.get('title', 'video')
@@ -491,9 +4624,12 @@ def download_video_task(download_id, url, format_id, audio_only, audio_format_pr
             suggested_filename = f"{title}.{downloaded_ext}"
 
             if not filename_on_server or not os.path.exists(filename_on_server):
-                app.logger.error(f"File not found on server after download attempt: {filename_on_server} for URL {url}")
-                download_progress[download_id]['status'] = 'error'
-                download_progress[download_id]['error'] = 'File not found on server after download processing.'
+                app.logger.error("File not found on server after download attempt: %s for URL %s", filename_on_server, url)
+                progress_registry.update(
+                    download_id,
+                    status='error',
+                    error='File not found on server after download processing.'
+                )
                 return
             
             # Determine mimetype based on actual downloaded extension
@@ -503,56 +4639,194 @@ def download_video_task(download_id, url, format_id, audio_only, audio_format_pr
             else: # Generic fallback
                 mimetype = 'application/octet-stream'
 
+            # 下载期间没有进度回调(例如正在后处理)时取消的任务, 在这里丢弃结果
+            if cancel_event is not None and cancel_event.is_set():
+                app.logger.info("Download cancelled after processing: %s for %s", download_id, url)
+                progress_registry.update(download_id, status='cancelled')
+                return
+
+            if job_key:
+                filename_on_server = artifact_store.add(job_key, filename_on_server, suggested_filename, mimetype)
+                lifecycle_manager.note_added(os.path.getsize(filename_on_server))
+
             # 更新下载进度信息，标记为完成
-            download_progress[download_id]['status'] = 'completed'
-            download_progress[download_id]['filename_on_server'] = filename_on_server
-            download_progress[download_id]['suggested_filename'] = suggested_filename
-            download_progress[download_id]['mimetype'] = mimetype
+            progress_registry.update(
+                download_id,
+                status='completed',
+                filename_on_server=filename_on_server,
+                suggested_filename=suggested_filename,
+                mimetype=mimetype
+            )
             
-            app.logger.info(f"Download completed: {filename_on_server} as {suggested_filename} with mimetype {mimetype}")
+            app.logger.info("Download completed: %s as %s with mimetype %s", filename_on_server, suggested_filename, mimetype)
 
     except yt_dlp.utils.DownloadError as e_outer_dl: # Errors before or during ydl context
         error_message = str(e_outer_dl)
-        app.logger.error(f"Outer DownloadError for {url}: {error_message}")
+        error_class = classify_download_error(error_message)
+        ERRORS.inc(stage='download', error_class=error_class)
+        app.logger.error("Outer DownloadError for %s: %s", url, error_message)
         
         # Check for YouTube bot detection
-        if "Sign in to confirm you're not a bot" in error_message:
-            download_progress[download_id]['status'] = 'error'
-            download_progress[download_id]['error'] = "YouTube bot detection triggered. Please create a cookies.txt file with your YouTube cookies."
-            download_progress[download_id]['details'] = "See https://github.com/yt-dlp/yt-dlp/wiki/FAQ#how-do-i-pass-cookies-to-yt-dlp for instructions."
+        if error_class == 'bot_detection':
+            progress_registry.update(
+                download_id,
+                status='error',
+                error="YouTube bot detection triggered. Please create a cookies.txt file with your YouTube cookies.",
+                details="See https://github.com/yt-dlp/yt-dlp/wiki/FAQ#how-do-i-pass-cookies-to-yt-dlp for instructions."
+            )
             return
             
-        download_progress[download_id]['status'] = 'error'
-        download_progress[download_id]['error'] = f"A download error occurred: {error_message}"
+        progress_registry.update(
+            download_id,
+            status='error',
+            error=f"A download error occurred: {error_message}"
+        )
         return
     except Exception as e_general_outer:
-        app.logger.error(f"Outer general error for {url}: {str(e_general_outer)}")
-        download_progress[download_id]['status'] = 'error'
-        download_progress[download_id]['error'] = f"An unexpected server error occurred during download preparation: {str(e_general_outer)}"
+        ERRORS.inc(stage='download', error_class='unexpected')
+        app.logger.error("Outer general error for %s: %s", url, e_general_outer)
+        progress_registry.update(
+            download_id,
+            status='error',
+            error=f"An unexpected server error occurred during download preparation: {str(e_general_outer)}"
+        )
         return
+    finally:
+        # 后处理器出错时没有 finished 回调, 在这里归还名额
+        for cost in postprocess_held:
+            postprocess_pool.release(cost)
+        bandwidth.close()
     # 不在下载后立即删除文件，而是等待用户下载完成
-    # 可以添加一个定时任务来清理过期的文件
+    # 产物库中的文件由 lifecycle_manager 按闲置时间和磁盘水位清理
+
+def current_rss_bytes():
+    """
+    当前进程的常驻内存(字节), 没有 /proc 时返回 None
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# 预热时加载的提取器: common (URL 匹配规则、YouTube 和通用提取器)、all (全部, 占用更多内存) 或 none
+WARMUP_EXTRACTORS = os.environ.get('WARMUP_EXTRACTORS', 'common').lower()
+
+class Warmup:
+    """
+    服务器开始监听后的后台预热: 导入 yt-dlp, 加载 cookies 并创建提取和下载使用的会话,
+    编译提取器的 URL 匹配规则. 预热完成前请求照常处理, 用到的部分按需加载;
+    /readyz 在完成前返回 503, 负载均衡可以只把流量发给已经预热的工作进程
+    """
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.started_at = None
+        self.ready_at = None
+        self.error = None
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    def start(self):
+        """
+        启动预热线程, 已经启动过时不做任何事
+        """
+        if self.started_at is not None:
+            return
+        with self._lock:
+            if self.started_at is not None:
+                return
+            self.started_at = time.time()
+        thread = Thread(target=self._run, name='warmup')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        steps = [
+            ('import', yt_dlp.load),
+            ('sessions', lambda: youtube_dl_sessions.prewarm(self.profiles)),
+        ]
+        if EXTRACTOR_MODE != 'subprocess' and WARMUP_EXTRACTORS != 'none':
+            steps.append(('extractors', lambda: youtube_dl_sessions.warm_extractors(EXTRACTOR_OPTIONS, WARMUP_EXTRACTORS == 'all')))
+        for name, step in steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                # 预热失败不影响服务, 用到时再加载
+                self.error = f"{name}: {str(e)}"
+                app.logger.warning("Warm-up step %s failed: %s", name, e)
+            self.steps[name] = round((time.perf_counter() - started) * 1000, 1)
+        self.ready_at = time.time()
+        app.logger.info("Warm-up finished in %s ms: %s", round((self.ready_at - self.started_at) * 1000), self.steps)
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'warmup_ms': round((self.ready_at - self.started_at) * 1000, 1) if self.ready else None,
+            'steps': dict(self.steps),
+            'error': self.error,
+        }
+
+warmup = Warmup([EXTRACTOR_OPTIONS, {'nocheckcertificate': True, 'http_headers': DOWNLOAD_HTTP_HEADERS}])
+
+@app.before_request
+def start_warmup():
+    # 没有通过入口启动预热的服务器(例如其他 WSGI 服务器)在第一个请求时开始
+    warmup.start()
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    存活检查: 进程能处理请求就返回 200
+    """
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    就绪检查: 处理这个请求的工作进程预热完成后返回 200, 之前返回 503; 同时报告启动耗时和内存占用
+    """
+    rss = current_rss_bytes()
+    body = dict(
+        warmup.stats(),
+        status='ready' if warmup.ready else 'warming',
+        pid=os.getpid(),
+        import_ms=IMPORT_MS,
+        rss_mb=round(rss / (1024 * 1024), 1) if rss is not None else None,
+    )
+    return jsonify(body), 200 if warmup.ready else 503
+
+# 加载本模块(包括 Flask, 不包括 yt-dlp)用去的时间
+IMPORT_MS = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+
+if __name__ != '__main__' and job_journal is not None:
+    # 由 gunicorn 或 ASGI 服务器导入时立即开始恢复中断的任务
+    job_journal.start()
 
 if __name__ == '__main__':
     # Get port from environment variable or use default 5001 (to avoid conflicts with AirPlay on macOS)
     port = int(os.environ.get('PORT', 5001))
     
-    # Get debug mode from environment variable or default to True
-    debug_mode = os.environ.get('DEBUG', 'True').lower() in ('true', '1', 't')
+    # Get debug mode from environment variable; the debugger and reloader are for development only
+    debug_mode = os.environ.get('DEBUG', 'False').lower() in ('true', '1', 't')
     
     print(f"Serving on http://127.0.0.1:{port}")
     print(f"Video downloads will be saved to: {DOWNLOADS_DIR}")
     
-    # Set up basic logging for the app
-    log_file = os.environ.get('LOG_FILE', 'web_server.log')
-    if not app.debug:
-        file_handler = RotatingFileHandler(log_file, maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-        ))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('yt-dlp Web UI startup')
+    # 日志输出由 configure_logging 按 LOG_* 环境变量设置, LOG_FILE 默认为 web_server.log
+    app.logger.info('yt-dlp Web UI startup')
+
+    # 调试模式下 werkzeug 的重载器在父进程中运行, 只在处理请求的子进程中恢复任务
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if job_journal is not None:
+            job_journal.start()
+        warmup.start()
 
     app.run(host='0.0.0.0', port=port, debug=debug_mode)